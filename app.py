@@ -1,7 +1,6 @@
-from flask import Flask, render_template, request, jsonify
-from prompt_manager import PromptManager
-from keyboard_listener import KeyboardListener
-from gemini_client import GeminiClient
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from daemon_client import connect_daemon, use_daemon
+import json
 import threading
 import os
 import sys
@@ -40,13 +39,16 @@ else:
     # Fallback to default Flask behavior (looks in templates/ and static/ relative to app.py)
     app = Flask(__name__)
 
-prompt_manager = PromptManager()
-gemini_client = GeminiClient()
-listener = KeyboardListener(prompt_manager, gemini_client)
-
-# Start listener in a separate thread to avoid blocking Flask
-# Note: pynput listener is already threaded, but we start it here.
-listener.start()
+# The keyboard hook, prompts and enhancer live in the shared daemon (started
+# on demand); with PROMPTMANAGER_DAEMON=0 they run in this process instead,
+# behind the same interface
+if use_daemon():
+    service = connect_daemon()
+    local_service = None
+else:
+    from daemon import PromptDaemon
+    service = local_service = PromptDaemon()
+    local_service.start(serve=False)
 
 @app.route('/')
 def index():
@@ -76,9 +78,9 @@ def save_settings():
         with open('.env', 'w') as f:
             f.write(f"GEMINI_API_KEY={api_key}")
         
-        # Update current process environment and client
+        # Update the enhancer's key (and this process's environment)
         os.environ["GEMINI_API_KEY"] = api_key
-        gemini_client.configure(api_key)
+        service.configure_api_key(api_key=api_key)
         
         return jsonify({"status": "success", "message": "Settings saved"})
     return jsonify({"status": "error", "message": "Invalid API Key"}), 400
@@ -86,7 +88,7 @@ def save_settings():
 @app.route('/api/prompts/defaults', methods=['GET'])
 def get_default_prompts():
     """Get default prompts from prompts.json file"""
-    return jsonify(prompt_manager.get_prompts())
+    return jsonify(service.prompts_snapshot()['prompts'])
 
 @app.route('/api/prompts/sync', methods=['POST'])
 def sync_prompts():
@@ -101,9 +103,7 @@ def sync_prompts():
         
         # Update the prompt manager with synced prompts
         # Clear existing and add all synced prompts
-        with prompt_manager.lock:
-            prompt_manager.prompts = prompts.copy()
-        prompt_manager.save_prompts()
+        service.prompts_replace(prompts=prompts)
         
         return jsonify({"status": "success", "message": "Prompts synced successfully"})
     except Exception as e:
@@ -111,6 +111,20 @@ def sync_prompts():
         print(f"Error syncing prompts: {traceback.format_exc()}")
         return jsonify({"status": "error", "message": f"Failed to sync prompts: {str(e)}"}), 500
 
+@app.route('/api/prompts/search', methods=['GET'])
+def search_prompts():
+    """Ranked search over prompt shortcuts and text (?q=words&limit=N)"""
+    query = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 200))
+    except ValueError:
+        limit = 20
+    results = service.prompts_search(query=query, limit=limit)
+    return jsonify({
+        "query": query,
+        "results": [{"shortcut": shortcut, "prompt": data} for shortcut, data in results],
+    })
+
 @app.route('/api/prompts/track-usage', methods=['POST'])
 def track_usage():
     """Track prompt usage for recently used feature"""
@@ -118,29 +132,143 @@ def track_usage():
         if not request.json:
             return jsonify({"status": "error", "message": "No data provided"}), 400
         
-        shortcut = request.json.get('shortcut')
-        if not shortcut:
-            return jsonify({"status": "error", "message": "Shortcut not provided"}), 400
+        # Accept a batch of events from the listener's usage tracker, or a
+        # single shortcut
+        events = request.json.get('events')
+        if events is None:
+            shortcut = request.json.get('shortcut')
+            if not shortcut:
+                return jsonify({"status": "error", "message": "Shortcut not provided"}), 400
+            events = [{'shortcut': shortcut}]
+        if not isinstance(events, list) or not all(isinstance(e, dict) for e in events):
+            return jsonify({"status": "error", "message": "Invalid events format"}), 400
         
-        # This endpoint is called by the keyboard listener when a shortcut is used
-        # The frontend will handle storing it in localStorage
-        return jsonify({"status": "success", "message": "Usage tracked"})
+        service.usage_record(events=events)
+        return jsonify({"status": "success", "message": "Usage tracked", "count": len(events)})
+    except ValueError as e:
+        # Invalid timestamps reject the whole batch
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": f"Failed to track usage: {str(e)}"}), 500
 
+def _usage_limit():
+    try:
+        return max(1, min(int(request.args.get('limit', 10)), 100))
+    except ValueError:
+        return 10
+
+@app.route('/api/usage/top', methods=['GET'])
+def usage_top():
+    """Most used shortcuts"""
+    return jsonify(service.usage_top(limit=_usage_limit()))
+
+@app.route('/api/usage/recent', methods=['GET'])
+def usage_recent():
+    """Most recently used shortcuts, newest first"""
+    return jsonify(service.usage_recent(limit=_usage_limit()))
+
+@app.route('/api/usage/<path:shortcut>', methods=['GET'])
+def usage_for_shortcut(shortcut):
+    """Counters and usage histogram for one shortcut"""
+    stats = service.usage_get(shortcut=shortcut)
+    if stats is None:
+        return jsonify({"status": "error", "message": "No usage recorded"}), 404
+    return jsonify(stats)
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Latency histograms and counters, as JSON or Prometheus text (?format=prometheus)"""
+    fmt = request.args.get('format')
+    if fmt is None and 'text/plain' in request.headers.get('Accept', ''):
+        fmt = 'prometheus'
+    if fmt == 'prometheus':
+        return Response(service.metrics_snapshot(format='prometheus'), mimetype='text/plain; version=0.0.4')
+    return jsonify(service.metrics_snapshot())
+
+@app.route('/api/enhance/batch', methods=['POST'])
+def create_batch_enhancement():
+    """
+    Start a background job enhancing many prompts.
+
+    Body: {"shortcuts": [...]} or {"tag": "..."} or {"all": true} to select
+    stored prompts, or {"items": [{"id", "text"}]} for ad-hoc text; plus
+    optional "force_refresh" and "apply" (write results back to the prompts).
+    """
+    data = request.json
+    if not data:
+        return jsonify({"status": "error", "message": "No data provided"}), 400
+    options = {'force_refresh': bool(data.get('force_refresh')), 'apply': bool(data.get('apply'))}
+    if 'items' in data:
+        items = data['items']
+        if not isinstance(items, list) or not all(
+                isinstance(item, dict) and isinstance(item.get('text'), str) for item in items):
+            return jsonify({"status": "error", "message": "Invalid items format"}), 400
+        options['items'] = items
+    elif data.get('shortcuts') is not None or data.get('tag') is not None or data.get('all'):
+        shortcuts = data.get('shortcuts')
+        if shortcuts is not None and not isinstance(shortcuts, list):
+            return jsonify({"status": "error", "message": "Invalid shortcuts format"}), 400
+        options.update(shortcuts=shortcuts, tag=data.get('tag'), select_all=bool(data.get('all')))
+    else:
+        return jsonify({"status": "error", "message": "Select prompts with shortcuts, tag, all or items"}), 400
+    try:
+        job = service.batch_create(**options)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "accepted", "job": job}), 202
+
+@app.route('/api/enhance/batch', methods=['GET'])
+def list_batch_enhancements():
+    return jsonify(service.batch_list())
+
+@app.route('/api/enhance/batch/<job_id>', methods=['GET'])
+def get_batch_enhancement(job_id):
+    """Job progress with the status of every item"""
+    job = service.batch_get(job_id=job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/enhance/batch/<job_id>/items/<int:index>', methods=['GET'])
+def get_batch_item(job_id, index):
+    event = service.batch_item(job_id=job_id, index=index)
+    if event is None:
+        return jsonify({"status": "error", "message": "Item not found"}), 404
+    return jsonify(event)
+
+@app.route('/api/enhance/batch/<job_id>/stream', methods=['GET'])
+def stream_batch_enhancement(job_id):
+    """Finished items as newline-delimited JSON; ?from=N skips items already received"""
+    if service.batch_get(job_id=job_id) is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    start = request.args.get('from', 0, type=int)
+
+    def generate():
+        for event in service.batch_stream(job_id, start):
+            yield json.dumps(event) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/enhance/batch/<job_id>/cancel', methods=['POST'])
+def cancel_batch_enhancement(job_id):
+    job = service.batch_cancel(job_id=job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": job})
+
+@app.route('/api/enhance/batch/<job_id>/resume', methods=['POST'])
+def resume_batch_enhancement(job_id):
+    job = service.batch_resume(job_id=job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": job})
+
 @app.route('/api/keyboard/status', methods=['GET'])
 def keyboard_status():
     """Check keyboard listener status"""
     try:
-        # Check if listener is running
-        is_running = False
-        if listener.running and listener.listener is not None:
-            try:
-                # pynput listener has a running property
-                is_running = getattr(listener.listener, 'running', False)
-            except:
-                # Fallback: if listener exists and running flag is True, assume it's running
-                is_running = listener.running
+        # Check if the daemon's listener is running
+        is_running = service.listener_status()['running']
         
         # Detect session type
         session_type = os.environ.get('XDG_SESSION_TYPE', 'unknown')
@@ -166,8 +294,13 @@ def keyboard_status():
 
 def main():
     """Entry point for the application"""
-    app.run(debug=True, port=5000, use_reloader=False) 
-    # use_reloader=False is important to avoid starting two listeners
+    try:
+        app.run(debug=True, port=5000, use_reloader=False) 
+        # use_reloader=False avoids loading the app (and, without the daemon, a listener) twice
+    finally:
+        # The daemon keeps running for the other clients
+        if local_service is not None:
+            local_service.stop()
 
 if __name__ == '__main__':
     main()
@@ -5,17 +5,27 @@ with a system tray icon for easy management.
 import sys
 import os
 import threading
-from prompt_manager import PromptManager
-from keyboard_listener import KeyboardListener
+from daemon_client import connect_daemon, use_daemon
 import pystray
 from PIL import Image, ImageDraw
 import subprocess
 
 class BackgroundService:
     def __init__(self):
-        self.prompt_manager = PromptManager()
-        self.listener = KeyboardListener(self.prompt_manager)
-        self.running = False
+        # The tray controls the daemon's listener; quitting the tray leaves
+        # the daemon running for the GUI and the web app
+        self.daemon = connect_daemon() if use_daemon() else None
+        if self.daemon is not None:
+            self.prompt_manager = None
+            self.listener = None
+        else:
+            from prompt_manager import PromptManager
+            from keyboard_listener import KeyboardListener
+            # Edits made in the GUI are picked up without a restart
+            self.prompt_manager = PromptManager(watch=True)
+            self.listener = KeyboardListener(self.prompt_manager)
+        # The daemon starts its listener itself; don't start it twice
+        self.running = self.daemon is not None and self.daemon.listener_status()['running']
         self.icon = None
         
     def create_icon_image(self):
@@ -31,14 +41,20 @@ class BackgroundService:
     def start_listener(self):
         """Start the keyboard listener"""
         if not self.running:
-            self.listener.start()
+            if self.daemon is not None:
+                self.daemon.listener_start()
+            else:
+                self.listener.start()
             self.running = True
             print("Keyboard listener started")
     
     def stop_listener(self):
         """Stop the keyboard listener"""
         if self.running:
-            self.listener.stop()
+            if self.daemon is not None:
+                self.daemon.listener_stop()
+            else:
+                self.listener.stop()
             self.running = False
             print("Keyboard listener stopped")
     
@@ -49,9 +65,18 @@ class BackgroundService:
         subprocess.Popen([sys.executable, gui_script], 
                         creationflags=subprocess.CREATE_NEW_CONSOLE if sys.platform == 'win32' else 0)
     
+    def shutdown(self):
+        """Stop the in-process listener; the daemon keeps running"""
+        if self.daemon is not None:
+            self.daemon.close()
+        else:
+            self.stop_listener()
+            self.listener.close()
+            self.prompt_manager.flush()
+
     def on_quit(self, icon=None, item=None):
         """Handle quit action"""
-        self.stop_listener()
+        self.shutdown()
         if self.icon:
             self.icon.stop()
         sys.exit(0)
@@ -88,6 +113,6 @@ if __name__ == "__main__":
     try:
         service.run()
     except KeyboardInterrupt:
-        service.stop_listener()
+        service.shutdown()
         sys.exit(0)
 
@@ -0,0 +1,460 @@
+"""
+Background batch enhancement of stored prompts.
+Jobs run on a bounded worker pool, paced to a requests-per-minute budget and
+backing off when the API reports rate limiting. Job state is persisted after
+every item so unfinished jobs resume after a restart, and finished items can
+be streamed to clients as they complete.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from request_scheduler import is_rate_limit_error, is_retryable_error
+
+ITEMS_DONE = metrics.counter('promptmanager_batch_items_done_total',
+                             'Batch enhancement items completed successfully')
+ITEMS_FAILED = metrics.counter('promptmanager_batch_items_failed_total',
+                               'Batch enhancement items that failed after all attempts')
+RATE_LIMITED = metrics.counter('promptmanager_batch_rate_limited_total',
+                               'Batch enhancement requests rejected for rate limiting')
+
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_CANCELLED = "cancelled"
+
+ITEM_PENDING = "pending"
+ITEM_RUNNING = "running"
+ITEM_DONE = "done"
+ITEM_ERROR = "error"
+
+
+def items_from_prompts(prompts, shortcuts=None, tag=None):
+    """
+    Build batch items from stored prompts.
+
+    Args:
+        prompts: Mapping of shortcut to prompt data.
+        shortcuts: Only include these shortcuts (all prompts when None).
+        tag: Only include prompts whose "tags" list contains this tag.
+
+    Raises:
+        ValueError: If a requested shortcut does not exist.
+    """
+    if shortcuts is not None:
+        missing = [shortcut for shortcut in shortcuts if shortcut not in prompts]
+        if missing:
+            raise ValueError(f"Unknown shortcuts: {', '.join(missing)}")
+        selected = shortcuts
+    else:
+        selected = list(prompts)
+
+    items = []
+    for shortcut in selected:
+        data = prompts[shortcut]
+        if isinstance(data, dict):
+            if tag is not None and tag not in (data.get('tags') or []):
+                continue
+            text = data.get('text', '')
+        else:
+            if tag is not None:
+                continue
+            text = data
+        if text.strip():
+            items.append({'id': shortcut, 'shortcut': shortcut, 'text': text})
+    return items
+
+
+class BatchJob:
+    """State of one batch enhancement job"""
+
+    def __init__(self, job_id, items, force_refresh=False, apply=False,
+                 status=JOB_RUNNING, created=None, finished=None):
+        self.id = job_id
+        self.items = items
+        self.force_refresh = force_refresh
+        self.apply = apply
+        self.status = status
+        self.created = created or time.time()
+        self.finished = finished
+        # Indices of finished items in completion order, for streaming
+        self.order = [index for index, item in sorted(
+            enumerate(items), key=lambda pair: pair[1].get('finished') or 0)
+            if item['status'] in (ITEM_DONE, ITEM_ERROR)]
+        self.condition = threading.Condition()
+
+    @classmethod
+    def new(cls, items, force_refresh=False, apply=False):
+        job_items = []
+        for index, item in enumerate(items):
+            job_items.append({
+                'id': str(item.get('id', index)),
+                'shortcut': item.get('shortcut'),
+                'text': item['text'],
+                'status': ITEM_PENDING,
+                'result': None,
+                'error': None,
+                'attempts': 0,
+                'started': None,
+                'finished': None,
+            })
+        return cls(uuid.uuid4().hex[:12], job_items, force_refresh, apply)
+
+    @classmethod
+    def from_dict(cls, data):
+        items = data['items']
+        for item in items:
+            # Items interrupted mid-request run again
+            if item['status'] == ITEM_RUNNING:
+                item['status'] = ITEM_PENDING
+        return cls(data['id'], items, data.get('force_refresh', False), data.get('apply', False),
+                   data.get('status', JOB_RUNNING), data.get('created'), data.get('finished'))
+
+    @property
+    def done(self):
+        return all(item['status'] in (ITEM_DONE, ITEM_ERROR) for item in self.items)
+
+    def counts(self):
+        counts = {ITEM_PENDING: 0, ITEM_RUNNING: 0, ITEM_DONE: 0, ITEM_ERROR: 0}
+        for item in self.items:
+            counts[item['status']] += 1
+        return counts
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'created': self.created,
+            'finished': self.finished,
+            'total': len(self.items),
+            'counts': self.counts(),
+            'force_refresh': self.force_refresh,
+            'apply': self.apply,
+        }
+
+    def to_dict(self):
+        data = self.summary()
+        data['items'] = [dict(item) for item in self.items]
+        return data
+
+    def item_event(self, index):
+        item = self.items[index]
+        return {'type': 'item', 'index': index, 'id': item['id'], 'status': item['status'],
+                'result': item['result'], 'error': item['error'], 'attempts': item['attempts']}
+
+
+class BatchEnhancer:
+    """Runs batch enhancement jobs in the background"""
+
+    def __init__(self, gemini_client, prompt_manager=None, state_dir="batch_jobs",
+                 max_workers=4, requests_per_minute=15, max_attempts=3,
+                 backoff=5.0, max_backoff=120.0):
+        """
+        Initialize the batch enhancer.
+
+        Args:
+            gemini_client: Client providing generate_enhancement() and
+                           cached_enhancement().
+            prompt_manager: Needed for jobs that write results back.
+            state_dir: Directory holding one JSON file per job.
+            max_workers: Maximum number of concurrent API calls.
+            requests_per_minute: API request budget; calls are spaced evenly.
+                                 Cached results don't count against it.
+            max_attempts: Attempts per item for rate-limit and server errors.
+                          Use 1 when gemini_client retries by itself (a
+                          RequestScheduler), so retries don't multiply.
+            backoff: Initial pause in seconds after a rate-limit error,
+                     doubled for every further attempt.
+            max_backoff: Upper bound for the pause.
+        """
+        self.gemini_client = gemini_client
+        self.prompt_manager = prompt_manager
+        self.state_dir = state_dir
+        self.max_workers = max_workers
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jobs = {}
+        self.queue = deque()  # (job, item index)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.save_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.stop_event = threading.Event()
+        self.next_request_at = 0.0
+        self.paused_until = 0.0
+        self.executor = None
+        self.dispatcher = None
+
+    def start(self):
+        """Load persisted jobs, resume unfinished ones and start dispatching"""
+        if self.dispatcher and self.dispatcher.is_alive():
+            return
+        self.stop_event.clear()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='batch')
+        self._load()
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def stop(self):
+        """Stop dispatching; unfinished items resume on the next start()"""
+        self.stop_event.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load(self):
+        if not os.path.isdir(self.state_dir):
+            return
+        for name in sorted(os.listdir(self.state_dir)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.state_dir, name), 'r') as f:
+                    job = BatchJob.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping unreadable batch job {name}: {e}")
+                continue
+            with self.lock:
+                self.jobs[job.id] = job
+            if job.status == JOB_RUNNING:
+                print(f"Resuming batch job {job.id} ({job.counts()[ITEM_PENDING]} items left)")
+                self._enqueue(job)
+
+    def _save(self, job):
+        with job.condition:
+            data = job.to_dict()
+        path = os.path.join(self.state_dir, f"{job.id}.json")
+        with self.save_lock:
+            try:
+                os.makedirs(self.state_dir, exist_ok=True)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f, indent=4)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Error saving batch job {job.id}: {e}")
+
+    def create_job(self, items, force_refresh=False, apply=False):
+        """
+        Create a job and start it in the background.
+
+        Args:
+            items: List of {"text", optional "id", optional "shortcut"}.
+            force_refresh: Bypass the enhancement cache.
+            apply: Write each result back to its prompt's text.
+
+        Returns:
+            The BatchJob.
+        """
+        if apply and self.prompt_manager is None:
+            raise ValueError("Applying results requires a prompt manager")
+        job = BatchJob.new(items, force_refresh, apply)
+        if not job.items:
+            job.status = JOB_COMPLETED
+            job.finished = time.time()
+        with self.lock:
+            self.jobs[job.id] = job
+        self._save(job)
+        if job.status == JOB_RUNNING:
+            self._enqueue(job)
+        return job
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return sorted(jobs, key=lambda job: job.created, reverse=True)
+
+    def cancel(self, job_id):
+        """Stop scheduling a job's remaining items; running items still finish"""
+        job = self.get_job(job_id)
+        if job is None:
+            return None
+        with job.condition:
+            if job.status == JOB_RUNNING:
+                job.status = JOB_CANCELLED
+                job.condition.notify_all()
+        self._save(job)
+        return job
+
+    def resume(self, job_id, retry_errors=True):
+        """Continue a cancelled job, optionally retrying failed items"""
+        job = self.get_job(job_id)
+        if job is None:
+            return None
+        with job.condition:
+            if retry_errors:
+                for item in job.items:
+                    if item['status'] == ITEM_ERROR:
+                        item.update(status=ITEM_PENDING, error=None, attempts=0, finished=None)
+                job.order = [index for index in job.order if job.items[index]['status'] == ITEM_DONE]
+            if job.done:
+                return job
+            job.status = JOB_RUNNING
+            job.finished = None
+        self._save(job)
+        self._enqueue(job)
+        return job
+
+    def _enqueue(self, job):
+        with self.wakeup:
+            for index, item in enumerate(job.items):
+                if item['status'] == ITEM_PENDING:
+                    self.queue.append((job, index))
+            self.wakeup.notify()
+
+    def _dispatch(self):
+        while True:
+            with self.wakeup:
+                while not self.queue and not self.stop_event.is_set():
+                    self.wakeup.wait()
+                if self.stop_event.is_set():
+                    return
+                job, index = self.queue.popleft()
+
+            item = job.items[index]
+            if job.status != JOB_RUNNING or item['status'] != ITEM_PENDING:
+                continue
+
+            # Cached results are free; don't spend rate budget on them
+            if not job.force_refresh:
+                cached = self.gemini_client.cached_enhancement(item['text'])
+                if cached is not None:
+                    self._finish_item(job, index, result=cached)
+                    continue
+
+            self.slots.acquire()
+            if not self._wait_for_budget():
+                self.slots.release()
+                return
+            with job.condition:
+                item['status'] = ITEM_RUNNING
+                item['attempts'] += 1
+                item['started'] = time.time()
+            try:
+                self.executor.submit(self._run_item, job, index)
+            except RuntimeError:
+                # Executor shut down while waiting
+                self.slots.release()
+                return
+
+    def _wait_for_budget(self):
+        """Block until the next request may be sent; False when stopping"""
+        while True:
+            now = time.monotonic()
+            ready_at = max(self.next_request_at, self.paused_until)
+            if now >= ready_at:
+                self.next_request_at = now + self.interval
+                return True
+            if self.stop_event.wait(ready_at - now):
+                return False
+
+    def _run_item(self, job, index):
+        item = job.items[index]
+        try:
+            result = self.gemini_client.generate_enhancement(item['text'], job.force_refresh)
+            if not result:
+                raise ValueError("Empty response")
+        except Exception as e:
+            self._handle_failure(job, index, e)
+        else:
+            self._finish_item(job, index, result=result)
+        finally:
+            self.slots.release()
+
+    def _handle_failure(self, job, index, error):
+        item = job.items[index]
+        if is_rate_limit_error(error):
+            RATE_LIMITED.inc()
+            delay = min(self.max_backoff, self.backoff * 2 ** (item['attempts'] - 1))
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            print(f"Batch job {job.id}: rate limited, pausing {delay:g}s")
+        if is_retryable_error(error) and item['attempts'] < self.max_attempts:
+            with job.condition:
+                item['status'] = ITEM_PENDING
+                item['error'] = str(error)
+            with self.wakeup:
+                # Retry ahead of items that have not been tried yet
+                self.queue.appendleft((job, index))
+                self.wakeup.notify()
+            return
+        self._finish_item(job, index, error=str(error))
+
+    def _finish_item(self, job, index, result=None, error=None):
+        item = job.items[index]
+        with job.condition:
+            item['status'] = ITEM_ERROR if error is not None else ITEM_DONE
+            item['result'] = result
+            item['error'] = error
+            item['finished'] = time.time()
+            job.order.append(index)
+            if job.done and job.status == JOB_RUNNING:
+                job.status = JOB_COMPLETED
+                job.finished = time.time()
+            job.condition.notify_all()
+        if error is not None:
+            ITEMS_FAILED.inc()
+        else:
+            ITEMS_DONE.inc()
+            if job.apply and item.get('shortcut'):
+                self._apply(item['shortcut'], result)
+        self._save(job)
+
+    def _apply(self, shortcut, result):
+        data = self.prompt_manager.get_prompt(shortcut)
+        if data is None:
+            return
+        if isinstance(data, dict):
+            data = dict(data, text=result)
+        else:
+            data = result
+        try:
+            self.prompt_manager.add_prompt(shortcut, data)
+        except Exception as e:
+            print(f"Error applying enhancement to {shortcut}: {e}")
+
+    def stream(self, job, start=0, timeout=None):
+        """
+        Yield finished items in completion order, waiting for new ones,
+        followed by the job summary once it stops running.
+
+        Args:
+            job: The BatchJob to follow.
+            start: Number of finished items the client already has.
+            timeout: If set, return early (without the summary) after the
+                     first batch of new items, or after waiting this many
+                     seconds for one; for long polling.
+        """
+        position = max(0, start)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with job.condition:
+                while position >= len(job.order) and job.status == JOB_RUNNING:
+                    if deadline is None:
+                        job.condition.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    job.condition.wait(remaining)
+                events = [job.item_event(index) for index in job.order[position:]]
+                position = len(job.order)
+                summary = job.summary() if job.status != JOB_RUNNING else None
+            for event in events:
+                yield event
+            if summary is not None:
+                summary['type'] = 'job'
+                yield summary
+                return
+            if deadline is not None:
+                return
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Headless keystroke replay benchmark for the keyboard listener.
+
+Drives KeyboardListener.on_press with synthetic or recorded key streams
+against generated prompt libraries, using a FakeController so no display or
+real keyboard hook is needed. Prints machine-readable JSON so matcher, buffer
+and injector regressions can be tracked over time.
+
+With --enhance it instead measures enhancement throughput and tail latency
+through GeminiClient and the HTTP backend, against stub_llm_server.py
+(started in-process unless --llm-url is given), so no network is needed.
+
+With --memory it measures the resident size and load time of each library
+held as plain dicts (as parsed from prompts.json), as PromptRecords, and
+loaded from the text store (bodies memory-mapped, not on the heap).
+
+Usage:
+    python benchmark.py --sizes 10,1000,100000 --keys 20000 --output bench.json
+    python benchmark.py --replay recorded.txt
+    python benchmark.py --enhance --concurrency 1,4,16 --requests 200 --stream
+    python benchmark.py --memory --sizes 1000,100000
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import enum
+import gc
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+
+def _install_headless_pynput():
+    """
+    Register a minimal pynput stand-in when the real package cannot be used
+    (not installed, or no display to connect to). Only the names the listener
+    imports are provided; the benchmark never starts a real hook.
+    """
+    class Key(enum.Enum):
+        alt = 'alt'
+        backspace = 'backspace'
+        cmd = 'cmd'
+        ctrl = 'ctrl'
+        enter = 'enter'
+        left = 'left'
+        shift = 'shift'
+        space = 'space'
+
+    class KeyCode:
+        def __init__(self, char=None):
+            self.char = char
+
+        @classmethod
+        def from_char(cls, char):
+            return cls(char)
+
+    class Controller:
+        def press(self, key):
+            pass
+
+        def release(self, key):
+            pass
+
+        def type(self, text):
+            pass
+
+    class Listener:
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError("Keyboard hooks are not available in headless benchmark mode")
+
+    keyboard_module = types.ModuleType('pynput.keyboard')
+    keyboard_module.Key = Key
+    keyboard_module.KeyCode = KeyCode
+    keyboard_module.Controller = Controller
+    keyboard_module.Listener = Listener
+    pynput_module = types.ModuleType('pynput')
+    pynput_module.keyboard = keyboard_module
+    sys.modules['pynput'] = pynput_module
+    sys.modules['pynput.keyboard'] = keyboard_module
+
+
+try:
+    from pynput.keyboard import Key, KeyCode
+except Exception:
+    _install_headless_pynput()
+    from pynput.keyboard import Key, KeyCode
+
+from prompt_manager import PromptManager
+from keyboard_listener import KeyboardListener
+from input_injector import FakeController, FakeClipboard
+from usage_tracker import UsageTracker
+from prompt_records import records_from_prompts
+
+WORDS = ("the", "fix", "add", "commit", "build", "test", "deploy", "review", "refactor",
+         "server", "client", "bug", "feature", "branch", "install", "script", "check",
+         "update", "config", "module", "release", "docs", "cleanup", "prompt")
+
+
+def generate_library(size, seed=0):
+    """
+    Generate a prompt library shaped like prompts.json: unique shortcuts,
+    mostly with "!!" prepended or postpended, and bodies from one line to
+    several paragraphs.
+    """
+    rng = random.Random(seed)
+    prompts = {}
+    while len(prompts) < size:
+        shortcut = rng.choice(WORDS) + ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 8)))
+        if shortcut in prompts:
+            continue
+        style = rng.random()
+        prepend = "!!" if style < 0.5 else ""
+        postpend = "!!" if 0.5 <= style < 0.8 else ""
+        body = ' '.join(rng.choice(WORDS) for _ in range(rng.choice((8, 20, 60, 150))))
+        prompts[shortcut] = {"text": body, "prepend": prepend, "postpend": postpend}
+    return prompts
+
+
+def synthetic_stream(prompts, count, seed=0, trigger_rate=0.05):
+    """
+    Generate a key stream of prose with occasional triggers, typos
+    (backspace) and line breaks (enter).
+    """
+    rng = random.Random(seed)
+    shortcuts = list(prompts)
+    keys = []
+    while len(keys) < count:
+        if shortcuts and rng.random() < trigger_rate:
+            shortcut = rng.choice(shortcuts)
+            data = prompts[shortcut]
+            word = data["prepend"] + shortcut + data["postpend"]
+        else:
+            word = rng.choice(WORDS)
+        for char in word:
+            keys.append(KeyCode.from_char(char))
+            if rng.random() < 0.02:
+                keys.append(Key.backspace)
+                keys.append(KeyCode.from_char(char))
+        keys.append(Key.enter if rng.random() < 0.05 else Key.space)
+    return keys[:count]
+
+
+def recorded_stream(path):
+    """
+    Load a recorded key stream from a text file. Each character is a key
+    press; "\\b" is backspace and newlines are enter.
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    keys = []
+    for char in text:
+        if char == '\b':
+            keys.append(Key.backspace)
+        elif char == '\n':
+            keys.append(Key.enter)
+        elif char == ' ':
+            keys.append(Key.space)
+        else:
+            keys.append(KeyCode.from_char(char))
+    return keys
+
+
+def percentiles(samples_ns):
+    """Return latency percentiles in microseconds"""
+    if not samples_ns:
+        return {}
+    ordered = sorted(samples_ns)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] / 1000.0
+
+    return {
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": ordered[-1] / 1000.0,
+        "mean": sum(ordered) / len(ordered) / 1000.0,
+    }
+
+
+def make_listener(prompts, workdir, strategy):
+    prompt_manager = PromptManager(os.path.join(workdir, "prompts.json"))
+    prompt_manager.replace_prompts(prompts)
+    # Write now, while the temporary directory still exists
+    prompt_manager.flush()
+    clipboard = FakeClipboard()
+    listener = KeyboardListener(
+        prompt_manager,
+        controller=FakeController(clipboard),
+        injection_strategy=strategy,
+        usage_tracker=UsageTracker(sink=lambda events: None),
+    )
+    listener.injector.clipboard = clipboard
+    listener.injector.paste_settle = 0
+    return listener
+
+
+def run_case(prompts, keys, workdir, strategy="auto", measure_allocations=True):
+    """Replay the key stream against one library and return its results"""
+    listener = make_listener(prompts, workdir, strategy)
+
+    started = time.perf_counter_ns()
+    listener.refresh_index()
+    build_ns = time.perf_counter_ns() - started
+
+    hook_ns = []
+    key_ns = []
+    clock = time.perf_counter_ns
+    run_started = clock()
+    for key in keys:
+        t0 = clock()
+        listener.on_press(key)
+        t1 = clock()
+        listener.drain()
+        t2 = clock()
+        hook_ns.append(t1 - t0)
+        key_ns.append(t2 - t0)
+    elapsed = (clock() - run_started) / 1e9
+
+    result = {
+        "library_size": len(prompts),
+        "keys": len(keys),
+        "strategy": strategy,
+        "index_build_ms": build_ns / 1e6,
+        "elapsed_s": elapsed,
+        "keys_per_sec": len(keys) / elapsed if elapsed else None,
+        "hook_latency_us": percentiles(hook_ns),
+        "per_key_latency_us": percentiles(key_ns),
+        "injected_events": listener.controller.events,
+    }
+
+    if measure_allocations:
+        # Separate pass: tracemalloc slows everything down, so timings above
+        # are taken without it
+        listener = make_listener(prompts, workdir, strategy)
+        listener.refresh_index()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for key in keys:
+            listener.on_press(key)
+            listener.drain()
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["allocations"] = {
+            "retained_bytes": after - before,
+            "peak_bytes": peak - before,
+            "retained_bytes_per_key": (after - before) / len(keys) if keys else 0,
+        }
+    return result
+
+
+def run_keystroke_benchmark(args, sizes, report):
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            prompts = generate_library(size, args.seed)
+            if args.replay:
+                keys = recorded_stream(args.replay)
+            else:
+                keys = synthetic_stream(prompts, args.keys, args.seed)
+            result = run_case(prompts, keys, workdir, args.strategy,
+                              measure_allocations=not args.no_allocations)
+            report["results"].append(result)
+            print(f"{size:>7} prompts: {result['keys_per_sec']:.0f} keys/s, "
+                  f"p99 {result['per_key_latency_us']['p99']:.1f} us", file=sys.stderr)
+
+
+def measure_load(load):
+    """Run load() under tracemalloc; return its result with load time and retained bytes"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    prompts = load()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return prompts, {"load_ms": elapsed * 1000, "retained_bytes": retained, "peak_bytes": peak}
+
+
+def run_memory_benchmark(args, sizes, report):
+    from text_store import TextStorage
+
+    report["benchmark"] = "prompt_memory"
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            data = json.dumps(generate_library(size, args.seed))
+            path = os.path.join(workdir, f"prompts-{size}.json")
+            with open(path, 'w') as f:
+                f.write(data)
+            # Import once, so the measured load only reads the index
+            with contextlib.redirect_stdout(sys.stderr):
+                TextStorage(path, write_delay=0).load()
+            models = {
+                "dicts": lambda: json.loads(data),
+                "records": lambda: records_from_prompts(json.loads(data)),
+                "text_store": lambda: records_from_prompts(TextStorage(path, write_delay=0).load()),
+            }
+            result = {"library_size": size}
+            for model, load in models.items():
+                prompts, stats = measure_load(load)
+                # Bodies cost the same in the first two models; report the
+                # rest separately as per-prompt overhead. The text store
+                # keeps bodies in the mapped file, outside the heap.
+                if model == "dicts":
+                    text_bytes = sum(sys.getsizeof(item["text"]) for item in prompts.values())
+                elif model == "records":
+                    text_bytes = sum(sys.getsizeof(record.text) for record in prompts.values())
+                else:
+                    text_bytes = 0
+                stats["bytes_per_prompt"] = stats["retained_bytes"] / size if size else 0
+                stats["overhead_bytes_per_prompt"] = (stats["retained_bytes"] - text_bytes) / size if size else 0
+                result[model] = stats
+                del prompts
+            dicts, records, stored = result["dicts"], result["records"], result["text_store"]
+            if dicts["overhead_bytes_per_prompt"]:
+                result["overhead_reduction"] = 1 - records["overhead_bytes_per_prompt"] / dicts["overhead_bytes_per_prompt"]
+            report["results"].append(result)
+            print(f"{size:>7} prompts: {dicts['overhead_bytes_per_prompt']:.0f} -> "
+                  f"{records['overhead_bytes_per_prompt']:.0f} bytes/prompt overhead; "
+                  f"text store {stored['bytes_per_prompt']:.0f} bytes/prompt in "
+                  f"{stored['load_ms']:.0f} ms (dicts {dicts['bytes_per_prompt']:.0f} in "
+                  f"{dicts['load_ms']:.0f} ms)", file=sys.stderr)
+
+
+def run_enhancement_case(url, requests, concurrency, workdir, stream=False, pool_size=None):
+    """Send enhancement requests through GeminiClient at a fixed concurrency"""
+    from enhancement_cache import EnhancementCache
+    from gemini_client import GeminiClient
+    from llm_backends import HTTPBackend
+    from model_cache import ModelCache
+
+    backend = HTTPBackend(url, pool_size=pool_size or concurrency)
+    client = GeminiClient(
+        model_cache=ModelCache(os.path.join(workdir, "model_cache.json")),
+        enhancement_cache=EnhancementCache(path=None),
+        backend=backend,
+    )
+    if client.model is None:
+        raise RuntimeError(f"No model available from {url}")
+
+    def one(index):
+        # Unique inputs and force_refresh so every request reaches the backend
+        text = f"benchmark request {index}: add a retry to the upload step"
+        started = time.perf_counter_ns()
+        first_chunk = None
+        try:
+            if stream:
+                for _ in client.enhance_prompt_stream(text, force_refresh=True):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter_ns() - started
+            elif client.enhance_prompt(text, force_refresh=True).startswith("Error"):
+                return None
+        except Exception:
+            return None
+        return time.perf_counter_ns() - started, first_chunk
+
+    run_started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - run_started
+    backend.close()
+
+    completed = [outcome for outcome in outcomes if outcome is not None]
+    result = {
+        "backend_url": url,
+        "model": client.model_name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "stream": stream,
+        "elapsed_s": elapsed,
+        "requests_per_sec": len(completed) / elapsed if elapsed else None,
+        "errors": requests - len(completed),
+        "latency_us": percentiles([total for total, _ in completed]),
+        "connections_opened": backend.pool.created,
+    }
+    if stream:
+        result["first_chunk_us"] = percentiles([ttft for _, ttft in completed if ttft is not None])
+    return result
+
+
+def run_enhancement_benchmark(args, report):
+    from stub_llm_server import StubLLMServer
+
+    server = None
+    url = args.llm_url
+    if not url:
+        server = StubLLMServer(port=0, latency=args.stub_latency, chunk_delay=args.stub_chunk_delay,
+                               error_rate=args.stub_error_rate, seed=args.seed).start()
+        url = server.url
+    report["benchmark"] = "enhancement"
+    try:
+        # The client logs to stdout; keep stdout for the JSON report
+        with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+            for concurrency in [int(value) for value in args.concurrency.split(',') if value]:
+                result = run_enhancement_case(url, args.requests, concurrency, workdir,
+                                              args.stream, args.pool_size)
+                report["results"].append(result)
+                print(f"{concurrency:>4} concurrent: {result['requests_per_sec']:.1f} req/s, "
+                      f"p99 {result['latency_us'].get('p99', 0) / 1000:.0f} ms, "
+                      f"{result['errors']} errors", file=sys.stderr)
+    finally:
+        if server:
+            server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='Comma-separated prompt library sizes')
+    parser.add_argument('--keys', type=int, default=20000, help='Synthetic keystrokes per case')
+    parser.add_argument('--replay', help='Replay a recorded key stream from this text file')
+    parser.add_argument('--strategy', default='auto', help='Injection strategy (auto, keys, select, paste)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-allocations', action='store_true', help='Skip the tracemalloc pass')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    parser.add_argument('--memory', action='store_true',
+                        help='Measure prompt library memory (dicts vs records) instead of keystrokes')
+    enhance = parser.add_argument_group('enhancement benchmark')
+    enhance.add_argument('--enhance', action='store_true', help='Benchmark enhancement requests instead of keystrokes')
+    enhance.add_argument('--requests', type=int, default=200, help='Enhancement requests per case')
+    enhance.add_argument('--concurrency', default='1,4,16', help='Comma-separated concurrency levels')
+    enhance.add_argument('--stream', action='store_true', help='Use streaming enhancements')
+    enhance.add_argument('--pool-size', type=int, help='HTTP connection pool size (default: the concurrency)')
+    enhance.add_argument('--llm-url', help='Use this server instead of an in-process stub')
+    enhance.add_argument('--stub-latency', type=float, default=0.2, help='Stub seconds before the first chunk')
+    enhance.add_argument('--stub-chunk-delay', type=float, default=0.01, help='Stub seconds between chunks')
+    enhance.add_argument('--stub-error-rate', type=float, default=0.0, help='Stub fraction of failed requests')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    report = {
+        "benchmark": "keyboard_listener",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    if args.enhance:
+        run_enhancement_benchmark(args, report)
+    elif args.memory:
+        run_memory_benchmark(args, sizes, report)
+    else:
+        run_keystroke_benchmark(args, sizes, report)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
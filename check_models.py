@@ -1,11 +1,46 @@
 #!/usr/bin/env python3
-"""Script to check available Gemini models for the configured API key"""
+"""
+Script to check available Gemini models for the configured API key.
+
+Usage:
+    python check_models.py            # list models
+    python check_models.py --probe    # also benchmark latency and recommend the fastest
+"""
 import google.generativeai as genai
 import os
+import sys
 from dotenv import load_dotenv
 
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
+probe = '--probe' in sys.argv
+probe_rounds = 3
+
+
+def probe_models(model_names):
+    """Benchmark the models with a real enhancement request; returns the fastest healthy one"""
+    from gemini_client import ENHANCEMENT_TEMPLATE
+    from model_probe import ModelProber
+
+    def probe_stream(model_name, text):
+        model = genai.GenerativeModel(model_name)
+        for chunk in model.generate_content(ENHANCEMENT_TEMPLATE.format(text=text), stream=True):
+            yield chunk.text
+
+    slo_ms = float(os.getenv("GEMINI_LATENCY_SLO_MS", "3000"))
+    prober = ModelProber(probe_stream, latency_slo=slo_ms / 1000.0)
+    print(f"\nProbing {len(model_names)} model(s), {probe_rounds} round(s) each...")
+    results = prober.probe_all(model_names, rounds=probe_rounds)
+
+    def fmt(seconds):
+        return f"{seconds * 1000:8.0f}" if seconds is not None else "       -"
+
+    print(f"\n{'Model':<32} {'TTFT ms':>8} {'Total ms':>8} {'Errors':>7}")
+    for result in sorted(results, key=lambda r: (r['total_s'] is None, r['total_s'] or 0)):
+        error_rate = result['error_rate'] or 0.0
+        print(f"{result['model_name']:<32} {fmt(result['ttft_s'])} {fmt(result['total_s'])} {error_rate:7.0%}")
+    return prober.best_model(model_names)
+
 
 if not api_key:
     print("Error: GEMINI_API_KEY not found in .env file")
@@ -54,6 +89,17 @@ try:
         if not recommended and supported_models:
             recommended = supported_models[0]['name'].replace('models/', '')
         
+        if probe:
+            from gemini_client import PREFERRED_MODELS, MAX_PROBE_CANDIDATES
+            names = [model['name'].replace('models/', '') for model in supported_models]
+            # Preferred models first, then the rest, so the probe stays short
+            candidates = [name for name in PREFERRED_MODELS if name in names]
+            candidates += [name for name in names if name not in candidates and 'flash' in name.lower()]
+            fastest = probe_models(candidates[:MAX_PROBE_CANDIDATES])
+            if fastest:
+                recommended = fastest
+            print("\nSet GEMINI_PROBE_MODELS=1 to let the app pick the fastest model automatically.")
+
         print("-" * 60)
         print(f"Recommended model: {recommended}")
         print(f"\nTo use this model, update gemini_client.py:")
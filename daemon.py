@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Resident prompt manager daemon.
+One process owns the keyboard hook, the prompt library, the usage store and
+the enhancement engine, and serves them to the GUI, the Flask app and the
+tray over local IPC (see ipc.py), so keys are processed once and the library
+is held in memory once however many front ends are open.
+
+Clients start it on demand (daemon_client.connect_daemon); it can also be run
+directly:
+    python daemon.py
+"""
+import os
+import signal
+import sys
+import threading
+from dotenv import load_dotenv
+from prompt_manager import PromptManager
+from keyboard_listener import KeyboardListener
+from gemini_client import GeminiClient
+from usage_store import UsageStore
+from usage_tracker import UsageTracker
+from metrics import metrics
+from batch_enhancer import BatchEnhancer, items_from_prompts
+from request_scheduler import RequestScheduler
+from daemon_client import API, DaemonClient
+from ipc import IPCServer, default_address
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+
+class PromptDaemon:
+    """The shared services, with a JSON-friendly API used locally or over IPC"""
+
+    def __init__(self):
+        self.prompt_manager = PromptManager(watch=True)
+        self.gemini_client = GeminiClient()
+        # All enhancement traffic shares one set of rate limits, retries and hedging
+        self.enhancer = RequestScheduler.from_env(self.gemini_client)
+        self.usage_store = UsageStore()
+        # PROMPTMANAGER_SPECULATE=1 starts enhancing during typing pauses
+        self.listener = KeyboardListener(
+            self.prompt_manager, self.enhancer,
+            usage_tracker=UsageTracker(sink=self.usage_store.record_many),
+            speculate=os.getenv("PROMPTMANAGER_SPECULATE", "").lower() in ("1", "true", "yes"),
+            speculation_idle=float(os.getenv("PROMPTMANAGER_SPECULATE_IDLE_MS", "800")) / 1000.0,
+            speculation_budget=int(os.getenv("PROMPTMANAGER_SPECULATE_BUDGET", "60")))
+        # Batch enhancement jobs run in the background and resume after a restart
+        self.batch_enhancer = BatchEnhancer(
+            self.enhancer, self.prompt_manager,
+            max_workers=int(os.getenv("PROMPTMANAGER_BATCH_WORKERS", "4")),
+            requests_per_minute=float(os.getenv("PROMPTMANAGER_BATCH_RPM", "15")),
+            # The scheduler already retries transient errors (GEMINI_MAX_RETRIES)
+            max_attempts=1,
+        )
+        self.server = None
+        self.stopped = threading.Event()
+        # Wakes prompts_wait() long polls when the prompts change
+        self.prompts_changed = threading.Condition()
+        self.prompt_manager.subscribe(self._on_prompts_changed)
+
+    def start(self, serve=True):
+        """Start the services, and the IPC server if serve is set"""
+        self.usage_store.start()
+        self.batch_enhancer.start()
+        self.listener.start()
+        if serve:
+            self.server = IPCServer(self.handle).start()
+            print(f"Prompt manager daemon listening on {self.server.address}")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        self.listener.close()
+        self.prompt_manager.flush()
+        self.batch_enhancer.stop()
+        self.usage_store.stop()
+        self.stopped.set()
+
+    def handle(self, method, params):
+        if method not in API:
+            raise ValueError(f"Unknown method: {method}")
+        return getattr(self, method)(**params)
+
+    # Daemon
+
+    def ping(self):
+        return {'pid': os.getpid()}
+
+    def shutdown(self):
+        # Reply first; the IPC server can't be stopped from one of its own threads
+        threading.Thread(target=self.stop, daemon=True).start()
+        return True
+
+    # Prompts
+
+    def prompts_snapshot(self, since_version=None):
+        """The prompts and their version; prompts is None if still at since_version"""
+        snapshot = self.prompt_manager.get_snapshot()
+        if snapshot.version == since_version:
+            return {'version': snapshot.version, 'prompts': None}
+        return {'version': snapshot.version, 'prompts': snapshot.to_dict()}
+
+    def prompts_version(self):
+        return self.prompt_manager.version
+
+    def _on_prompts_changed(self, version, changed, removed):
+        with self.prompts_changed:
+            self.prompts_changed.notify_all()
+
+    def prompts_wait(self, since_version=None, timeout=25.0):
+        """
+        Long poll for a prompt change: return the version once it differs
+        from since_version, or the current version after timeout seconds
+        (which also covers full reloads, which aren't notified).
+        """
+        with self.prompts_changed:
+            self.prompts_changed.wait_for(lambda: self.prompt_manager.version != since_version,
+                                          min(timeout, 50.0))
+        return self.prompt_manager.version
+
+    def prompt_get(self, shortcut):
+        return self.prompt_manager.get_prompt(shortcut)
+
+    def prompt_add(self, shortcut, text):
+        self.prompt_manager.add_prompt(shortcut, text)
+        return True
+
+    def prompt_delete(self, shortcut):
+        return self.prompt_manager.delete_prompt(shortcut)
+
+    def prompts_replace(self, prompts):
+        self.prompt_manager.replace_prompts(prompts)
+        return True
+
+    def prompts_search(self, query, limit=20):
+        return [[shortcut, data] for shortcut, data in self.prompt_manager.search(query, limit)]
+
+    def prompts_flush(self):
+        self.prompt_manager.flush()
+        return True
+
+    # Usage
+
+    def usage_record(self, events):
+        self.usage_store.record_many(events)
+        return len(events)
+
+    def usage_top(self, limit=10):
+        return self.usage_store.top(limit)
+
+    def usage_recent(self, limit=10):
+        return self.usage_store.recent(limit)
+
+    def usage_get(self, shortcut):
+        return self.usage_store.get(shortcut)
+
+    # Listener and enhancement
+
+    def listener_status(self):
+        listener = self.listener
+        running = False
+        if listener.running and listener.listener is not None:
+            # pynput listener has a running property
+            running = bool(getattr(listener.listener, 'running', False))
+        return {'running': running}
+
+    def listener_start(self):
+        # Starting is a no-op while the hook is installed, so clients can't
+        # add a second hook and key worker
+        if not self.listener.running:
+            self.listener.start()
+        return self.listener_status()
+
+    def listener_stop(self):
+        self.listener.stop()
+        return self.listener_status()
+
+    def configure_api_key(self, api_key):
+        os.environ["GEMINI_API_KEY"] = api_key
+        # Model discovery for a new key runs in the background
+        self.gemini_client.configure(api_key, background=True)
+        return True
+
+    def metrics_snapshot(self, format=None):
+        """Metrics as a dict, or Prometheus text for format="prometheus" """
+        if format == 'prometheus':
+            return metrics.to_prometheus()
+        return metrics.to_dict()
+
+    # Batch enhancement
+
+    def batch_create(self, items=None, shortcuts=None, tag=None, select_all=False,
+                     force_refresh=False, apply=False):
+        """
+        Start a batch job over ad-hoc items, or over stored prompts selected
+        by shortcuts, tag or select_all. Results are only written back
+        (apply) for stored prompts.
+        """
+        if items is None:
+            if shortcuts is None and tag is None and not select_all:
+                raise ValueError("Select prompts with shortcuts, tag, all or items")
+            items = items_from_prompts(self.prompt_manager.get_prompts(), shortcuts, tag)
+        else:
+            apply = False
+        return self.batch_enhancer.create_job(items, force_refresh=force_refresh, apply=apply).summary()
+
+    def batch_list(self):
+        return [job.summary() for job in self.batch_enhancer.list_jobs()]
+
+    def batch_get(self, job_id):
+        job = self.batch_enhancer.get_job(job_id)
+        if job is None:
+            return None
+        with job.condition:
+            return job.to_dict()
+
+    def batch_item(self, job_id, index):
+        job = self.batch_enhancer.get_job(job_id)
+        if job is None or not 0 <= index < len(job.items):
+            return None
+        with job.condition:
+            return job.item_event(index)
+
+    def batch_events(self, job_id, start=0, timeout=15.0):
+        """
+        Long poll for finished items: waits up to timeout for items after
+        start. The last event has type "job" once the job stopped running.
+
+        Returns:
+            {"events": [...], "position": start for the next call}, or None
+            if the job doesn't exist.
+        """
+        job = self.batch_enhancer.get_job(job_id)
+        if job is None:
+            return None
+        events = list(self.batch_enhancer.stream(job, start, timeout=timeout))
+        position = start + sum(1 for event in events if event['type'] == 'item')
+        return {'events': events, 'position': position}
+
+    def batch_stream(self, job_id, start=0):
+        """Same as DaemonClient.batch_stream, for in-process use"""
+        job = self.batch_enhancer.get_job(job_id)
+        return self.batch_enhancer.stream(job, start) if job is not None else iter(())
+
+    def batch_cancel(self, job_id):
+        job = self.batch_enhancer.cancel(job_id)
+        return job.summary() if job is not None else None
+
+    def batch_resume(self, job_id):
+        job = self.batch_enhancer.resume(job_id)
+        return job.summary() if job is not None else None
+
+
+def _single_instance_lock():
+    """Hold an exclusive lock for the daemon's lifetime; None if another daemon has it"""
+    address = default_address()
+    if isinstance(address, str):
+        path = address + ".lock"
+    else:
+        path = os.path.join(os.path.expanduser("~"), ".promptmanager-daemon.lock")
+    lock_file = open(path, 'a')
+    if HAS_FCNTL:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+    return lock_file
+
+
+def main():
+    load_dotenv()
+    try:
+        DaemonClient(timeout=5.0).ping()
+        print("The prompt manager daemon is already running")
+        return 0
+    except OSError:
+        pass
+    lock_file = _single_instance_lock()
+    if lock_file is None:
+        print("The prompt manager daemon is already starting")
+        return 0
+
+    daemon = PromptDaemon()
+    daemon.start()
+    if threading.current_thread() is threading.main_thread():
+        # SIGTERM (e.g. from the service manager) shuts down cleanly
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stopped.set())
+    try:
+        while not daemon.stopped.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if daemon.server is not None or not daemon.stopped.is_set():
+            daemon.stop()
+        lock_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
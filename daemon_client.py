@@ -0,0 +1,176 @@
+"""
+Thin clients for the prompt manager daemon (daemon.py).
+The GUI, the Flask app and the tray talk to the single daemon process that
+owns the keyboard hook, the prompt library and the enhancement engine,
+starting it on first use. Set PROMPTMANAGER_DAEMON=0 to run everything
+in-process instead.
+
+This module only depends on the standard library (plus ipc and
+prompt_records, which do too), so clients don't load the listener, storage
+or LLM stacks.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from ipc import IPCClient
+from prompt_records import PromptSnapshot
+
+# Methods of PromptDaemon callable over IPC
+API = (
+    'ping', 'shutdown',
+    'prompts_snapshot', 'prompts_version', 'prompts_wait', 'prompt_get', 'prompt_add', 'prompt_delete',
+    'prompts_replace', 'prompts_search', 'prompts_flush',
+    'usage_record', 'usage_top', 'usage_recent', 'usage_get',
+    'listener_status', 'listener_start', 'listener_stop',
+    'configure_api_key', 'metrics_snapshot',
+    'batch_create', 'batch_list', 'batch_get', 'batch_item', 'batch_events',
+    'batch_cancel', 'batch_resume',
+)
+
+
+def use_daemon():
+    return os.getenv("PROMPTMANAGER_DAEMON", "1") != "0"
+
+
+class DaemonClient:
+    """Calls PromptDaemon methods over IPC: client.prompts_search(query="x")"""
+
+    def __init__(self, address=None, timeout=60.0):
+        self.ipc = IPCClient(address, timeout)
+
+    def __getattr__(self, name):
+        if name not in API:
+            raise AttributeError(name)
+
+        def call(**params):
+            return self.ipc.call(name, **params)
+        call.__name__ = name
+        return call
+
+    def batch_stream(self, job_id, start=0):
+        """Yield a batch job's finished items and final summary as they arrive"""
+        position = start
+        while True:
+            result = self.batch_events(job_id=job_id, start=position, timeout=15.0)
+            for event in result['events']:
+                yield event
+                if event['type'] == 'job':
+                    return
+            position = result['position']
+
+    def close(self):
+        self.ipc.close()
+
+
+def start_daemon(log_path="daemon.log"):
+    """Start daemon.py as a detached process in the current directory"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "daemon.py")
+    log = open(log_path, 'a')
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW | subprocess.DETACHED_PROCESS
+    else:
+        kwargs['start_new_session'] = True
+    try:
+        subprocess.Popen([sys.executable, script], stdout=log, stderr=subprocess.STDOUT,
+                         stdin=subprocess.DEVNULL, **kwargs)
+    finally:
+        log.close()
+
+
+def connect_daemon(start=True, timeout=20.0):
+    """
+    Connect to the running daemon.
+
+    Args:
+        start: Start the daemon if none is running.
+        timeout: Seconds to wait for a newly started daemon.
+
+    Returns:
+        A DaemonClient, or None if no daemon runs and start is False.
+
+    Raises:
+        RuntimeError: A started daemon did not come up in time.
+    """
+    client = DaemonClient()
+    try:
+        client.ping()
+        return client
+    except OSError:
+        if not start:
+            return None
+    print("Starting the prompt manager daemon")
+    start_daemon()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.2)
+        try:
+            client.ping()
+            return client
+        except OSError:
+            continue
+    raise RuntimeError("The prompt manager daemon did not start; see daemon.log")
+
+
+class RemotePromptManager:
+    """
+    The parts of PromptManager's interface the clients use, backed by the
+    daemon. The prompt version is cached and kept current by a background
+    long poll, so version checks (e.g. the GUI's once a second) stay local.
+    """
+
+    def __init__(self, client, wait_timeout=25.0):
+        self.client = client
+        self.wait_timeout = wait_timeout
+        self._snapshot = PromptSnapshot(None, {})
+        self._version = client.prompts_version()
+        self.watcher = threading.Thread(target=self._watch_version)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def _watch_version(self):
+        while True:
+            try:
+                self._version = self.client.prompts_wait(since_version=self._version,
+                                                         timeout=self.wait_timeout)
+            except (OSError, RuntimeError):
+                # Daemon restarting; the cached version is kept until it's back
+                time.sleep(1.0)
+
+    @property
+    def version(self):
+        return self._version
+
+    def get_snapshot(self):
+        """Return the daemon's current snapshot, fetching prompts only when they changed"""
+        result = self.client.prompts_snapshot(since_version=self._snapshot.version)
+        self._version = result['version']
+        if result['prompts'] is not None:
+            self._snapshot = PromptSnapshot.from_prompts(result['version'], result['prompts'])
+        return self._snapshot
+
+    def has_changed(self, since_version):
+        return self._version != since_version
+
+    def get_prompts(self):
+        return self.get_snapshot().prompts
+
+    def get_prompt(self, shortcut):
+        return self.client.prompt_get(shortcut=shortcut)
+
+    def add_prompt(self, shortcut, text):
+        self.client.prompt_add(shortcut=shortcut, text=text)
+
+    def delete_prompt(self, shortcut):
+        return self.client.prompt_delete(shortcut=shortcut)
+
+    def replace_prompts(self, prompts):
+        self.client.prompts_replace(prompts=prompts)
+
+    def search(self, query, limit=20):
+        return [tuple(result) for result in self.client.prompts_search(query=query, limit=limit)]
+
+    def flush(self):
+        self.client.prompts_flush()
@@ -0,0 +1,168 @@
+"""
+Two-tier cache for prompt enhancement results.
+A bounded in-memory LRU sits in front of a persistent SQLite store with
+size-based eviction and an optional time-to-live, so repeated enhancements
+of the same phrase skip the API entirely.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from metrics import metrics
+
+MEMORY_HITS = metrics.counter('promptmanager_enhancement_cache_memory_hits_total',
+                              'Enhancements served from the in-memory cache')
+DISK_HITS = metrics.counter('promptmanager_enhancement_cache_disk_hits_total',
+                            'Enhancements served from the on-disk cache')
+MISSES = metrics.counter('promptmanager_enhancement_cache_misses_total',
+                         'Enhancements not found in either cache tier')
+
+
+def normalize_text(text):
+    """Normalize input so trivially different phrasings share a cache entry"""
+    return ' '.join(text.split()).casefold()
+
+
+def cache_key(text, model_name, template_version):
+    raw = f"{template_version}\0{model_name}\0{normalize_text(text)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class EnhancementCache:
+    """In-memory LRU in front of an on-disk SQLite store"""
+
+    def __init__(self, path="enhancement_cache.db", max_memory_entries=256,
+                 max_disk_bytes=16 * 1024 * 1024, ttl=None):
+        """
+        Initialize the cache.
+
+        Args:
+            path: SQLite database file for the persistent tier, or None to
+                  keep only the in-memory tier.
+            max_memory_entries: Capacity of the in-memory LRU.
+            max_disk_bytes: Total size of cached results kept on disk; the
+                            least recently used entries are evicted beyond it.
+            ttl: Optional lifetime of an entry in seconds.
+        """
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key -> (value, created)
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        self.disk_bytes = 0
+        if path:
+            try:
+                self._open(path)
+            except sqlite3.Error as e:
+                print(f"Enhancement cache disabled on disk: {e}")
+                self.db = None
+
+    def _open(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS enhancements ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS enhancements_accessed ON enhancements (accessed)")
+        self.db.commit()
+        row = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM enhancements").fetchone()
+        self.disk_bytes = row[0]
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, text, model_name, template_version):
+        """Return the cached enhancement, or None on a miss"""
+        key = cache_key(text, model_name, template_version)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    MEMORY_HITS.inc()
+                    return entry[0]
+                del self.memory[key]
+
+            if self.db is not None:
+                try:
+                    row = self.db.execute(
+                        "SELECT value, created FROM enhancements WHERE key = ?", (key,)).fetchone()
+                    if row is not None and not self._expired(row[1], now):
+                        self.db.execute("UPDATE enhancements SET accessed = ? WHERE key = ?", (now, key))
+                        self.db.commit()
+                        self._remember(key, row[0], row[1])
+                        self.disk_hits += 1
+                        DISK_HITS.inc()
+                        return row[0]
+                except sqlite3.Error as e:
+                    print(f"Error reading enhancement cache: {e}")
+
+            self.misses += 1
+            MISSES.inc()
+            return None
+
+    def put(self, text, model_name, template_version, value):
+        """Store an enhancement result in both tiers"""
+        key = cache_key(text, model_name, template_version)
+        now = time.time()
+        with self.lock:
+            self._remember(key, value, now)
+            if self.db is None:
+                return
+            size = len(value.encode('utf-8'))
+            try:
+                row = self.db.execute("SELECT size FROM enhancements WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_bytes -= row[0]
+                self.db.execute(
+                    "INSERT OR REPLACE INTO enhancements (key, value, size, created, accessed)"
+                    " VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+                self.disk_bytes += size
+                self._evict_disk()
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Error writing enhancement cache: {e}")
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+        rows = self.db.execute("SELECT key, size FROM enhancements ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            self.db.execute("DELETE FROM enhancements WHERE key = ?", (key,))
+            self.disk_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM enhancements")
+                self.db.commit()
+                self.disk_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': ((self.memory_hits + self.disk_hits) / lookups) if lookups else None,
+                'memory_entries': len(self.memory),
+                'disk_bytes': self.disk_bytes,
+            }
@@ -0,0 +1,352 @@
+"""
+Enhancement executor for the keyboard listener.
+Runs enhancement requests on a bounded thread pool, coalesces identical
+in-flight requests (streamed ones included), supersedes a pending request
+when a new one starts in the same context, enforces per-request deadlines
+and serializes output injection so results never interleave keystrokes.
+
+A deadline or cancellation stops delivery and drops the request's interest
+in the shared work. Work nobody waits for any more is cancelled if it hasn't
+started, and a stream is closed at its next chunk; a backend call that is
+already running can't be interrupted, so it finishes in the background
+(bounded by the backend's own timeout) and its result is still cached.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enhancement_cache import normalize_text
+from metrics import metrics
+
+COALESCED = metrics.counter('promptmanager_enhancement_coalesced_total',
+                            'Enhancement requests that joined an identical in-flight request')
+SUPERSEDED = metrics.counter('promptmanager_enhancement_superseded_total',
+                             'Enhancement requests cancelled by a newer request in the same context')
+TIMED_OUT = metrics.counter('promptmanager_enhancement_timeouts_total',
+                            'Enhancement requests that missed their deadline')
+
+
+class EnhancementRequest:
+    """Handle for a submitted enhancement"""
+
+    def __init__(self, text, context, force_refresh, stream, timeout, callbacks):
+        self.text = text
+        self.context = context
+        self.force_refresh = force_refresh
+        self.stream = stream
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.callbacks = callbacks
+        self.finished = False
+        self.outcome = None  # "result", "error", "cancelled" or "timeout"
+        self.lock = threading.Lock()
+        self.timer = None
+        self.key = None  # Coalescing key while joined to a shared future
+        self.shared_stream = None  # The SharedStream delivering its chunks
+
+    @property
+    def active(self):
+        return not self.finished
+
+    def _finish(self, outcome):
+        """Mark the request finished; returns False if it already was"""
+        with self.lock:
+            if self.finished:
+                return False
+            self.finished = True
+            self.outcome = outcome
+        if self.timer:
+            self.timer.cancel()
+        return True
+
+
+class SharedStream:
+    """One streamed generation, fanned out to every request that joined it"""
+
+    def __init__(self):
+        self.chunks = []     # Everything streamed so far, replayed to late joiners
+        self.requests = []   # Requests receiving chunks
+        self.waiters = 1     # Requests still interested
+        self.done = False
+        self.error = None
+
+
+class EnhancementEngine:
+    """Bounded, coalescing, cancellable executor for prompt enhancements"""
+
+    def __init__(self, gemini_client, output_lock=None, max_workers=2, timeout=30.0):
+        """
+        Initialize the engine.
+
+        Args:
+            gemini_client: Client providing generate_enhancement() and
+                           enhance_prompt_stream(), both raising on failure
+                           (a GeminiClient or a RequestScheduler).
+            output_lock: Lock held while delivering output, shared with
+                         everything else that injects keystrokes (usually
+                         InputInjector.lock).
+            max_workers: Maximum number of concurrent API calls.
+            timeout: Default per-request deadline in seconds.
+        """
+        self.gemini_client = gemini_client
+        self.output_lock = output_lock or threading.RLock()
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='enhance')
+        # Background work (speculation) gets its own single worker so it
+        # never occupies the workers serving the user
+        self.background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='enhance-bg')
+        # Reentrant: future callbacks may run synchronously while it is held
+        self.lock = threading.RLock()
+        # (normalized text, force_refresh) -> [future, waiter count]
+        self.inflight = {}
+        # (normalized text, force_refresh) -> SharedStream
+        self.streams = {}
+        self.active = {}    # context -> EnhancementRequest
+
+    def submit(self, text, context="default", force_refresh=False, stream=False, timeout=None,
+               on_start=None, on_chunk=None, on_result=None, on_error=None, on_done=None):
+        """
+        Submit an enhancement.
+
+        Args:
+            text: The text to enhance.
+            context: Requests in the same context supersede each other; the
+                     previous one is cancelled when a new one is submitted.
+            force_refresh: Bypass the enhancement cache.
+            stream: Deliver output through on_chunk as it is generated.
+            timeout: Deadline in seconds (defaults to the engine timeout).
+                     Only delivery stops at the deadline; see the module
+                     docstring.
+            on_start: Called once the previous request in the context has
+                      been cancelled, before any work is scheduled.
+            on_chunk: Called with each streamed chunk (stream mode).
+            on_result: Called with the complete result (non-stream mode).
+            on_error: Called with the exception on failure or timeout.
+            on_done: Called once when the request finishes for any reason,
+                     before its final output and outside the output lock.
+
+        on_chunk, on_result and on_error run with the output lock held.
+
+        Returns:
+            The EnhancementRequest handle.
+        """
+        callbacks = {'chunk': on_chunk, 'result': on_result, 'error': on_error, 'done': on_done}
+        request = EnhancementRequest(text, context, force_refresh, stream,
+                                     timeout or self.timeout, callbacks)
+        with self.lock:
+            previous = self.active.get(context)
+            self.active[context] = request
+        if previous is not None and previous.active:
+            SUPERSEDED.inc()
+            self.cancel(previous)
+        if on_start:
+            on_start()
+
+        request.timer = threading.Timer(request.timeout, self._expire, (request,))
+        request.timer.daemon = True
+        request.timer.start()
+
+        key = self._key(text, force_refresh)
+        future = shared_stream = None
+        start_stream = False
+        with self.lock:
+            shared = self.inflight.get(key)
+            if shared is not None:
+                # Join the identical request that is already running
+                shared[1] += 1
+                future = shared[0]
+                COALESCED.inc()
+            elif stream:
+                shared_stream = self.streams.get(key)
+                if shared_stream is None:
+                    shared_stream = self.streams[key] = SharedStream()
+                    start_stream = True
+                else:
+                    shared_stream.waiters += 1
+                    COALESCED.inc()
+                request.shared_stream = shared_stream
+            else:
+                future = self._start_generation(key, text, force_refresh)
+            if future is not None:
+                request.key = key
+
+        if future is not None:
+            future.add_done_callback(lambda f: self._deliver_future(request, f))
+            return request
+        self._join_stream(request, shared_stream)
+        if start_stream:
+            self.executor.submit(self._run_stream, key, text, force_refresh, shared_stream)
+        return request
+
+    def enhance(self, text, force_refresh=False, background=False):
+        """
+        Start (or join) an enhancement without delivering output.
+
+        Args:
+            text: The text to enhance.
+            force_refresh: Bypass the enhancement cache.
+            background: Run on the low-priority background worker.
+
+        Returns:
+            A Future resolving to the enhanced text. Call release(text) to
+            drop interest in it.
+        """
+        key = self._key(text, force_refresh)
+        with self.lock:
+            shared = self.inflight.get(key)
+            if shared is not None:
+                shared[1] += 1
+                return shared[0]
+            executor = self.background_executor if background else self.executor
+            return self._start_generation(key, text, force_refresh, executor)
+
+    def release(self, text, force_refresh=False):
+        """Drop one enhance() caller's interest; cancels the work if nobody else waits and it hasn't started"""
+        self._release_key(self._key(text, force_refresh))
+
+    @staticmethod
+    def _key(text, force_refresh):
+        # A forced refresh must not be answered by (or answer) a cached run
+        return normalize_text(text), bool(force_refresh)
+
+    def _start_generation(self, key, text, force_refresh, executor=None):
+        # Must be called with self.lock held
+        executor = executor or self.executor
+        future = executor.submit(self.gemini_client.generate_enhancement, text, force_refresh)
+        self.inflight[key] = [future, 1]
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key, future):
+        with self.lock:
+            shared = self.inflight.get(key)
+            if shared is not None and shared[0] is future:
+                del self.inflight[key]
+
+    def _release(self, request):
+        """Drop the request's interest in a shared future; cancel it if unused and not started"""
+        if request.key is not None:
+            self._release_key(request.key)
+        elif request.shared_stream is not None:
+            with self.lock:
+                # The stream is closed at its next chunk once nobody waits
+                request.shared_stream.waiters -= 1
+
+    def _release_key(self, key):
+        with self.lock:
+            shared = self.inflight.get(key)
+            if shared is None:
+                return
+            shared[1] -= 1
+            if shared[1] <= 0 and shared[0].cancel():
+                # cancel() already ran _forget() through the done callback
+                self.inflight.pop(key, None)
+
+    def cancel(self, request):
+        """Cancel a request; nothing more is delivered for it"""
+        if request._finish("cancelled"):
+            self._release(request)
+            self._call(request, 'done')
+
+    def _expire(self, request):
+        if request._finish("timeout"):
+            TIMED_OUT.inc()
+            self._release(request)
+            self._call(request, 'done')
+            error = TimeoutError(f"Enhancement timed out after {request.timeout:g}s")
+            with self.output_lock:
+                self._call(request, 'error', error)
+
+    def _deliver_future(self, request, future):
+        if future.cancelled():
+            return
+        if not request._finish("result"):
+            return
+        self._call(request, 'done')
+        error = future.exception()
+        with self.output_lock:
+            if error is not None:
+                self._call(request, 'error', error)
+            elif request.stream:
+                self._call(request, 'chunk', future.result())
+            else:
+                self._call(request, 'result', future.result())
+
+    def _join_stream(self, request, shared):
+        """Replay what a shared stream produced so far, then follow it"""
+        with self.output_lock:
+            for chunk in shared.chunks:
+                if not request.active:
+                    return
+                self._call(request, 'chunk', chunk)
+            if not shared.done:
+                shared.requests.append(request)
+                return
+        # It finished before this request joined
+        self._finish_stream(request, shared.error)
+
+    def _run_stream(self, key, text, force_refresh, shared):
+        error = None
+        try:
+            stream = self.gemini_client.enhance_prompt_stream(text, force_refresh)
+            try:
+                for chunk in stream:
+                    with self.output_lock:
+                        shared.chunks.append(chunk)
+                        for request in shared.requests:
+                            if request.active:
+                                self._call(request, 'chunk', chunk)
+                    with self.lock:
+                        if shared.waiters <= 0:
+                            # Everyone cancelled or timed out: stop generating
+                            self.streams.pop(key, None)
+                            break
+            finally:
+                stream.close()
+        except Exception as e:
+            error = e
+        with self.lock:
+            if self.streams.get(key) is shared:
+                del self.streams[key]
+        with self.output_lock:
+            shared.done = True
+            shared.error = error
+            requests, shared.requests = shared.requests, []
+        for request in requests:
+            self._finish_stream(request, error)
+
+    def _finish_stream(self, request, error):
+        if error is None:
+            if request._finish("result"):
+                self._call(request, 'done')
+        elif request._finish("error"):
+            self._call(request, 'done')
+            with self.output_lock:
+                self._call(request, 'error', error)
+
+    def _call(self, request, name, *args):
+        callback = request.callbacks.get(name)
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"Error in enhancement {name} callback: {e}")
+
+    def cancel_context(self, context):
+        """Cancel the active request in a context, if any"""
+        with self.lock:
+            request = self.active.get(context)
+        if request is not None and request.active:
+            SUPERSEDED.inc()
+            self.cancel(request)
+
+    def cancel_all(self):
+        with self.lock:
+            requests = list(self.active.values())
+        for request in requests:
+            self.cancel(request)
+
+    def shutdown(self):
+        self.cancel_all()
+        self.executor.shutdown(wait=False)
+        self.background_executor.shutdown(wait=False, cancel_futures=True)
@@ -1,55 +1,227 @@
-import google.generativeai as genai
 import os
+import time
+import threading
 from dotenv import load_dotenv
+from metrics import metrics
+from model_cache import ModelCache
+from enhancement_cache import EnhancementCache
+from model_probe import ModelProber
+from llm_backends import create_backend
+
+ENHANCEMENT_SECONDS = metrics.histogram('promptmanager_enhancement_seconds',
+                                        'Round-trip time of a Gemini enhancement request')
+ENHANCEMENT_FIRST_CHUNK_SECONDS = metrics.histogram('promptmanager_enhancement_first_chunk_seconds',
+                                                    'Time until the first streamed enhancement chunk arrives')
+ENHANCEMENT_ERRORS = metrics.counter('promptmanager_enhancement_errors_total',
+                                     'Gemini enhancement requests that failed')
+
+# Bump whenever ENHANCEMENT_TEMPLATE changes so cached results are not reused
+ENHANCEMENT_TEMPLATE_VERSION = 1
+
+# List of preferred models in order of preference. When model probing is
+# enabled the order only breaks ties; measured latency decides.
+PREFERRED_MODELS = [
+    'gemini-2.5-flash',      # Latest stable flash (recommended)
+    'gemini-2.0-flash',      # Stable flash v2.0
+    'gemini-2.0-flash-001',  # Stable flash v2.0 (versioned)
+    'gemini-flash-latest',   # Latest flash (alias)
+    'gemini-2.5-pro',        # Latest stable pro
+    'gemini-pro-latest',     # Latest pro (alias)
+    'gemini-2.0-flash-lite', # Lite version (fastest/cheapest)
+]
+
+# Maximum number of models benchmarked per probe round
+MAX_PROBE_CANDIDATES = 4
+
+# Used when the model list cannot be fetched (or hasn't been yet)
+DEFAULT_MODEL = 'gemini-2.5-flash'
+
+ENHANCEMENT_TEMPLATE = """
+            You are an expert AI prompt engineer. Your task is to rewrite the following user input into a clear, detailed, and effective prompt for an AI agent (like Cursor AI) that can execute actions and modify code.
+            
+            User Input: "{text}"
+            
+            Important Guidelines:
+            1. Transform the input into an INSTRUCTION for the AI agent to EXECUTE an action, not to generate or explain text.
+            2. Focus on what the agent should DO, not what it should generate or describe.
+            3. If the input asks for a command or code, instruct the agent to execute it, not to generate it.
+            4. Add necessary context about what files to work with, what to check, or what conditions to consider.
+            5. Make the instruction actionable and specific for an AI coding assistant.
+            6. Keep the original intent but make it execution-oriented.
+            7. Use imperative mood (e.g., "Create", "Implement", "Modify", "Add") rather than descriptive language.
+            8. Do NOT ask the agent to generate commands, code, or explanations - ask it to perform actions.
+            
+            Examples:
+            - Input: "make a git commit" → Output: "Stage all currently modified and new files, then create a git commit with an appropriate commit message based on the changes. Analyze the staged changes to determine a meaningful commit message."
+            - Input: "add a button" → Output: "Add a button component to the current file. Determine the appropriate location and styling based on the existing UI patterns."
+            - Input: "fix the bug" → Output: "Identify and fix the bug in the current codebase. First analyze the code to locate the issue, then implement the fix."
+            
+            Return ONLY the enhanced prompt text as a single paragraph, no explanations, no quotes, no markdown formatting.
+            """
 
 class GeminiClient:
-    def __init__(self):
+    def __init__(self, model_cache=None, enhancement_cache=None, prober=None, backend=None):
         # Always load from .env file (override=True to get latest value)
         load_dotenv(override=True)
         self.api_key = os.getenv("GEMINI_API_KEY")
+        # Gemini by default; PROMPTMANAGER_LLM_BACKEND=http for a local server
+        self.backend = backend or create_backend()
+        self.identity = None  # Model cache key for the backend and API key
         self.model = None
         self.model_name = None
-        if self.api_key:
+        self.available_models = []
+        # Models the API rejected at generation time; skipped on rediscovery
+        self.failed_models = set()
+        # Model discovery results are cached on disk per API key
+        self.model_cache = model_cache or ModelCache()
+        # Enhancement results, keyed by normalized input, model and template
+        self.cache = enhancement_cache or EnhancementCache()
+        self.revalidating = False
+        self.revalidate_lock = threading.Lock()
+        # Optional latency-aware model selection (GEMINI_PROBE_MODELS=1).
+        # Probing sends real requests, so it is opt-in.
+        self.prober = prober
+        if self.prober is None and os.getenv("GEMINI_PROBE_MODELS", "").lower() in ("1", "true", "yes"):
+            slo_ms = float(os.getenv("GEMINI_LATENCY_SLO_MS", "3000"))
+            self.prober = ModelProber(self._probe_stream, latency_slo=slo_ms / 1000.0)
+        self.probe_interval = float(os.getenv("GEMINI_PROBE_INTERVAL", "1800"))
+        if self.api_key or not self.backend.requires_api_key:
             self.configure(self.api_key)
 
-    def configure(self, api_key):
+    def configure(self, api_key, background=False):
+        """
+        Configure the client for an API key and pick a model.
+
+        Args:
+            api_key: The Gemini API key (optional for backends that
+                     don't need one).
+            background: When there is no cached model for this key, start
+                        with the default model right away and run discovery
+                        on a background thread instead of blocking.
+        """
         self.api_key = api_key
-        genai.configure(api_key=self.api_key)
+        self.backend.configure(self.api_key)
+        self.identity = self.backend.identity(api_key)
         
+        # Use the cached model for this key when there is one; the model
+        # listing only runs when the cache is missing or stale
+        entry = self.model_cache.get(self.identity)
+        if entry and entry.get('model_name'):
+            self.available_models = entry.get('available_models', [])
+            if self.prober:
+                self.prober.load(entry.get('probes'))
+            self._use_model(entry['model_name'])
+            if self.model_cache.is_stale(entry):
+                self._revalidate_in_background()
+        elif background:
+            self._use_model(DEFAULT_MODEL)
+            self._revalidate_in_background()
+        else:
+            self._resolve_model()
+        if self.prober:
+            self.prober.start(self.probe_candidates, self.probe_interval, self._apply_probe_results)
+
+    def _resolve_model(self):
         # Automatically detect and use an available model
-        self.model_name = self._find_available_model()
+        identity = self.identity
+        model_name = self._find_available_model()
+        if identity != self.identity:
+            # Reconfigured with another key while listing - discard
+            return
+        if self.prober:
+            # Measured latency beats the static preference order
+            model_name = self.prober.best_model(self.probe_candidates()) or model_name
+        if model_name != self.model_name or self.model is None:
+            self._use_model(model_name)
+        # Only cache results backed by a successful listing
+        if model_name and self.available_models:
+            self._cache_model(identity, model_name)
+
+    def _cache_model(self, identity, model_name):
+        if self.prober:
+            self.model_cache.put(identity, model_name, self.available_models,
+                                 probes=self.prober.snapshot())
+        else:
+            self.model_cache.put(identity, model_name, self.available_models)
+
+    def probe_candidates(self):
+        """Models worth benchmarking: preferred models that are available and healthy"""
+        available = [m for m in self.available_models if m not in self.failed_models]
+        candidates = [m for m in PREFERRED_MODELS if m in available]
+        if not candidates and self.model_name:
+            candidates = [self.model_name]
+        return candidates[:MAX_PROBE_CANDIDATES]
+
+    def _probe_stream(self, model_name, text):
+        """Stream a representative enhancement from a specific model (used by the prober)"""
+        model = self.backend.load_model(model_name)
+        yield from model.stream(ENHANCEMENT_TEMPLATE.format(text=text))
+
+    def _apply_probe_results(self, best_model):
+        """Switch to the fastest healthy model found by the prober"""
+        if not best_model or best_model == self.model_name or not self.identity:
+            return
+        print(f"Switching to faster model {best_model} (was {self.model_name})")
+        self._use_model(best_model)
+        if self.available_models:
+            self._cache_model(self.identity, best_model)
+
+    def _use_model(self, model_name):
+        self.model_name = model_name
         if self.model_name:
             try:
-                self.model = genai.GenerativeModel(self.model_name)
-                print(f"Using Gemini model: {self.model_name}")
+                self.model = self.backend.load_model(self.model_name)
+                print(f"Using {self.backend.name} model: {self.model_name}")
             except Exception as e:
                 print(f"Error initializing model {self.model_name}: {str(e)}")
                 self.model = None
         else:
             print("Warning: No suitable Gemini model found. Please check your API key.")
             self.model = None
+
+    def _revalidate_in_background(self):
+        """Re-run model discovery on a background thread (at most one at a time)"""
+        with self.revalidate_lock:
+            if self.revalidating:
+                return
+            self.revalidating = True
+
+        def revalidate():
+            try:
+                self._resolve_model()
+            except Exception as e:
+                print(f"Error revalidating Gemini model: {str(e)}")
+            finally:
+                self.revalidating = False
+
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+    def _handle_model_error(self, error, model_name=None):
+        """Drop a cached model the API no longer accepts and rediscover"""
+        message = str(error).lower()
+        if getattr(error, 'code', None) == 404 or 'not found' in message or 'not supported' in message:
+            model_name = model_name or self.model_name
+            if model_name:
+                self.failed_models.add(model_name)
+            if model_name != self.model_name:
+                # A fallback model failed; the current one is still fine
+                return
+            self.model_cache.invalidate(self.identity)
+            self._revalidate_in_background()
     
     def _find_available_model(self):
         """Find the best available model that supports generateContent"""
         try:
-            # List of preferred models in order of preference (fastest/cheapest first)
-            preferred_models = [
-                'gemini-2.5-flash',      # Latest stable flash (recommended)
-                'gemini-2.0-flash',      # Stable flash v2.0
-                'gemini-2.0-flash-001',  # Stable flash v2.0 (versioned)
-                'gemini-flash-latest',   # Latest flash (alias)
-                'gemini-2.5-pro',        # Latest stable pro
-                'gemini-pro-latest',     # Latest pro (alias)
-                'gemini-2.0-flash-lite', # Lite version (fastest/cheapest)
-            ]
+            preferred_models = PREFERRED_MODELS
             
             # First, try to get the list of available models from API
             try:
-                available_models = {}
-                for model in genai.list_models():
-                    if 'generateContent' in model.supported_generation_methods:
-                        model_name = model.name.replace('models/', '')
-                        available_models[model_name] = model.display_name
+                self.available_models = []
+                available_models = [model_name for model_name in self.backend.list_models()
+                                    if model_name not in self.failed_models]
+                self.available_models = list(available_models)
                 
                 # Try preferred models in order (exact match first)
                 for preferred in preferred_models:
@@ -60,7 +232,7 @@ class GeminiClient:
                 for preferred in preferred_models:
                     # Check if any available model starts with preferred name or contains key parts
                     preferred_parts = preferred.split('-')
-                    for available in available_models.keys():
+                    for available in available_models:
                         available_parts = available.split('-')
                         # Match if first 2-3 parts match and both contain "flash" or both contain "pro"
                         if (len(preferred_parts) >= 2 and len(available_parts) >= 2 and
@@ -71,21 +243,21 @@ class GeminiClient:
                             return available
                 
                 # If none of preferred found, use first available flash model
-                for available in available_models.keys():
+                for available in available_models:
                     if 'flash' in available.lower() and 'latest' not in available.lower():
                         print(f"Using first available flash model: {available}")
                         return available
                 
                 # Last resort: use first available model
                 if available_models:
-                    first_model = list(available_models.keys())[0]
+                    first_model = available_models[0]
                     print(f"Using first available model: {first_model}")
                     return first_model
             except Exception as e:
                 print(f"Could not list models from API: {str(e)}")
                 # Fall back: try the most common model directly
                 try:
-                    return 'gemini-2.5-flash'
+                    return DEFAULT_MODEL
                 except:
                     pass
             
@@ -95,34 +267,130 @@ class GeminiClient:
             print(f"Error finding available model: {str(e)}")
             return None
 
-    def enhance_prompt(self, text):
+    def enhance_prompt(self, text, force_refresh=False):
+        """
+        Enhance the text, serving repeated requests from the cache.
+
+        Args:
+            text: The user input to enhance.
+            force_refresh: Skip the cache lookup and regenerate.
+
+        Returns:
+            The enhanced text, or an "Error ..." message on failure.
+        """
         if not self.model:
             return "Error: Gemini API Key not configured."
-        
         try:
-            prompt = f"""
-            You are an expert AI prompt engineer. Your task is to rewrite the following user input into a clear, detailed, and effective prompt for an AI agent (like Cursor AI) that can execute actions and modify code.
-            
-            User Input: "{text}"
-            
-            Important Guidelines:
-            1. Transform the input into an INSTRUCTION for the AI agent to EXECUTE an action, not to generate or explain text.
-            2. Focus on what the agent should DO, not what it should generate or describe.
-            3. If the input asks for a command or code, instruct the agent to execute it, not to generate it.
-            4. Add necessary context about what files to work with, what to check, or what conditions to consider.
-            5. Make the instruction actionable and specific for an AI coding assistant.
-            6. Keep the original intent but make it execution-oriented.
-            7. Use imperative mood (e.g., "Create", "Implement", "Modify", "Add") rather than descriptive language.
-            8. Do NOT ask the agent to generate commands, code, or explanations - ask it to perform actions.
-            
-            Examples:
-            - Input: "make a git commit" → Output: "Stage all currently modified and new files, then create a git commit with an appropriate commit message based on the changes. Analyze the staged changes to determine a meaningful commit message."
-            - Input: "add a button" → Output: "Add a button component to the current file. Determine the appropriate location and styling based on the existing UI patterns."
-            - Input: "fix the bug" → Output: "Identify and fix the bug in the current codebase. First analyze the code to locate the issue, then implement the fix."
-            
-            Return ONLY the enhanced prompt text as a single paragraph, no explanations, no quotes, no markdown formatting.
-            """
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
+            return self.generate_enhancement(text, force_refresh)
         except Exception as e:
             return f"Error enhancing prompt: {str(e)}"
+
+    def cached_enhancement(self, text):
+        """Return the cached enhancement for the current model, or None"""
+        if not self.model:
+            return None
+        return self.cache.get(text, self.model_name, ENHANCEMENT_TEMPLATE_VERSION)
+
+    def _model_for(self, model_name):
+        """Return (name, handle) for a model, defaulting to the current one"""
+        if not model_name or model_name == self.model_name:
+            return self.model_name, self.model
+        return model_name, self.backend.load_model(model_name)
+
+    def generate_enhancement(self, text, force_refresh=False, model_name=None):
+        """
+        Enhance the text like enhance_prompt(), but raise on failure.
+
+        Args:
+            text: The user input to enhance.
+            force_refresh: Skip the cache lookup and regenerate.
+            model_name: Use this model instead of the current one.
+
+        Raises:
+            RuntimeError: If no model is configured.
+            Exception: Any error raised by the backend.
+        """
+        if not self.model:
+            raise RuntimeError("Gemini API Key not configured.")
+
+        model_name, model = self._model_for(model_name)
+        if not force_refresh:
+            cached = self.cache.get(text, model_name, ENHANCEMENT_TEMPLATE_VERSION)
+            if cached is not None:
+                return cached
+        
+        try:
+            prompt = ENHANCEMENT_TEMPLATE.format(text=text)
+            started = time.perf_counter()
+            response_text = model.generate(prompt)
+            elapsed = time.perf_counter() - started
+        except Exception as e:
+            ENHANCEMENT_ERRORS.inc()
+            if self.prober:
+                self.prober.record(model_name, error=True)
+            self._handle_model_error(e, model_name)
+            raise
+        if metrics.enabled:
+            ENHANCEMENT_SECONDS.observe(elapsed)
+        if self.prober:
+            self.prober.record(model_name, total=elapsed)
+        enhanced_text = response_text.strip()
+        if enhanced_text:
+            self.cache.put(text, model_name, ENHANCEMENT_TEMPLATE_VERSION, enhanced_text)
+        return enhanced_text
+
+    def enhance_prompt_stream(self, text, force_refresh=False, model_name=None):
+        """
+        Stream the enhanced prompt as it is generated.
+
+        Args:
+            text: The user input to enhance.
+            force_refresh: Skip the cache lookup and regenerate.
+            model_name: Use this model instead of the current one.
+
+        Yields:
+            Raw text chunks as they arrive from the model (or the whole
+            cached result as a single chunk).
+
+        Raises:
+            RuntimeError: If no model is configured.
+            Exception: Any error raised by the API, including mid-stream.
+        """
+        if not self.model:
+            raise RuntimeError("Gemini API Key not configured.")
+
+        model_name, model = self._model_for(model_name)
+        if not force_refresh:
+            cached = self.cache.get(text, model_name, ENHANCEMENT_TEMPLATE_VERSION)
+            if cached is not None:
+                yield cached
+                return
+
+        prompt = ENHANCEMENT_TEMPLATE.format(text=text)
+        started = time.perf_counter()
+        ttft = None
+        chunks = []
+        try:
+            for chunk_text in model.stream(prompt):
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                    if metrics.enabled:
+                        ENHANCEMENT_FIRST_CHUNK_SECONDS.observe(ttft)
+                if chunk_text:
+                    chunks.append(chunk_text)
+                    yield chunk_text
+        except Exception as e:
+            ENHANCEMENT_ERRORS.inc()
+            if self.prober:
+                self.prober.record(model_name, error=True)
+            self._handle_model_error(e, model_name)
+            raise
+        elapsed = time.perf_counter() - started
+        if metrics.enabled:
+            ENHANCEMENT_SECONDS.observe(elapsed)
+        if self.prober:
+            self.prober.record(model_name, ttft, elapsed)
+        # Only complete responses are cached
+        enhanced_text = ''.join(chunks).strip()
+        if enhanced_text:
+            self.cache.put(text, model_name, ENHANCEMENT_TEMPLATE_VERSION, enhanced_text)
@@ -1,6 +1,5 @@
 import customtkinter as ctk
-from prompt_manager import PromptManager
-from keyboard_listener import KeyboardListener
+from daemon_client import RemotePromptManager, connect_daemon, use_daemon
 from service_manager import (
     check_background_service_running,
     check_startup_enabled,
@@ -22,11 +21,17 @@ class PromptApp(ctk.CTk):
         self.title("Prompt Manager")
         self.geometry("800x600")
 
-        self.prompt_manager = PromptManager()
-        self.listener = KeyboardListener(self.prompt_manager)
-        
-        # Start listener automatically
-        self.listener.start()
+        if use_daemon():
+            # The daemon owns the prompts and the keyboard hook
+            self.prompt_manager = RemotePromptManager(connect_daemon())
+            self.listener = None
+        else:
+            from prompt_manager import PromptManager
+            from keyboard_listener import KeyboardListener
+            self.prompt_manager = PromptManager(watch=True)
+            self.listener = KeyboardListener(self.prompt_manager)
+            # Start listener automatically
+            self.listener.start()
 
         # Layout configuration
         self.grid_columnconfigure(1, weight=1)
@@ -70,16 +75,19 @@ class PromptApp(ctk.CTk):
         self.refresh_list()
         # Update status periodically
         self.update_status()
+        self.check_prompt_changes()
 
     def refresh_list(self):
         # Clear existing buttons
         for widget in self.scrollable_frame.winfo_children():
             widget.destroy()
 
-        prompts = self.prompt_manager.get_prompts()
-        for shortcut, text in prompts.items():
+        snapshot = self.prompt_manager.get_snapshot()
+        self.list_version = snapshot.version
+        for shortcut, record in snapshot.records.items():
+            # The text is read when the prompt is clicked, not for every row
             btn = ctk.CTkButton(self.scrollable_frame, text=shortcut, 
-                                command=lambda s=shortcut, t=text: self.load_prompt_into_form(s, t),
+                                command=lambda s=shortcut, r=record: self.load_prompt_into_form(s, r.text),
                                 fg_color="transparent", border_width=1, text_color=("gray10", "#DCE4EE"))
             btn.pack(pady=2, fill="x")
             
@@ -87,6 +95,12 @@ class PromptApp(ctk.CTk):
             # For simplicity in this version, we'll just have the list items load into the form
             # and maybe add a delete button in the main form if a shortcut exists.
 
+    def check_prompt_changes(self):
+        """Refresh the list when prompts were changed by another process"""
+        if self.prompt_manager.has_changed(self.list_version):
+            self.refresh_list()
+        self.after(1000, self.check_prompt_changes)
+
     def load_prompt_into_form(self, shortcut, text):
         self.shortcut_entry.delete(0, "end")
         self.shortcut_entry.insert(0, shortcut)
@@ -104,7 +118,9 @@ class PromptApp(ctk.CTk):
         text = self.text_entry.get("0.0", "end-1c") # Get text without trailing newline
         
         if shortcut and text:
-            self.prompt_manager.add_prompt(shortcut, text)
+            # Keep the prepend/postpend of an existing prompt
+            existing = self.prompt_manager.get_prompt(shortcut)
+            self.prompt_manager.add_prompt(shortcut, dict(existing, text=text) if existing else text)
             self.refresh_list()
             self.clear_form()
 
@@ -255,7 +271,9 @@ class PromptApp(ctk.CTk):
         button.pack(pady=10)
 
     def on_closing(self):
-        self.listener.stop()
+        if self.listener is not None:
+            self.listener.close()
+        self.prompt_manager.flush()
         self.destroy()
         sys.exit()
 
@@ -0,0 +1,294 @@
+"""
+Input injection strategies for replacing typed triggers with prompt text.
+Deletes and inserts text in the focused window using batched key events,
+select-then-replace, or (opt-in) a clipboard paste for long replacements.
+"""
+import os
+import sys
+import time
+import threading
+from pynput.keyboard import Key, Controller
+
+try:
+    import pyperclip
+    HAS_PYPERCLIP = True
+except ImportError:
+    HAS_PYPERCLIP = False
+
+STRATEGY_AUTO = "auto"
+STRATEGY_KEYS = "keys"
+STRATEGY_SELECT = "select"
+STRATEGY_PASTE = "paste"
+STRATEGIES = (STRATEGY_AUTO, STRATEGY_KEYS, STRATEGY_SELECT, STRATEGY_PASTE)
+DEFAULT_PASTE_KEYS = "cmd+v" if sys.platform == 'darwin' else "ctrl+v"
+
+
+def parse_keys(spec):
+    """
+    Parse a shortcut such as "ctrl+shift+v".
+
+    Returns:
+        (modifier Keys, final key) - the final key is a pynput Key for
+        names like "insert", else the character itself.
+
+    Raises:
+        ValueError: A part isn't a key pynput knows.
+    """
+    parts = [part.strip().lower() for part in spec.split('+')]
+    if not all(parts):
+        raise ValueError(f"Invalid shortcut: {spec}")
+
+    def key(name):
+        if len(name) == 1:
+            return name
+        try:
+            return Key[name]
+        except KeyError:
+            raise ValueError(f"Unknown key in shortcut {spec}: {name}") from None
+
+    return [key(part) for part in parts[:-1]], key(parts[-1])
+
+
+class InputInjector:
+    """Deletes and inserts text in the active window using a selectable strategy"""
+
+    def __init__(self, controller=None, strategy=STRATEGY_AUTO, paste_threshold=None,
+                 key_delay=0.0, clipboard=None, paste_settle=0.3, paste_keys=DEFAULT_PASTE_KEYS):
+        """
+        Initialize the injector.
+
+        Args:
+            controller: pynput Controller (or a FakeController) used to send
+                        key events. If None, creates a new one.
+            strategy: One of "auto", "keys", "select" or "paste".
+                      "keys" sends backspaces then types the text,
+                      "select" selects the trigger with shift+left and types
+                      over the selection, "paste" pastes the text from the
+                      clipboard and restores the previous clipboard content.
+                      "auto" types like "keys" unless paste_threshold is
+                      set; it then pastes replacements at least that long
+                      when a clipboard is available.
+            paste_threshold: Replacement length at which "auto" switches to
+                             clipboard paste. None (the default) never
+                             pastes, as the paste shortcut differs between
+                             applications (e.g. ctrl+shift+v in terminals).
+            key_delay: Optional delay in seconds after each deletion batch,
+                       for applications that drop fast synthetic input.
+            clipboard: Object with copy(text)/paste() methods. Defaults to
+                       pyperclip when installed.
+            paste_settle: Seconds to wait after the paste shortcut before
+                          restoring the previous clipboard content. Slow
+                          applications may need longer to read it.
+            paste_keys: The paste shortcut, e.g. "ctrl+shift+v".
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown injection strategy: {strategy}")
+        self.controller = controller or Controller()
+        self.strategy = strategy
+        self.paste_threshold = paste_threshold
+        self.key_delay = key_delay
+        self.clipboard = clipboard if clipboard is not None else (pyperclip if HAS_PYPERCLIP else None)
+        self.paste_settle = paste_settle
+        self.paste_modifiers, self.paste_key = parse_keys(paste_keys)
+        # Serializes injections so output from different threads never interleaves
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls, controller=None, strategy=None):
+        """
+        Build an injector configured from PROMPTMANAGER_INJECTION (strategy),
+        PROMPTMANAGER_PASTE_THRESHOLD (characters; enables paste in "auto"),
+        PROMPTMANAGER_PASTE_KEYS and PROMPTMANAGER_PASTE_SETTLE_MS.
+
+        Args:
+            controller: pynput Controller, as for __init__.
+            strategy: Overrides PROMPTMANAGER_INJECTION when given.
+        """
+        threshold = os.getenv("PROMPTMANAGER_PASTE_THRESHOLD")
+        return cls(
+            controller,
+            strategy=strategy or os.getenv("PROMPTMANAGER_INJECTION") or STRATEGY_AUTO,
+            paste_threshold=int(threshold) if threshold else None,
+            paste_settle=float(os.getenv("PROMPTMANAGER_PASTE_SETTLE_MS", "300")) / 1000.0,
+            paste_keys=os.getenv("PROMPTMANAGER_PASTE_KEYS") or DEFAULT_PASTE_KEYS,
+        )
+
+    def choose_strategy(self, text):
+        """Return the concrete strategy used to insert the given text"""
+        if self.strategy == STRATEGY_PASTE and self.clipboard is None:
+            return STRATEGY_KEYS
+        if self.strategy != STRATEGY_AUTO:
+            return self.strategy
+        if (self.paste_threshold is not None and self.clipboard is not None
+                and len(text) >= self.paste_threshold):
+            return STRATEGY_PASTE
+        return STRATEGY_KEYS
+
+    def delete(self, count):
+        """
+        Delete characters before the cursor.
+
+        Args:
+            count: Number of characters to delete.
+        """
+        if count <= 0:
+            return
+        with self.lock:
+            if self.strategy == STRATEGY_SELECT:
+                self._select_back(count)
+                self._tap(Key.backspace)
+            else:
+                for _ in range(count):
+                    self._tap(Key.backspace)
+            if self.key_delay:
+                time.sleep(self.key_delay)
+
+    def insert(self, text):
+        """
+        Insert text at the cursor.
+
+        Args:
+            text: The text to insert.
+        """
+        if not text:
+            return
+        with self.lock:
+            if self.choose_strategy(text) == STRATEGY_PASTE:
+                self._paste(text)
+            else:
+                self.controller.type(text)
+
+    def replace(self, count, text):
+        """
+        Replace the characters before the cursor with new text.
+
+        Args:
+            count: Number of characters to remove (e.g. the typed trigger).
+            text: The replacement text.
+        """
+        with self.lock:
+            strategy = self.choose_strategy(text)
+            if strategy == STRATEGY_SELECT and count > 0:
+                # Typing over the selection replaces it in one step
+                self._select_back(count)
+            else:
+                self.delete(count)
+            if strategy == STRATEGY_PASTE:
+                self._paste(text)
+            elif text:
+                self.controller.type(text)
+
+    def _tap(self, key):
+        self.controller.press(key)
+        self.controller.release(key)
+
+    def _select_back(self, count):
+        with self.controller.pressed(Key.shift):
+            for _ in range(count):
+                self._tap(Key.left)
+
+    def _paste(self, text):
+        try:
+            previous = self.clipboard.paste()
+        except Exception:
+            previous = None
+        try:
+            self.clipboard.copy(text)
+        except Exception as e:
+            # Clipboard unavailable - fall back to typing
+            print(f"Clipboard paste failed, typing instead: {e}")
+            self.controller.type(text)
+            return
+        with self.controller.pressed(*self.paste_modifiers):
+            self._tap(self.paste_key)
+        # Give the target application time to read the clipboard
+        time.sleep(self.paste_settle)
+        if previous is not None:
+            try:
+                self.clipboard.copy(previous)
+            except Exception:
+                pass
+
+
+class FakeClipboard:
+    """In-memory clipboard for headless use"""
+
+    def __init__(self, text=""):
+        self.text = text
+
+    def copy(self, text):
+        self.text = text
+
+    def paste(self):
+        return self.text
+
+
+class FakeController:
+    """
+    Headless stand-in for pynput's Controller.
+    Simulates a single text field so injection strategies can be verified and
+    benchmarked without a display.
+    """
+
+    def __init__(self, clipboard=None):
+        self.clipboard = clipboard
+        self.text = []
+        self.selection = 0  # Number of characters selected before the cursor
+        self.held = set()
+        self.events = 0
+
+    def press(self, key):
+        self.events += 1
+        if key in (Key.shift, Key.ctrl, Key.cmd):
+            self.held.add(key)
+        elif key == Key.backspace:
+            self._delete_selection_or(1)
+        elif key == Key.left:
+            if Key.shift in self.held:
+                self.selection = min(self.selection + 1, len(self.text))
+        elif key == 'v' and (Key.ctrl in self.held or Key.cmd in self.held):
+            if self.clipboard is not None:
+                self._insert(self.clipboard.paste())
+        elif isinstance(key, str):
+            self._insert(key)
+
+    def release(self, key):
+        self.events += 1
+        self.held.discard(key)
+
+    def pressed(self, *keys):
+        return _Pressed(self, keys)
+
+    def type(self, text):
+        for char in text:
+            self.press(char)
+            self.release(char)
+
+    def value(self):
+        """Return the current content of the simulated text field"""
+        return ''.join(self.text)
+
+    def _delete_selection_or(self, count):
+        count = self.selection or count
+        self.selection = 0
+        if count:
+            del self.text[-count:]
+
+    def _insert(self, text):
+        if self.selection:
+            self._delete_selection_or(0)
+        self.text.extend(text)
+
+
+class _Pressed:
+    def __init__(self, controller, keys):
+        self.controller = controller
+        self.keys = keys
+
+    def __enter__(self):
+        for key in self.keys:
+            self.controller.press(key)
+
+    def __exit__(self, *exc_info):
+        for key in reversed(self.keys):
+            self.controller.release(key)
@@ -0,0 +1,270 @@
+"""
+Local IPC between the prompt manager daemon and its clients.
+
+Messages are JSON objects preceded by their length as a 4-byte big-endian
+integer. A client sends {"method", "params"} and receives {"result"} or
+{"error": {"type", "message"}}; a connection carries any number of requests,
+one at a time.
+
+The daemon listens on a Unix domain socket (mode 0600) where available.
+Elsewhere it falls back to TCP on 127.0.0.1, and clients must first present
+a random token the daemon writes to a file only the user can read.
+
+Configure with PROMPTMANAGER_IPC_PATH (socket path) or PROMPTMANAGER_IPC_PORT
+(TCP port, which also forces TCP).
+"""
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+
+LENGTH = struct.Struct('>I')
+MAX_MESSAGE = 64 * 1024 * 1024
+DEFAULT_PORT = 8766
+
+
+class IPCError(RuntimeError):
+    """Error raised by the daemon while handling a request"""
+
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_message(sock, message):
+    data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    if len(data) > MAX_MESSAGE:
+        raise ValueError(f"IPC message too large ({len(data)} bytes)")
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    """Return the next message, or None if the peer closed the connection"""
+    header = _recv_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+    (size,) = LENGTH.unpack(header)
+    if size > MAX_MESSAGE:
+        raise ValueError(f"IPC message too large ({size} bytes)")
+    data = _recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def default_address():
+    """
+    Return the daemon address: a socket path (str) or a (host, port) tuple.
+    """
+    port = os.getenv("PROMPTMANAGER_IPC_PORT")
+    if port or not hasattr(socket, 'AF_UNIX'):
+        return ("127.0.0.1", int(port or DEFAULT_PORT))
+    path = os.getenv("PROMPTMANAGER_IPC_PATH")
+    if path:
+        return path
+    directory = os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    user = os.getuid() if hasattr(os, 'getuid') else os.getenv("USERNAME", "user")
+    return os.path.join(directory, f"promptmanager-{user}.sock")
+
+
+def token_path():
+    return os.path.join(os.path.expanduser("~"), ".promptmanager-ipc-token")
+
+
+def read_token():
+    try:
+        with open(token_path()) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        sock = self.request
+        try:
+            if server.token is not None:
+                hello = recv_message(sock)
+                if not isinstance(hello, dict) or not hmac.compare_digest(
+                        str(hello.get('token', '')), server.token):
+                    send_message(sock, {'error': {'type': 'PermissionError', 'message': 'bad token'}})
+                    return
+                send_message(sock, {'result': 'ok'})
+            while True:
+                request = recv_message(sock)
+                if request is None:
+                    return
+                send_message(sock, server.dispatch(request))
+        except (ConnectionError, OSError, ValueError):
+            # Client went away or sent garbage; drop the connection
+            return
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    # On Windows SO_REUSEADDR would let a second daemon bind the same port
+    allow_reuse_address = os.name != 'nt'
+
+
+class IPCServer:
+    """Serves requests to handler(method, params) on a background thread"""
+
+    def __init__(self, handler, address=None):
+        """
+        Initialize the server.
+
+        Args:
+            handler: Called as handler(method, params) for every request; its
+                     return value (JSON-serializable) is sent back, and any
+                     exception is reported to the client.
+            address: Socket path or (host, port); defaults to
+                     default_address().
+        """
+        self.handler = handler
+        self.address = address or default_address()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                # Left over from a daemon that died; callers check that no
+                # daemon answers before starting a new one
+                os.unlink(self.address)
+            old_umask = os.umask(0o177)
+            try:
+                self.server = _UnixServer(self.address, _Handler)
+            finally:
+                os.umask(old_umask)
+            self.server.token = None
+        else:
+            self.server = _TCPServer(self.address, _Handler)
+            self.server.token = secrets.token_hex(16)
+            fd = os.open(token_path(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.server.token)
+        self.server.dispatch = self._dispatch
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _dispatch(self, request):
+        try:
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                raise ValueError("Malformed request")
+            return {'result': self.handler(request['method'], request.get('params') or {})}
+        except Exception as e:
+            return {'error': {'type': type(e).__name__, 'message': str(e)}}
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+        self.server = None
+
+
+class IPCClient:
+    """Client for an IPCServer; each thread uses its own connection"""
+
+    def __init__(self, address=None, timeout=60.0):
+        """
+        Initialize the client (connections are opened on first use).
+
+        Args:
+            address: Socket path or (host, port); defaults to
+                     default_address().
+            timeout: Socket timeout in seconds for each request.
+        """
+        self.address = address or default_address()
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+            if not isinstance(self.address, str):
+                send_message(sock, {'token': read_token() or ''})
+                reply = recv_message(sock)
+                if not reply or 'error' in reply:
+                    raise ConnectionRefusedError("IPC token rejected")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def call(self, method, **params):
+        """
+        Send a request and wait for its result.
+
+        Raises:
+            ConnectionError: The daemon is not reachable.
+            ValueError: The daemon rejected the arguments.
+            IPCError: The request failed in the daemon.
+        """
+        request = {'method': method, 'params': params}
+        for attempt in range(2):
+            sock = getattr(self.local, 'sock', None)
+            reused = sock is not None
+            if sock is None:
+                sock = self.local.sock = self._connect()
+            try:
+                send_message(sock, request)
+                response = recv_message(sock)
+                if response is None:
+                    raise ConnectionResetError("IPC connection closed")
+                break
+            except socket.timeout:
+                # The request may still be running; don't send it twice
+                self.close()
+                raise
+            except OSError:
+                self.close()
+                if not reused or attempt:
+                    raise
+                # The daemon restarted since this connection was opened
+        if 'error' in response:
+            error = response['error']
+            if error.get('type') == 'ValueError':
+                raise ValueError(error.get('message'))
+            raise IPCError(error.get('message'), error.get('type'))
+        return response.get('result')
+
+    def close(self):
+        """Close this thread's connection"""
+        sock = getattr(self.local, 'sock', None)
+        if sock is not None:
+            self.local.sock = None
+            sock.close()
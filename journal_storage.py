@@ -0,0 +1,451 @@
+"""
+Append-only journal storage for large prompt libraries.
+
+The library lives in two files next to prompts.json:
+    prompts.snapshot.json  full library as of some generation, written atomically
+    prompts.journal        operations since that snapshot, one per line
+
+Every journal line is "<crc32 hex> <json>"; the first line is a header naming
+the generation it belongs to, the rest are put/delete records. A single edit
+appends one record, so its cost depends on the size of the prompt rather than
+the size of the library.
+
+Startup loads the snapshot and replays the journal on top of it. A torn or
+corrupt tail (e.g. from a crash mid-append) is cut off at the last valid
+record. Once the journal grows past a multiple of the snapshot size it is
+compacted in the background: the snapshot plus journal are folded into a new
+snapshot and the journal restarts with only the records that arrived while
+the snapshot was being written. The snapshot remembers where in the old
+journal it was taken, so a crash at any point of a compaction loses nothing.
+
+Several processes can share the files: appends are single writes to a file
+opened in append mode, compactions are serialized with a lock file, and a
+process that finds the journal replaced under it switches to the new one.
+poll() reads only the records appended since the last poll.
+
+An existing prompts.json is imported on first use; it is left in place but
+no longer updated.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+import zlib
+from metrics import metrics
+from prompt_storage import (MISSING, PromptStorage, STORAGE_JOURNAL, diff_prompts, file_signature,
+                            read_json_prompts, write_atomic)
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+SNAPSHOT_FORMAT = "promptmanager-snapshot"
+
+JOURNAL_RECORDS = metrics.counter('promptmanager_journal_records_total',
+                                  'Records appended to the prompt journal')
+JOURNAL_COMPACTIONS = metrics.counter('promptmanager_journal_compactions_total',
+                                      'Prompt journal compactions')
+
+
+def encode_record(record):
+    payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def decode_record(line):
+    """Return the record stored in a journal line, or None if it is damaged"""
+    if len(line) < 10 or not line.endswith(b'\n') or line[8:9] != b' ':
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def apply_record(prompts, record):
+    if record['op'] == 'put':
+        prompts[record['key']] = record['value']
+    elif record['op'] == 'delete':
+        prompts.pop(record['key'], None)
+
+
+class JournalStorage(PromptStorage):
+    """Snapshot plus append-only operation log with background compaction"""
+
+    name = STORAGE_JOURNAL
+
+    def __init__(self, filepath="prompts.json", compact_ratio=1.0, min_compact_bytes=64 * 1024,
+                 fsync=True):
+        """
+        Initialize the engine.
+
+        Args:
+            filepath: The prompts.json path. The snapshot and journal are
+                      stored next to it, and it is imported if neither exists.
+            compact_ratio: Compact once the journal is larger than this
+                           multiple of the snapshot.
+            min_compact_bytes: Never compact journals smaller than this.
+            fsync: Sync every append to disk. Without it, appends are only
+                   synced by flush() (and compaction).
+        """
+        root = os.path.splitext(filepath)[0]
+        self.filepath = filepath
+        self.snapshot_path = root + ".snapshot.json"
+        self.journal_path = root + ".journal"
+        self.lock_path = root + ".lock"
+        self.compact_ratio = compact_ratio
+        self.min_compact_bytes = min_compact_bytes
+        self.fsync = fsync
+        self.snapshot_fn = None
+        # Serializes appends, polls and the journal swap of a compaction
+        self.lock = threading.Lock()
+        # Serializes compactions within this process
+        self.compact_lock = threading.Lock()
+        self.journal = None
+        self.generation = 0
+        self.journal_bytes = 0
+        self.snapshot_bytes = 0
+        self.snapshot_signature = None
+        # The prompts as of read_offset in the journal, for poll(). None
+        # means the files must be read again in full.
+        self.disk_prompts = {}
+        self.read_offset = None
+        self.compactor = None
+
+    @classmethod
+    def from_env(cls, filepath="prompts.json"):
+        """Create an engine configured by PROMPTMANAGER_JOURNAL_* variables"""
+        return cls(
+            filepath,
+            compact_ratio=float(os.getenv("PROMPTMANAGER_JOURNAL_COMPACT_RATIO", "1.0")),
+            min_compact_bytes=int(os.getenv("PROMPTMANAGER_JOURNAL_MIN_COMPACT_BYTES", str(64 * 1024))),
+            fsync=os.getenv("PROMPTMANAGER_JOURNAL_FSYNC", "1") != "0",
+        )
+
+    # Reading
+
+    def load(self):
+        base = None
+        if os.path.exists(self.snapshot_path):
+            prompts, base, self.generation, self.snapshot_bytes, self.snapshot_signature = \
+                self._read_snapshot()
+        elif not os.path.exists(self.journal_path) and os.path.exists(self.filepath):
+            prompts = read_json_prompts(self.filepath)
+            self.generation = 1
+            self._write_snapshot(prompts, None, self.generation)
+            print(f"Imported {len(prompts)} prompts from {self.filepath} into {self.snapshot_path}")
+        else:
+            prompts = {}
+
+        replayed, stale, offset = self._replay(prompts, self.generation, base, repair=True)
+        if stale or not os.path.exists(self.journal_path):
+            # The journal belongs to an earlier snapshot (or is missing):
+            # fold whatever applied into a new snapshot and start over
+            if stale:
+                self.generation += 1
+                self._write_snapshot(prompts, None, self.generation)
+            self._start_journal(b'')
+            self.read_offset = self.journal_bytes
+        else:
+            self.journal = open(self.journal_path, 'ab')
+            self.journal_bytes = self.read_offset = offset
+        if replayed:
+            print(f"Replayed {replayed} journal records on top of {self.snapshot_path}")
+        self.disk_prompts = dict(prompts)
+        return prompts
+
+    def _read_snapshot(self):
+        """Return (prompts, base, generation, size, signature) of the snapshot file"""
+        with open(self.snapshot_path, 'rb') as f:
+            signature = file_signature(os.fstat(f.fileno()))
+            data = f.read()
+        snapshot = json.loads(data)
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"{self.snapshot_path} is not a prompt snapshot")
+        return snapshot['prompts'], snapshot.get('base'), snapshot['generation'], len(data), signature
+
+    def _replay(self, prompts, generation, base, repair=False, limit=None):
+        """
+        Apply the journal's records to prompts.
+
+        Args:
+            prompts: Snapshot contents, updated in place.
+            generation: The snapshot's generation.
+            base: [generation, offset] of the journal the snapshot was taken
+                  from, if it came from a compaction.
+            repair: Move an unreadable journal aside and cut off a damaged
+                    tail (only safe while no other process is appending).
+            limit: Stop at this journal offset.
+
+        Returns:
+            (records applied, whether the journal must be replaced, offset
+            after the last record applied)
+        """
+        if not os.path.exists(self.journal_path):
+            return 0, False, 0
+        with open(self.journal_path, 'rb') as f:
+            header = decode_record(f.readline())
+            if header is None or header.get('op') != 'header':
+                if repair:
+                    backup = f"{self.journal_path}.corrupt-{int(time.time())}"
+                    print(f"Unreadable journal header; moved {self.journal_path} to {backup}")
+                    os.replace(self.journal_path, backup)
+                return 0, True, 0
+            if header['generation'] == generation:
+                stale = False
+            elif base and header['generation'] == base[0]:
+                # Crashed between writing the snapshot and swapping the
+                # journal: only records after the snapshot point still apply
+                stale = True
+                f.seek(base[1])
+            else:
+                if repair:
+                    print(f"Ignoring journal of generation {header['generation']} "
+                          f"(snapshot is generation {generation})")
+                return 0, True, 0
+
+            applied = 0
+            good_offset = f.tell()
+            for line in f:
+                if limit is not None and good_offset + len(line) > limit:
+                    break
+                record = decode_record(line)
+                if record is None:
+                    break
+                apply_record(prompts, record)
+                applied += 1
+                good_offset += len(line)
+            damaged = limit is None and (f.tell() != good_offset or f.read(1) != b'')
+
+        if damaged and repair and not stale:
+            print(f"Discarding damaged tail of {self.journal_path} after {applied} records")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_offset)
+                os.fsync(f.fileno())
+        return applied, stale, good_offset
+
+    def _read_state(self, limit=None):
+        """
+        Read snapshot plus journal without changing the files.
+
+        Returns:
+            (prompts, journal offset read up to, snapshot signature)
+        """
+        if os.path.exists(self.snapshot_path):
+            prompts, base, generation, _, signature = self._read_snapshot()
+        else:
+            prompts, base, generation, signature = {}, None, 0, None
+        _, _, offset = self._replay(prompts, generation, base, limit=limit)
+        return prompts, offset, signature
+
+    def watch_paths(self):
+        return [self.snapshot_path, self.journal_path]
+
+    def poll(self):
+        with self.lock:
+            if self.journal is None:
+                return None
+            if self._journal_replaced():
+                # Another process compacted
+                self._reopen_journal()
+            elif self._snapshot_changed():
+                # Another process is compacting; the journal swap follows
+                self.read_offset = None
+            if self.read_offset is None:
+                prompts, self.read_offset, self.snapshot_signature = self._read_state()
+                changes = diff_prompts(self.disk_prompts, prompts)
+                self.disk_prompts = prompts
+                return changes or None
+            return self._read_tail()
+
+    def _read_tail(self):
+        """Apply the records appended since the last read to disk_prompts"""
+        # Must be called with self.lock held
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self.read_offset)
+            data = f.read()
+        changes = {}
+        for line in data.splitlines(keepends=True):
+            record = decode_record(line)
+            if record is None:
+                # An append still in progress; read it next time
+                break
+            key = record['key']
+            old = self.disk_prompts.get(key, MISSING)
+            apply_record(self.disk_prompts, record)
+            new = self.disk_prompts.get(key, MISSING)
+            changes[key] = (changes[key][0] if key in changes else old, new)
+            self.read_offset += len(line)
+        changes = [(key, old, new) for key, (old, new) in changes.items() if old != new]
+        return changes or None
+
+    def _journal_replaced(self):
+        try:
+            return os.stat(self.journal_path).st_ino != os.fstat(self.journal.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _snapshot_changed(self):
+        try:
+            return file_signature(os.stat(self.snapshot_path)) != self.snapshot_signature
+        except FileNotFoundError:
+            return False
+
+    def _reopen_journal(self):
+        # Must be called with self.lock held
+        self.journal.close()
+        self.journal = open(self.journal_path, 'ab')
+        with open(self.journal_path, 'rb') as f:
+            header = decode_record(f.readline())
+        if header is not None and header.get('op') == 'header':
+            self.generation = header['generation']
+        self.journal_bytes = os.fstat(self.journal.fileno()).st_size
+        self.read_offset = None
+
+    # Changes
+
+    def put(self, shortcut, data):
+        self._append([{'op': 'put', 'key': shortcut, 'value': data}])
+
+    def delete(self, shortcut):
+        self._append([{'op': 'delete', 'key': shortcut}])
+
+    def replace(self, old_prompts, new_prompts):
+        # Journal only the difference; a large one simply triggers compaction
+        records = [{'op': 'put', 'key': key, 'value': new} if new is not MISSING
+                   else {'op': 'delete', 'key': key}
+                   for key, old, new in diff_prompts(old_prompts, new_prompts)]
+        if records:
+            self._append(records)
+
+    def _append(self, records):
+        data = b''.join(encode_record(record) for record in records)
+        with self.lock:
+            try:
+                if self._journal_replaced():
+                    self._reopen_journal()
+                # One write on an append-mode file, so appends from several
+                # processes never interleave within a record
+                os.write(self.journal.fileno(), data)
+                if self.fsync:
+                    os.fsync(self.journal.fileno())
+                self.journal_bytes = os.fstat(self.journal.fileno()).st_size
+            except OSError as e:
+                print(f"Error appending to {self.journal_path}: {e}")
+                return
+            JOURNAL_RECORDS.inc(len(records))
+            if self._needs_compaction():
+                self.compactor = threading.Thread(target=self._compact_in_background)
+                self.compactor.daemon = True
+                self.compactor.start()
+
+    def _needs_compaction(self):
+        # Must be called with self.lock held
+        if self.compactor is not None and self.compactor.is_alive():
+            return False
+        return self.journal_bytes > max(self.min_compact_bytes,
+                                        self.compact_ratio * self.snapshot_bytes)
+
+    def flush(self):
+        with self.lock:
+            if self.journal is not None and not self.journal.closed:
+                os.fsync(self.journal.fileno())
+
+    def close(self):
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            if self.journal is not None and not self.journal.closed:
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+
+    # Compaction
+
+    @contextlib.contextmanager
+    def _process_lock(self):
+        """Hold the cross-process compaction lock; yields False if another process has it"""
+        if not HAS_FCNTL:
+            yield True
+            return
+        with open(self.lock_path, 'a') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def compact(self):
+        """Write a new snapshot and restart the journal (blocks until done)"""
+        with self.compact_lock, self._process_lock() as locked:
+            if locked:
+                self._compact()
+
+    def _compact(self):
+        with self.lock:
+            if self._journal_replaced():
+                # Another process compacted since our last append
+                self._reopen_journal()
+                return
+            base_generation = self.generation
+            base_offset = os.fstat(self.journal.fileno()).st_size
+        # Built from the files rather than the in-memory snapshot, which may
+        # not have seen other processes' records yet
+        prompts, base_offset, _ = self._read_state(limit=base_offset)
+        self._write_snapshot(prompts, [base_generation, base_offset], base_generation + 1)
+        with self.lock:
+            # Carry over the records that arrived while the snapshot was written
+            self.journal.close()
+            with open(self.journal_path, 'rb') as old_journal:
+                old_journal.seek(base_offset)
+                tail = old_journal.read()
+                self.generation = base_generation + 1
+                self._start_journal(tail)
+                header_bytes = self.journal_bytes - len(tail)
+                # Another process may have appended to the old journal just
+                # before the swap; move those records over too
+                late = old_journal.read()
+            if late:
+                os.write(self.journal.fileno(), late)
+                os.fsync(self.journal.fileno())
+                self.journal_bytes += len(late)
+            if self.read_offset is not None and self.read_offset >= base_offset:
+                self.read_offset = header_bytes + self.read_offset - base_offset
+            else:
+                self.read_offset = None
+        JOURNAL_COMPACTIONS.inc()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Error compacting {self.journal_path}: {e}")
+
+    def _write_snapshot(self, prompts, base, generation):
+        snapshot = {
+            'format': SNAPSHOT_FORMAT,
+            'generation': generation,
+            'base': base,
+            'prompts': prompts,
+        }
+        data = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+        stat = write_atomic(self.snapshot_path, data)
+        self.snapshot_bytes = len(data)
+        self.snapshot_signature = file_signature(stat)
+
+    def _start_journal(self, records):
+        # Must be called with self.lock held (or before the engine is shared)
+        header = encode_record({'op': 'header', 'generation': self.generation})
+        write_atomic(self.journal_path, header + records)
+        self.journal = open(self.journal_path, 'ab')
+        self.journal_bytes = len(header) + len(records)
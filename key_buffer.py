@@ -0,0 +1,95 @@
+"""
+Fixed-capacity ring buffer for the typed keystroke history.
+Keeps the last N characters in a preallocated slot list so recording a key
+press never builds a new string, whatever the window size.
+"""
+
+
+class KeyBuffer:
+    """Circular buffer of the most recently typed characters"""
+
+    def __init__(self, capacity=500):
+        """
+        Initialize the buffer.
+
+        Args:
+            capacity: Maximum number of characters kept. Older characters
+                      are overwritten once the buffer is full.
+        """
+        if capacity < 1:
+            raise ValueError("Buffer capacity must be at least 1")
+        self.capacity = capacity
+        self._slots = [''] * capacity
+        self._end = 0  # Slot index one past the newest character
+        self._length = 0
+
+    def append(self, chars):
+        """
+        Record typed characters.
+
+        Args:
+            chars: The character(s) produced by a key press.
+        """
+        for char in chars:
+            self._slots[self._end] = char
+            self._end = (self._end + 1) % self.capacity
+            if self._length < self.capacity:
+                self._length += 1
+
+    def backspace(self):
+        """Drop the newest character, if any"""
+        if self._length:
+            self._end = (self._end - 1) % self.capacity
+            self._length -= 1
+
+    def reset(self):
+        """Forget everything typed so far"""
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        """
+        Return a single character.
+
+        Args:
+            index: Position in the buffer; negative values count from the
+                   newest character (-1 is the last one typed).
+        """
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("KeyBuffer index out of range")
+        return self._slots[(self._end - self._length + index) % self.capacity]
+
+    def endswith(self, suffix):
+        """Check whether the newest characters equal suffix, without slicing"""
+        count = len(suffix)
+        if count > self._length:
+            return False
+        slots = self._slots
+        position = self._end
+        for i in range(1, count + 1):
+            position = position - 1 if position else self.capacity - 1
+            if slots[position] != suffix[-i]:
+                return False
+        return True
+
+    def tail(self, count):
+        """
+        Return the newest characters as a string.
+
+        Args:
+            count: How many characters to return (clamped to the length).
+        """
+        count = min(count, self._length)
+        if count <= 0:
+            return ""
+        start = (self._end - count) % self.capacity
+        if start < self._end:
+            return ''.join(self._slots[start:self._end])
+        return ''.join(self._slots[start:]) + ''.join(self._slots[:self._end])
+
+    def __str__(self):
+        return self.tail(self._length)
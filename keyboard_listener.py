@@ -2,45 +2,158 @@ from pynput import keyboard
 from pynput.keyboard import Key, Controller
 import time
 import threading
-import json
+import queue
+from collections import deque
 from loading_animation import LoadingAnimation
-try:
-    from urllib.request import urlopen, Request
-    from urllib.error import URLError
-    HAS_URLLIB = True
-except ImportError:
-    HAS_URLLIB = False
+from trigger_index import TriggerIndex
+from key_buffer import KeyBuffer
+from input_injector import InputInjector
+from usage_tracker import UsageTracker
+from metrics import metrics, DEPTH_BUCKETS
+from enhancement_engine import EnhancementEngine
+from speculative_enhancer import SpeculativeEnhancer
+
+# Typed right before the enhancement trigger to bypass the enhancement cache
+FORCE_REFRESH_MARKER = "~"
+
+# Queued by stop() to tell the key worker to exit
+_STOP = object()
+
+HOOK_SECONDS = metrics.histogram('promptmanager_hook_seconds',
+                                 'Time spent in the keyboard hook callback')
+MATCH_SECONDS = metrics.histogram('promptmanager_match_seconds',
+                                  'Time to look up triggers at the end of the key buffer')
+INJECTION_SECONDS = metrics.histogram('promptmanager_injection_seconds',
+                                      'Time to delete a trigger and insert its replacement')
+QUEUE_DEPTH = metrics.histogram('promptmanager_key_queue_depth',
+                                'Keys waiting behind each key handled by the worker', DEPTH_BUCKETS)
+DROPPED_KEYS = metrics.counter('promptmanager_dropped_keys_total',
+                               'Keys dropped because the key worker fell behind')
+
+class StreamSanitizer:
+    """
+    Cleans streamed model output one chunk at a time so it can be typed
+    safely: newlines become spaces (to prevent auto-sending), leading
+    whitespace is dropped and trailing whitespace is held back until more
+    text follows - the same result as stripping the complete response.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.emitted = False
+
+    def feed(self, chunk):
+        """Return the part of the chunk that is safe to type now"""
+        text = self.pending + chunk.replace('\r', '').replace('\n', ' ')
+        if not self.emitted:
+            text = text.lstrip()
+        stripped = text.rstrip()
+        self.pending = text[len(stripped):]
+        if stripped:
+            self.emitted = True
+        return stripped
 
 class KeyboardListener:
-    def __init__(self, prompt_manager, gemini_client=None):
+    def __init__(self, prompt_manager, gemini_client=None, buffer_size=500, max_pending_keys=1000,
+                 controller=None, injection_strategy=None, usage_tracker=None,
+                 stream_enhancements=True, speculate=False, speculation_idle=0.8,
+                 speculation_budget=60):
         self.prompt_manager = prompt_manager
         self.gemini_client = gemini_client
-        self.buffer = ""
-        self.controller = Controller()
+        # Preallocated ring buffer - large enough to hold text for enhancement
+        self.buffer = KeyBuffer(buffer_size)
+        self.controller = controller or Controller()
+        # Strategy and paste settings come from PROMPTMANAGER_INJECTION and
+        # PROMPTMANAGER_PASTE_* unless a strategy is given
+        self.injector = InputInjector.from_env(self.controller, strategy=injection_strategy)
         self.listener = None
         self.running = False
-        self.loading_animation = LoadingAnimation(self.controller)
+        self.loading_animation = LoadingAnimation(self.controller, self.injector)
+        # Type enhanced text as it streams in instead of showing the animation
+        self.stream_enhancements = stream_enhancements
+        # Runs enhancements off the key worker; output shares the injector lock
+        self.enhancement_engine = None
+        if gemini_client:
+            self.enhancement_engine = EnhancementEngine(gemini_client, output_lock=self.injector.lock)
+        # Opt-in: enhance the buffer in the background during typing pauses
+        self.speculator = None
+        if speculate and self.enhancement_engine:
+            self.speculator = SpeculativeEnhancer(
+                self.enhancement_engine, lambda: str(self.buffer),
+                idle_seconds=speculation_idle, budget_per_hour=speculation_budget)
+        # Usage events are batched and flushed in the background
+        self.usage_tracker = usage_tracker or UsageTracker()
+        # Compiled trigger index. Changes reported by the prompt manager are
+        # queued and applied in place on the key worker; anything else (e.g.
+        # a full reload) rebuilds it.
+        self.trigger_index = TriggerIndex()
+        self.index_version = None
+        self.index_changes = deque()
+        prompt_manager.subscribe(self._on_prompts_changed)
+        # The OS hook only enqueues keys; a worker thread does matching and
+        # injection in arrival order. SimpleQueue.put never blocks.
+        self.key_queue = queue.SimpleQueue()
+        self.max_pending_keys = max_pending_keys
+        self.worker = None
+        self.overflowed = False
+        # Serializes start() and stop(), which IPC clients may call concurrently
+        self.state_lock = threading.Lock()
 
     def on_press(self, key):
+        """pynput hook callback - records the key and returns immediately"""
+        started = time.perf_counter() if metrics.enabled else 0
+        if self.key_queue.qsize() < self.max_pending_keys:
+            self.key_queue.put(key)
+        else:
+            # Backpressure: the worker is too far behind. Drop the key and
+            # have the worker reset its buffer, since the typed history no
+            # longer matches what is on screen.
+            self.overflowed = True
+            DROPPED_KEYS.inc()
+        if started:
+            HOOK_SECONDS.observe(time.perf_counter() - started)
+
+    def _process_keys(self):
+        """Worker loop - handles queued keys one at a time, in order"""
+        while True:
+            key = self.key_queue.get()
+            if key is _STOP:
+                break
+            self.process_key(key)
+
+    def drain(self):
+        """Process all queued keys on the calling thread (for headless replay)"""
+        while True:
+            try:
+                key = self.key_queue.get_nowait()
+            except queue.Empty:
+                return
+            if key is not _STOP:
+                self.process_key(key)
+
+    def process_key(self, key):
+        if metrics.enabled:
+            QUEUE_DEPTH.observe(self.key_queue.qsize())
+        if self.overflowed:
+            self.overflowed = False
+            self.buffer.reset()
         try:
             if hasattr(key, 'char') and key.char:
-                self.buffer += key.char
+                self.buffer.append(key.char)
             elif key == Key.space:
-                self.buffer += " "
+                self.buffer.append(" ")
             elif key == Key.enter:
-                self.buffer = "" # Reset on enter usually
+                self.buffer.reset() # Reset on enter usually
             elif key == Key.backspace:
-                self.buffer = self.buffer[:-1]
-            
-            # Limit buffer size to prevent memory issues - increased for enhancement
-            if len(self.buffer) > 500:
-                self.buffer = self.buffer[-500:]
+                self.buffer.backspace()
+            if self.speculator:
+                self.speculator.note_activity()
             
             # Check for matches
             self.check_for_matches()
             
         except Exception as e:
-            print(f"Error in on_press: {e}")
+            print(f"Error processing key: {e}")
 
     def check_for_matches(self):
         # Check for enhancement trigger
@@ -48,48 +161,57 @@ class KeyboardListener:
             self.handle_enhancement()
             return
 
-        prompts = self.prompt_manager.get_prompts()
-        for shortcut, prompt_data in prompts.items():
-            # Handle both old format (string) and new format (object)
-            if isinstance(prompt_data, dict):
-                prepend = prompt_data.get('prepend', '')
-                postpend = prompt_data.get('postpend', '')
-                # Build the full trigger shortcut: prepend + shortcut + postpend
-                full_trigger = prepend + shortcut + postpend
-                text = prompt_data.get('text', '')
-                replacement = text  # Replacement is just the text, not prepend/postpend
-            else:
-                # Old format - just use the shortcut as-is
-                full_trigger = shortcut
-                replacement = prompt_data
-            
-            # Check if buffer ends with the full trigger shortcut
-            if self.buffer.endswith(full_trigger):
-                # Track usage (non-blocking)
-                self.track_usage(shortcut)
-                
-                # Clear buffer BEFORE replacement to ensure clean state
-                self.buffer = ""
-                # Replace the full trigger with only the text (no prepend/postpend)
-                self.replace_text(full_trigger, replacement)
+        started = time.perf_counter() if metrics.enabled else 0
+        self.refresh_index()
+        match = self.trigger_index.match(self.buffer)
+        if started:
+            MATCH_SECONDS.observe(time.perf_counter() - started)
+        if match:
+            # Track usage (non-blocking)
+            self.track_usage(match.shortcut)
+
+            # Clear buffer BEFORE replacement to ensure clean state
+            self.buffer.reset()
+            # Replace the full trigger with only the text (no prepend/postpend)
+            self.replace_text(match.trigger, match.text)
+
+    def _on_prompts_changed(self, version, changed, removed):
+        # Runs on the writer's thread; deque.append is thread-safe
+        self.index_changes.append((version, changed, removed))
+
+    def refresh_index(self):
+        """Bring the trigger index up to date with the prompt set"""
+        if not self.prompt_manager.has_changed(self.index_version):
+            return
+        snapshot = self.prompt_manager.get_snapshot()
+        version = self.index_version
+        # Apply queued changes while they continue the indexed version
+        while self.index_changes and version is not None:
+            change_version, changed, removed = self.index_changes[0]
+            if change_version > snapshot.version:
                 break
+            self.index_changes.popleft()
+            if change_version <= version:
+                continue
+            if change_version != version + 1:
+                version = None
+                break
+            self.trigger_index.update(changed, removed)
+            version = change_version
+        if version is None or version < snapshot.version and not self.index_changes:
+            # A change that wasn't reported: rebuild from the snapshot
+            self.trigger_index.build(snapshot.records)
+            version = snapshot.version
+            while self.index_changes and self.index_changes[0][0] <= version:
+                self.index_changes.popleft()
+        self.index_version = version
     
     def track_usage(self, shortcut):
-        """Track prompt usage by calling the API endpoint"""
-        if not HAS_URLLIB:
-            return
-        try:
-            data = json.dumps({'shortcut': shortcut}).encode('utf-8')
-            req = Request('http://localhost:5000/api/prompts/track-usage', 
-                         data=data,
-                         headers={'Content-Type': 'application/json'})
-            urlopen(req, timeout=0.1)
-        except:
-            # Silently fail - this is non-critical
-            pass
+        """Record prompt usage; delivery happens on the tracker's worker thread"""
+        self.usage_tracker.record(shortcut)
 
     def handle_enhancement(self):
-        if not self.gemini_client:
+        if not self.enhancement_engine:
             return
 
         # Extract the text before ````
@@ -99,67 +221,129 @@ class KeyboardListener:
         # For simplicity, we'll take the whole buffer minus the trigger.
         
         trigger = "````"
-        text_to_enhance = self.buffer[:-len(trigger)].strip()
+        text_to_enhance = str(self.buffer)[:-len(trigger)].strip()
         
         if not text_to_enhance:
             return
 
         # Clear buffer to prevent further processing
-        self.buffer = ""
+        self.buffer.reset()
+
+        # Stop a previous enhancement still typing its output before
+        # deleting anything, so the deletions hit the right characters
+        self.enhancement_engine.cancel_context("keyboard")
         
         # Visual feedback: delete the trigger
         self.delete_text(trigger)
         
         # Delete the original text
         self.delete_text(text_to_enhance)
+
+        # "text~````" forces a fresh enhancement instead of a cached one
+        force_refresh = text_to_enhance.endswith(FORCE_REFRESH_MARKER)
+        if force_refresh:
+            text_to_enhance = text_to_enhance[:-len(FORCE_REFRESH_MARKER)].strip()
+            if not text_to_enhance:
+                return
         
-        # Start the animated loading indicator
-        self.loading_animation.start()
-        
-        # Run enhancement in a separate thread to avoid blocking
-        def enhance_and_replace():
-            try:
-                # Get the enhanced text
-                enhanced_text = self.gemini_client.enhance_prompt(text_to_enhance)
-                
-                # Stop animation
-                self.loading_animation.stop()
-                
-                # Type the enhanced text, replacing newlines with spaces to prevent auto-sending
-                self.controller.type(enhanced_text.replace('\n', ' '))
-            except Exception as e:
-                # Stop animation on error
-                self.loading_animation.stop()
-                
-                # Show error message
-                error_msg = f"Error: {str(e)}"
-                self.controller.type(error_msg)
-        
-        # Start the enhancement in a separate thread
-        thread = threading.Thread(target=enhance_and_replace)
-        thread.daemon = True
-        thread.start()
+        if self.stream_enhancements:
+            self.stream_enhancement(text_to_enhance, force_refresh)
+        else:
+            self.enhance_and_replace(text_to_enhance, force_refresh)
+        if self.speculator:
+            # After submitting, so the request has joined a running speculation
+            if force_refresh:
+                self.speculator.cancel()
+            else:
+                self.speculator.claim(text_to_enhance)
+
+    def enhance_and_replace(self, text_to_enhance, force_refresh=False):
+        """Show the loading animation until the full enhancement arrives, then type it"""
+        def on_result(enhanced_text):
+            # Type the enhanced text, replacing newlines with spaces to prevent auto-sending
+            self.injector.insert(enhanced_text.replace('\n', ' '))
+
+        def on_error(error):
+            # Give the user their text back rather than typing the error
+            print(f"Enhancement failed: {error}")
+            self.injector.insert(text_to_enhance)
+
+        # A newer request in the same context cancels this one, which stops
+        # its animation through on_done
+        self.enhancement_engine.submit(
+            text_to_enhance, context="keyboard", force_refresh=force_refresh,
+            on_start=self.loading_animation.start, on_done=self.loading_animation.stop,
+            on_result=on_result, on_error=on_error)
+
+    def stream_enhancement(self, text_to_enhance, force_refresh=False):
+        """Type the enhanced text chunk by chunk as the model streams it"""
+        sanitizer = StreamSanitizer()
+        typed = [0]
+
+        def on_chunk(chunk):
+            output = sanitizer.feed(chunk)
+            if output:
+                self.injector.insert(output)
+                typed[0] += len(output)
+
+        def on_error(error):
+            # Remove any partial output and give the user their text back
+            print(f"Enhancement failed: {error}")
+            self.injector.replace(typed[0], text_to_enhance)
+
+        self.enhancement_engine.submit(
+            text_to_enhance, context="keyboard", force_refresh=force_refresh, stream=True,
+            on_chunk=on_chunk, on_error=on_error)
 
     def delete_text(self, text):
-        for _ in range(len(text)):
-            self.controller.press(Key.backspace)
-            self.controller.release(Key.backspace)
-            time.sleep(0.01)
+        self.injector.delete(len(text))
 
     def replace_text(self, text_to_delete, replacement):
         # Delete the full trigger (prepend + shortcut + postpend)
         # Make sure we delete exactly what was typed, nothing more, nothing less
-        self.delete_text(text_to_delete)
         # Insert only the replacement text (no prepend/postpend)
         # Strip trailing newlines/whitespace to prevent auto-enter
-        self.controller.type(replacement.rstrip())
+        started = time.perf_counter() if metrics.enabled else 0
+        self.injector.replace(len(text_to_delete), replacement.rstrip())
+        if started:
+            INJECTION_SECONDS.observe(time.perf_counter() - started)
 
     def start(self):
-        self.running = True
-        self.listener = keyboard.Listener(on_press=self.on_press)
-        self.listener.start()
+        """Install the keyboard hook and start the key worker (no-op if already running)"""
+        with self.state_lock:
+            if self.running:
+                return
+            self.running = True
+            self.usage_tracker.start()
+            if self.speculator:
+                self.speculator.start()
+            self.worker = threading.Thread(target=self._process_keys)
+            self.worker.daemon = True
+            self.worker.start()
+            self.listener = keyboard.Listener(on_press=self.on_press)
+            self.listener.start()
 
     def stop(self):
-        self.running = False
-        if self.listener:
-            self.listener.stop()
+        with self.state_lock:
+            self.running = False
+            if self.listener:
+                self.listener.stop()
+                self.listener = None
+            worker = self.worker
+            if worker:
+                self.key_queue.put(_STOP)
+                self.worker = None
+            if self.speculator:
+                self.speculator.stop()
+            if self.enhancement_engine:
+                self.enhancement_engine.cancel_all()
+            self.usage_tracker.stop()
+        if worker and worker is not threading.current_thread():
+            # Let the worker finish the keys queued before the stop
+            worker.join(timeout=5.0)
+
+    def close(self):
+        """Stop for good: also shuts down the enhancement workers (stop() leaves them for a restart)"""
+        self.stop()
+        if self.enhancement_engine:
+            self.enhancement_engine.shutdown()
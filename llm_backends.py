@@ -0,0 +1,295 @@
+"""
+LLM backends used by GeminiClient.
+A backend lists models and turns a prompt into text, either all at once or
+as a stream of chunks. GeminiBackend talks to the Gemini API; HTTPBackend
+talks to any local endpoint speaking the small JSON protocol implemented by
+stub_llm_server.py, over a pool of persistent keep-alive connections.
+
+Select the backend with PROMPTMANAGER_LLM_BACKEND ("gemini" or "http") and
+point the HTTP backend at a server with PROMPTMANAGER_LLM_URL.
+"""
+import http.client
+import json
+import os
+import queue
+import threading
+from urllib.parse import urlsplit
+
+try:
+    import google.generativeai as genai
+    HAS_GENAI = True
+except ImportError:
+    HAS_GENAI = False
+
+BACKEND_GEMINI = "gemini"
+BACKEND_HTTP = "http"
+
+DEFAULT_HTTP_URL = "http://127.0.0.1:8765"
+
+
+class BackendError(Exception):
+    """Error returned by a backend; code is the HTTP-style status when known"""
+
+    def __init__(self, message, code=None, retry_after=None):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after  # Seconds, from a Retry-After header
+
+
+class LLMBackend:
+    """Interface implemented by every backend"""
+
+    name = None
+    # Whether configure() needs an API key before models can be used
+    requires_api_key = True
+
+    def configure(self, api_key):
+        """Apply credentials"""
+
+    def identity(self, api_key):
+        """Value identifying this backend and credentials for the model cache"""
+        return api_key
+
+    def list_models(self):
+        """Return the names of models that can generate content"""
+        raise NotImplementedError
+
+    def load_model(self, model_name):
+        """Return a model handle with generate(prompt) and stream(prompt)"""
+        raise NotImplementedError
+
+
+class GeminiModel:
+    def __init__(self, model_name):
+        self.name = model_name
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt):
+        return self.model.generate_content(prompt).text
+
+    def stream(self, prompt):
+        for chunk in self.model.generate_content(prompt, stream=True):
+            yield chunk.text
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini through google.generativeai"""
+
+    name = BACKEND_GEMINI
+
+    def __init__(self):
+        if not HAS_GENAI:
+            raise RuntimeError("google-generativeai is not installed")
+
+    def configure(self, api_key):
+        genai.configure(api_key=api_key)
+
+    def list_models(self):
+        return [model.name.replace('models/', '') for model in genai.list_models()
+                if 'generateContent' in model.supported_generation_methods]
+
+    def load_model(self, model_name):
+        return GeminiModel(model_name)
+
+
+class ConnectionPool:
+    """Bounded pool of persistent HTTP connections to one host"""
+
+    def __init__(self, url, size=4, timeout=30.0):
+        """
+        Initialize the pool.
+
+        Args:
+            url: Base URL of the server (http or https).
+            size: Maximum number of open connections; callers wait for a
+                  free one beyond that.
+            timeout: Socket timeout in seconds for connecting and reading.
+        """
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+        self.created = 0
+
+    def _connect(self):
+        self.created += 1
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        """Return (connection, reused)"""
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            self.idle.put(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HTTPModel:
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.name = model_name
+
+    def generate(self, prompt):
+        body = {'model': self.name, 'prompt': prompt, 'stream': False}
+        return self.backend.request_json("POST", "/v1/generate", body)['text']
+
+    def stream(self, prompt):
+        body = {'model': self.name, 'prompt': prompt, 'stream': True}
+        return self.backend.stream_lines("/v1/generate", body)
+
+
+class HTTPBackend(LLMBackend):
+    """Local or self-hosted model server reached over pooled keep-alive connections"""
+
+    name = BACKEND_HTTP
+    requires_api_key = False
+
+    def __init__(self, url=DEFAULT_HTTP_URL, pool_size=4, timeout=30.0):
+        """
+        Initialize the backend.
+
+        Args:
+            url: Base URL of the server.
+            pool_size: Maximum number of concurrent connections.
+            timeout: Socket timeout in seconds.
+        """
+        self.url = url
+        self.pool = ConnectionPool(url, pool_size, timeout)
+        self.api_key = None
+
+    def configure(self, api_key):
+        self.api_key = api_key
+
+    def identity(self, api_key):
+        return f"{self.url}\0{api_key or ''}"
+
+    def list_models(self):
+        return self.request_json("GET", "/v1/models")['models']
+
+    def load_model(self, model_name):
+        return HTTPModel(self, model_name)
+
+    def _headers(self, body):
+        headers = {'Connection': 'keep-alive', 'Accept': 'application/json'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        if self.api_key:
+            headers['Authorization'] = f"Bearer {self.api_key}"
+        return headers
+
+    def _send(self, method, path, body):
+        """
+        Send a request on a pooled connection.
+
+        Returns:
+            (connection, response) - the caller must release the connection.
+        """
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        while True:
+            connection, reused = self.pool.acquire()
+            try:
+                connection.request(method, self.pool.base_path + path, body=payload,
+                                   headers=self._headers(body))
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.pool.release(connection, reusable=False)
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection; retry on a fresh one
+            except Exception:
+                self.pool.release(connection, reusable=False)
+                raise
+
+    def _raise_for_status(self, response, data):
+        if response.status < 400:
+            return
+        try:
+            message = json.loads(data).get('error') or data.decode('utf-8', 'replace')
+        except (ValueError, AttributeError):
+            message = data.decode('utf-8', 'replace')
+        retry_after = response.getheader('Retry-After')
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise BackendError(f"{response.status} {message}", code=response.status, retry_after=retry_after)
+
+    def request_json(self, method, path, body=None):
+        connection, response = self._send(method, path, body)
+        try:
+            data = response.read()
+        except Exception:
+            self.pool.release(connection, reusable=False)
+            raise
+        self.pool.release(connection, reusable=not response.will_close)
+        self._raise_for_status(response, data)
+        return json.loads(data)
+
+    def stream_lines(self, path, body):
+        """Yield the text of each newline-delimited JSON chunk"""
+        connection, response = self._send("POST", path, body)
+        reusable = False
+        try:
+            if response.status >= 400:
+                data = response.read()
+                reusable = not response.will_close
+                self._raise_for_status(response, data)
+            for line in response:
+                line = line.strip()
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get('error'):
+                    raise BackendError(chunk['error'], code=chunk.get('code'))
+                if chunk.get('text'):
+                    yield chunk['text']
+            reusable = not response.will_close
+        finally:
+            # A stream abandoned part way through leaves unread data behind,
+            # so the connection is only reused after a complete read
+            self.pool.release(connection, reusable=reusable)
+
+    def close(self):
+        self.pool.close()
+
+
+def create_backend(name=None, url=None):
+    """
+    Create the backend selected by the arguments or the environment.
+
+    Args:
+        name: "gemini" or "http" (defaults to PROMPTMANAGER_LLM_BACKEND,
+              then "gemini").
+        url: Server URL for the HTTP backend (defaults to
+             PROMPTMANAGER_LLM_URL).
+    """
+    name = (name or os.getenv("PROMPTMANAGER_LLM_BACKEND") or BACKEND_GEMINI).lower()
+    if name == BACKEND_HTTP:
+        return HTTPBackend(
+            url or os.getenv("PROMPTMANAGER_LLM_URL") or DEFAULT_HTTP_URL,
+            pool_size=int(os.getenv("PROMPTMANAGER_LLM_POOL_SIZE", "4")),
+            timeout=float(os.getenv("PROMPTMANAGER_LLM_TIMEOUT", "30")),
+        )
+    if name == BACKEND_GEMINI:
+        return GeminiBackend()
+    raise ValueError(f"Unknown LLM backend: {name}")
@@ -4,21 +4,25 @@ Handles animated loading indicator with flying plane effect.
 """
 import time
 import threading
-from pynput.keyboard import Key, Controller
+from pynput.keyboard import Controller
+from input_injector import InputInjector
 
 
 class LoadingAnimation:
     """Handles animated loading indicator with ➤ character (flying plane effect)"""
     
-    def __init__(self, controller=None):
+    def __init__(self, controller=None, injector=None):
         """
         Initialize the loading animation.
         
         Args:
             controller: pynput Controller instance for typing/deleting text.
                       If None, creates a new one.
+            injector: InputInjector used to send the frames. If None, creates
+                      one around the controller.
         """
         self.controller = controller or Controller()
+        self.injector = injector or InputInjector(self.controller)
         self.animation_running = False
         self.animation_stop_event = threading.Event()
         self.animation_thread = None
@@ -75,7 +79,7 @@ class LoadingAnimation:
                 self._delete_text(self.current_text)
             
             # Type new animation frame
-            self.controller.type(animated_text)
+            self.injector.insert(animated_text)
             self.current_text = animated_text
             first_frame = False
             
@@ -91,20 +95,13 @@ class LoadingAnimation:
         Handles up to the maximum possible length of animation.
         """
         max_length = self.max_spaces + len(self.arrow)
-        for _ in range(max_length):
-            self.controller.press(Key.backspace)
-            self.controller.release(Key.backspace)
-            time.sleep(0.005)  # Small delay for smooth deletion
+        self.injector.delete(max_length)
     
     def _delete_text(self, text):
         """
-        Delete a specific text string character by character.
+        Delete a specific text string in a single batch of key events.
         
         Args:
             text: The text string to delete.
         """
-        for _ in range(len(text)):
-            self.controller.press(Key.backspace)
-            self.controller.release(Key.backspace)
-            time.sleep(0.01)
-
+        self.injector.delete(len(text))
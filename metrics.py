@@ -0,0 +1,159 @@
+"""
+Low-overhead latency instrumentation.
+Fixed-bucket histograms and counters shared by the listener, the injector and
+the Gemini client, rendered as JSON or Prometheus text by /api/metrics.
+
+Set PROMPTMANAGER_METRICS=0 to disable recording; instrumented code checks
+metrics.enabled before reading the clock, so the disabled cost is one
+attribute lookup.
+"""
+import os
+import threading
+from bisect import bisect_left
+
+# Latency buckets in seconds: 1us .. 30s
+LATENCY_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005,
+                   0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram:
+    """Cumulative fixed-bucket histogram (Prometheus semantics)"""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket containing it.
+        Returns None when there are no observations and the string "+Inf"
+        when the quantile falls beyond the largest bucket.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.bounds, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return '+Inf'
+
+    def to_dict(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, value_sum = self.count, self.sum
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            buckets[repr(bound)] = cumulative
+        buckets['+Inf'] = total
+        return {
+            'type': 'histogram',
+            'help': self.description,
+            'count': total,
+            'sum': value_sum,
+            'avg': (value_sum / total) if total else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+    def to_prometheus(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            counts = list(self.counts)
+            total, value_sum = self.count, self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound!r}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {value_sum!r}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter"""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def to_dict(self):
+        return {'type': 'counter', 'help': self.description, 'value': self.value}
+
+    def to_prometheus(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter",
+                f"{self.name} {self.value}"]
+
+
+class MetricsRegistry:
+    """Named collection of metrics"""
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.getenv("PROMPTMANAGER_METRICS", "1").lower() not in ("0", "false", "no", "off")
+        self.enabled = enabled
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        """Return the histogram with this name, creating it on first use"""
+        return self._get_or_create(name, lambda: Histogram(name, description, buckets))
+
+    def counter(self, name, description):
+        """Return the counter with this name, creating it on first use"""
+        return self._get_or_create(name, lambda: Counter(name, description))
+
+    def _get_or_create(self, name, factory):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = factory()
+            return metric
+
+    def to_dict(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {
+            'enabled': self.enabled,
+            'metrics': {metric.name: metric.to_dict() for metric in metrics},
+        }
+
+    def to_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.to_prometheus())
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
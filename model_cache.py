@@ -0,0 +1,96 @@
+"""
+Persistent cache of Gemini model discovery results.
+Stores the resolved model name and the list of available models per API key
+(keyed by a fingerprint, never the key itself) so startup and
+reconfiguration don't need a list_models() round-trip.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def fingerprint(api_key):
+    """Return a short, non-reversible identifier for an API key"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+class ModelCache:
+    """On-disk cache of model discovery results with a time-to-live"""
+
+    def __init__(self, path="model_cache.json", ttl=24 * 3600):
+        """
+        Initialize the cache.
+
+        Args:
+            path: JSON file holding the cache entries.
+            ttl: Seconds after which an entry is considered stale. Stale
+                 entries are still returned so callers can use them while
+                 revalidating in the background.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self._read()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (json.JSONDecodeError, OSError):
+            return {}
+
+    def _write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def get(self, api_key):
+        """Return the cached entry for this key, or None"""
+        if not api_key:
+            return None
+        with self.lock:
+            entry = self.entries.get(fingerprint(api_key))
+            return dict(entry) if entry else None
+
+    def is_stale(self, entry):
+        return time.time() - entry.get('resolved_at', 0) > self.ttl
+
+    def put(self, api_key, model_name, available_models, **extra):
+        """
+        Store the discovery result for an API key.
+
+        Args:
+            api_key: The API key the result belongs to.
+            model_name: The model chosen for enhancements.
+            available_models: Names of all models supporting generateContent.
+            extra: Additional fields to keep with the entry.
+        """
+        with self.lock:
+            entry = {
+                'model_name': model_name,
+                'available_models': list(available_models),
+                'resolved_at': time.time(),
+            }
+            entry.update(extra)
+            self.entries[fingerprint(api_key)] = entry
+            try:
+                self._write()
+            except OSError as e:
+                print(f"Could not write model cache: {e}")
+
+    def invalidate(self, api_key):
+        """Forget the cached result for an API key"""
+        if not api_key:
+            return
+        with self.lock:
+            if self.entries.pop(fingerprint(api_key), None) is not None:
+                try:
+                    self._write()
+                except OSError as e:
+                    print(f"Could not write model cache: {e}")
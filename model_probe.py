@@ -0,0 +1,181 @@
+"""
+Latency probing for candidate Gemini models.
+Benchmarks models with a representative enhancement request, records
+time-to-first-token, total latency and error rate, and picks the fastest
+healthy model that meets a latency objective.
+"""
+import threading
+import time
+from collections import deque
+
+# Short, typical input for probing - the real enhancement template is applied
+# by the probe function so the measured work matches production requests
+PROBE_INPUT = "fix the failing login test and make a git commit"
+
+
+class ProbeStats:
+    """Rolling latency and error statistics for one model"""
+
+    def __init__(self, model_name, window=20):
+        self.model_name = model_name
+        self.samples = deque(maxlen=window)  # (ttft, total) in seconds
+        self.outcomes = deque(maxlen=window)  # True for success
+        self.last_probed = None
+
+    def record(self, ttft=None, total=None, error=False):
+        self.outcomes.append(not error)
+        if not error and total is not None:
+            self.samples.append((ttft if ttft is not None else total, total))
+        self.last_probed = time.time()
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return None
+        return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+    def _median(self, index):
+        values = sorted(sample[index] for sample in self.samples)
+        if not values:
+            return None
+        return values[len(values) // 2]
+
+    @property
+    def ttft(self):
+        return self._median(0)
+
+    @property
+    def total(self):
+        return self._median(1)
+
+    def to_dict(self):
+        return {
+            'model_name': self.model_name,
+            'ttft_s': self.ttft,
+            'total_s': self.total,
+            'error_rate': self.error_rate,
+            'samples': len(self.outcomes),
+            'last_probed': self.last_probed,
+        }
+
+
+class ModelProber:
+    """Benchmarks candidate models and selects the fastest healthy one"""
+
+    def __init__(self, probe_fn, latency_slo=3.0, max_error_rate=0.2, window=20):
+        """
+        Initialize the prober.
+
+        Args:
+            probe_fn: Callable (model_name, text) returning an iterator of
+                      response text chunks (a streamed enhancement). Any
+                      exception counts as an error.
+            latency_slo: Target median total latency in seconds.
+            max_error_rate: Models failing more often are unhealthy.
+            window: Number of recent samples kept per model.
+        """
+        self.probe_fn = probe_fn
+        self.latency_slo = latency_slo
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.worker = None
+
+    def _stats_for(self, model_name):
+        with self.lock:
+            stats = self.stats.get(model_name)
+            if stats is None:
+                stats = self.stats[model_name] = ProbeStats(model_name, self.window)
+            return stats
+
+    def record(self, model_name, ttft=None, total=None, error=False):
+        """Record an observation, from a probe or from live traffic"""
+        stats = self._stats_for(model_name)
+        with self.lock:
+            stats.record(ttft, total, error)
+
+    def probe(self, model_name, text=PROBE_INPUT):
+        """Run one probe request against a model and record the result"""
+        started = time.perf_counter()
+        ttft = None
+        try:
+            for chunk in self.probe_fn(model_name, text):
+                if ttft is None and chunk:
+                    ttft = time.perf_counter() - started
+            self.record(model_name, ttft, time.perf_counter() - started)
+        except Exception as e:
+            print(f"Probe of {model_name} failed: {str(e)}")
+            self.record(model_name, error=True)
+        return self._stats_for(model_name).to_dict()
+
+    def probe_all(self, candidates, rounds=1):
+        """Probe every candidate model; returns their statistics"""
+        for _ in range(rounds):
+            for model_name in candidates:
+                if self.stop_event.is_set():
+                    break
+                self.probe(model_name)
+        return [self._stats_for(model_name).to_dict() for model_name in candidates]
+
+    def is_healthy(self, stats):
+        return (stats.error_rate is not None and stats.error_rate <= self.max_error_rate
+                and stats.total is not None)
+
+    def best_model(self, candidates=None):
+        """
+        Return the fastest healthy model, preferring those within the
+        latency objective. Returns None when nothing has been measured.
+        """
+        with self.lock:
+            stats = [s for name, s in self.stats.items() if candidates is None or name in candidates]
+        healthy = sorted((s for s in stats if self.is_healthy(s)), key=lambda s: (s.total, s.ttft))
+        if not healthy:
+            return None
+        within_slo = [s for s in healthy if self.latency_slo is None or s.total <= self.latency_slo]
+        return (within_slo or healthy)[0].model_name
+
+    def snapshot(self):
+        with self.lock:
+            return [stats.to_dict() for stats in self.stats.values()]
+
+    def load(self, entries):
+        """Seed statistics from persisted probe results"""
+        for entry in entries or []:
+            if entry.get('total_s') is not None:
+                self.record(entry['model_name'], entry.get('ttft_s'), entry['total_s'])
+            elif entry.get('error_rate'):
+                self.record(entry['model_name'], error=True)
+
+    def start(self, candidates_fn, interval, on_update):
+        """
+        Re-probe in the background.
+
+        Args:
+            candidates_fn: Callable returning the models to probe.
+            interval: Seconds between probe rounds.
+            on_update: Called with the best model after every round.
+        """
+        if self.worker and self.worker.is_alive():
+            return
+        self.stop_event.clear()
+
+        def run():
+            while True:
+                try:
+                    candidates = candidates_fn()
+                    if candidates:
+                        self.probe_all(candidates)
+                        on_update(self.best_model(candidates))
+                except Exception as e:
+                    print(f"Error probing models: {str(e)}")
+                if self.stop_event.wait(interval):
+                    return
+
+        self.worker = threading.Thread(target=run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -1,52 +1,206 @@
-import json
+import atexit
 import os
 import threading
+from prompt_records import PromptRecord, PromptSnapshot, records_from_prompts
+from prompt_storage import MISSING, create_storage, diff_prompts
+from prompt_watcher import create_watcher
+
 
 class PromptManager:
-    def __init__(self, filepath="prompts.json"):
+    def __init__(self, filepath="prompts.json", write_delay=0.5, storage=None, watch=False):
+        """
+        Initialize the prompt manager and load the prompt library.
+
+        Args:
+            filepath: JSON file holding the prompt library.
+            write_delay: Seconds to collect further changes before writing
+                         them to disk in one go (write-behind). 0 writes on
+                         every change. Used by the JSON and text storages.
+            storage: PromptStorage engine (defaults to the one selected by
+                     PROMPTMANAGER_STORAGE).
+            watch: Pick up changes other processes make to the stored
+                   prompts (see start_watching). PROMPTMANAGER_WATCH=0
+                   turns this off.
+        """
         self.filepath = filepath
-        self.prompts = {}
+        self.write_delay = write_delay
+        self.storage = storage or create_storage(filepath, write_delay=write_delay)
+        # Serializes writers only; readers go through the published snapshot
         self.lock = threading.Lock()
+        self._snapshot = PromptSnapshot(0, {})
+        # Called as callback(version, changed, removed) for every change
+        self.subscribers = []
+        self.watcher = None
+        self.storage.bind(self.get_snapshot)
         self.load_prompts()
+        # Pending changes are written on interpreter exit
+        atexit.register(self.flush)
+        if watch and os.getenv("PROMPTMANAGER_WATCH", "1") != "0":
+            self.start_watching()
 
-    def load_prompts(self):
-        if os.path.exists(self.filepath):
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    @property
+    def prompts(self):
+        return self._snapshot.prompts
+
+    def _publish(self, records):
+        # Must be called with self.lock held. Attribute assignment is atomic,
+        # so readers see either the old snapshot or the new one.
+        self._snapshot = PromptSnapshot(self._snapshot.version + 1, records)
+
+    def subscribe(self, callback):
+        """
+        Register callback(version, changed, removed), called after each change
+        with the new snapshot version, a dict of added or changed prompts
+        (shortcut -> PromptRecord) and a list of removed shortcuts. It runs with the writer lock held, so it
+        must be quick; a full reload (load_prompts) is not reported, which
+        subscribers notice as a gap in versions.
+        """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def _notify(self, changed, removed):
+        # Must be called with self.lock held, right after _publish
+        for callback in self.subscribers:
             try:
-                with open(self.filepath, 'r') as f:
-                    self.prompts = json.load(f)
-            except json.JSONDecodeError:
-                self.prompts = {}
-        else:
-            self.prompts = {}
+                callback(self._snapshot.version, changed, removed)
+            except Exception as e:
+                print(f"Error in prompt change subscriber: {e}")
 
-    def save_prompts(self):
+    def start_watching(self, interval=1.0):
+        """
+        Watch the storage files and merge changes made by other processes
+        (e.g. the GUI editing prompts while the background service runs).
+
+        Args:
+            interval: Polling interval where inotify is unavailable.
+        """
+        if self.watcher is not None:
+            return
+        self.watcher = create_watcher(self.storage.watch_paths(), self.reload_changes, interval)
+        self.watcher.start()
+
+    def stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def reload_changes(self):
+        """
+        Merge changes another process made to the stored prompts into the
+        snapshot. Only the changed prompts are applied. A prompt edited
+        locally since the storage last saw it keeps the local version.
+
+        Returns:
+            True if the snapshot changed.
+        """
+        changes = self.storage.poll()
+        if not changes:
+            return False
         with self.lock:
-            with open(self.filepath, 'w') as f:
-                json.dump(self.prompts, f, indent=4)
+            current = self._snapshot.records
+            changed = {}
+            removed = []
+            for shortcut, old, new in changes:
+                value = current.get(shortcut, MISSING)
+                if old is not MISSING:
+                    old = PromptRecord.from_data(shortcut, old)
+                if new is not MISSING:
+                    new = PromptRecord.from_data(shortcut, new)
+                if value == new or value != old:
+                    # Already applied, or changed locally since
+                    continue
+                if new is MISSING:
+                    removed.append(shortcut)
+                else:
+                    changed[shortcut] = new
+            if not changed and not removed:
+                return False
+            records = dict(current)
+            records.update(changed)
+            for shortcut in removed:
+                del records[shortcut]
+            self._publish(records)
+            self._notify(changed, removed)
+        print(f"Reloaded prompts from another process: {len(changed)} changed, {len(removed)} removed")
+        return True
+
+    def load_prompts(self):
+        # Legacy plain-string prompts become records like any other
+        records = records_from_prompts(self.storage.load())
+        with self.lock:
+            self._publish(records)
+
+    def save_prompts(self):
+        """Write the prompts to disk now"""
+        self.flush()
+
+    def flush(self):
+        """Write pending changes to disk, if any. Call before shutting down."""
+        self.storage.flush()
 
     def add_prompt(self, shortcut, text):
         if ' ' in shortcut:
             raise ValueError("Shortcuts cannot contain spaces")
+        record = PromptRecord.from_data(shortcut, text)
         with self.lock:
-            self.prompts[shortcut] = text
-        self.save_prompts()
+            records = dict(self._snapshot.records)
+            records[shortcut] = record
+            self._publish(records)
+            # Storage is told inside the lock so it sees changes in publish order
+            self.storage.put(shortcut, record.to_dict())
+            self._notify({shortcut: record}, [])
 
     def delete_prompt(self, shortcut):
-        deleted = False
         with self.lock:
-            if shortcut in self.prompts:
-                del self.prompts[shortcut]
-                deleted = True
-        if deleted:
-            self.save_prompts()
-            # Reload to ensure file was written correctly
-            self.load_prompts()
-        return deleted
+            if shortcut not in self._snapshot.records:
+                return False
+            records = dict(self._snapshot.records)
+            del records[shortcut]
+            self._publish(records)
+            self.storage.delete(shortcut)
+            self._notify({}, [shortcut])
+        return True
 
-    def get_prompts(self):
+    def replace_prompts(self, prompts):
+        """Replace the whole prompt set (used when syncing from the browser)"""
+        records = records_from_prompts(prompts)
         with self.lock:
-            return self.prompts.copy()
+            old = self._snapshot
+            self._publish(records)
+            self.storage.replace(old.prompts, self._snapshot.prompts)
+            if self.subscribers:
+                changes = diff_prompts(old.records, self._snapshot.records)
+                self._notify({key: new for key, _, new in changes if new is not MISSING},
+                             [key for key, _, new in changes if new is MISSING])
+
+    def get_snapshot(self):
+        """Return the current immutable snapshot (no locking, no copying)"""
+        return self._snapshot
+
+    def has_changed(self, since_version):
+        """Check whether the prompts changed since the given snapshot version"""
+        return self._snapshot.version != since_version
+
+    def get_prompts(self):
+        """Return a read-only mapping of all prompts from the current snapshot"""
+        return self._snapshot.prompts
 
     def get_prompt(self, shortcut):
-        with self.lock:
-            return self.prompts.get(shortcut)
+        record = self._snapshot.records.get(shortcut)
+        return record.to_dict() if record is not None else None
+
+    def search(self, query, limit=20):
+        """
+        Search shortcuts and prompt text (indexed with the SQLite storage,
+        a scan of the snapshot otherwise).
+
+        Returns:
+            Up to limit (shortcut, prompt data) pairs, best matches first.
+        """
+        return self.storage.search(query, limit)
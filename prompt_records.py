@@ -0,0 +1,143 @@
+"""
+Compact in-memory prompt records.
+The library is held as one PromptRecord per prompt instead of a dict per
+prompt. Records use __slots__, share interned trigger markers (most prompts
+use the same few prepend/postpend strings) and carry their full trigger,
+computed once when the record is built, so the listener never has to look
+inside prompt data while matching. Legacy entries (a plain string instead of
+an object) are converted when they are loaded.
+
+The JSON-shaped form ({"text", "prepend", "postpend", ...}) is still what
+storage, the API and the GUI see, through to_dict() and PromptView.
+
+Only the standard library is used here, so daemon clients can build
+snapshots without loading the storage stack.
+"""
+import sys
+from collections.abc import Mapping
+from types import MappingProxyType
+
+# Keys stored in slots; anything else (e.g. "tags") is kept in extra
+FIELDS = frozenset(('text', 'prepend', 'postpend'))
+
+
+class PromptRecord:
+    """One prompt: its shortcut, body and precomputed full trigger"""
+
+    __slots__ = ('shortcut', 'text', 'prepend', 'postpend', 'trigger', 'extra')
+
+    # Set by records that read their body from storage when asked for it
+    lazy_text = False
+
+    def __init__(self, shortcut, text, prepend="", postpend="", extra=None):
+        self.shortcut = shortcut
+        self.text = text
+        # Markers repeat across prompts, so one copy each. Shortcuts and
+        # triggers are unique; interning them would only grow the intern table.
+        self.prepend = sys.intern(prepend)
+        self.postpend = sys.intern(postpend)
+        # The typed trigger: prepend + shortcut + postpend (the shortcut
+        # object itself when there are no markers)
+        self.trigger = prepend + shortcut + postpend
+        self.extra = extra or None
+
+    @classmethod
+    def from_data(cls, shortcut, data):
+        """
+        Build a record from stored prompt data.
+
+        Args:
+            shortcut: The prompt's shortcut.
+            data: Either the object format ({"text", "prepend", "postpend"}
+                  plus optional extra keys) or a legacy plain string.
+        """
+        if isinstance(data, PromptRecord):
+            return data
+        if not isinstance(data, dict):
+            # Legacy format - the string is the text and the shortcut is the trigger
+            return cls(shortcut, data)
+        extra = None
+        if not data.keys() <= FIELDS:
+            extra = {key: value for key, value in data.items() if key not in FIELDS}
+        return cls(shortcut, data.get('text', ''), data.get('prepend') or '',
+                   data.get('postpend') or '', extra)
+
+    def to_dict(self):
+        """Return the prompt in the stored object format"""
+        data = {'text': self.text, 'prepend': self.prepend, 'postpend': self.postpend}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def same_text(self, other):
+        """Whether another record has the same body; lazy records compare it without decoding"""
+        if other.lazy_text:
+            return other.same_text(self)
+        return self.text == other.text
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PromptRecord):
+            return NotImplemented
+        # The body last, as it may have to be read from storage
+        return (self.shortcut == other.shortcut and self.prepend == other.prepend
+                and self.postpend == other.postpend and self.extra == other.extra
+                and self.same_text(other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"PromptRecord({self.shortcut!r}, trigger={self.trigger!r})"
+
+
+def records_from_prompts(prompts):
+    """Convert a prompt dict (shortcut -> stored data) into a dict of records"""
+    return {shortcut: PromptRecord.from_data(shortcut, data) for shortcut, data in prompts.items()}
+
+
+class PromptView(Mapping):
+    """Read-only shortcut -> prompt data mapping over a dict of records"""
+
+    __slots__ = ('records',)
+
+    def __init__(self, records):
+        self.records = records
+
+    def __getitem__(self, shortcut):
+        return self.records[shortcut].to_dict()
+
+    def __contains__(self, shortcut):
+        return shortcut in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+class PromptSnapshot:
+    """Immutable, versioned view of the prompt library.
+
+    Writers never modify a published snapshot; they build a new one and swap
+    it in, so readers can hold on to a snapshot without locking or copying.
+    Prompts are held as PromptRecords (records); prompts presents them in
+    the stored dict format.
+    """
+
+    __slots__ = ('version', 'records', 'prompts')
+
+    def __init__(self, version, records):
+        self.version = version
+        self.records = MappingProxyType(records)
+        self.prompts = PromptView(self.records)
+
+    @classmethod
+    def from_prompts(cls, version, prompts):
+        """Build a snapshot from stored prompt data (either format)"""
+        return cls(version, records_from_prompts(prompts))
+
+    def to_dict(self):
+        """Return a plain (mutable) copy of the prompts, e.g. for JSON output"""
+        return {shortcut: record.to_dict() for shortcut, record in self.records.items()}
@@ -0,0 +1,339 @@
+"""
+Storage engines behind PromptManager.
+PromptManager keeps the whole library in memory and publishes immutable
+snapshots; a storage engine loads the library at startup and persists every
+change after it has been published. Engines are notified of changes with the
+manager's lock held, so they see them in publish order. Engines can also
+report changes other processes made to their files (poll), which the
+manager merges into its snapshot when watching is enabled.
+
+Select the engine with PROMPTMANAGER_STORAGE:
+    json     - the whole library in prompts.json, rewritten (write-behind)
+               after changes (default)
+    journal  - snapshot plus append-only operation log, see journal_storage.py
+    sqlite   - SQLite database with full-text search, see sqlite_storage.py
+    text     - small trigger index plus memory-mapped prompt bodies, loaded
+               lazily, see text_store.py
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+STORAGE_JSON = "json"
+STORAGE_JOURNAL = "journal"
+STORAGE_SQLITE = "sqlite"
+STORAGE_TEXT = "text"
+
+SEARCH_TERM = re.compile(r"\w+")
+
+# Stands in for "no such prompt" in change triples
+MISSING = object()
+
+
+def fsync_directory(path):
+    """Persist a rename inside the directory containing path"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, data):
+    """
+    Replace path with data (bytes) so it is never left half-written: write a
+    complete temporary file, then rename it over the original.
+
+    Returns:
+        The os.stat_result of the written file.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        stat = os.fstat(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+    return stat
+
+
+def file_signature(stat):
+    """Cheap change check for a file: replaced, resized or rewritten"""
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def diff_prompts(old, new):
+    """
+    Compare two prompt dicts.
+
+    Returns:
+        List of (shortcut, old data, new data) triples for every prompt that
+        was added, changed or removed, with MISSING for an absent side.
+    """
+    changes = [(key, old.get(key, MISSING), value) for key, value in new.items()
+               if old.get(key, MISSING) != value]
+    changes.extend((key, value, MISSING) for key, value in old.items() if key not in new)
+    return changes
+
+
+def prompt_text(data):
+    """Body of a prompt in either format (plain string or object with text)"""
+    if isinstance(data, dict):
+        return data.get('text', '')
+    return data
+
+
+def search_terms(query):
+    """Lowercased words of a search query"""
+    return SEARCH_TERM.findall(query.casefold())
+
+
+def read_json_prompts(path):
+    """
+    Read a prompts.json file. An unreadable file is moved aside instead of
+    being overwritten by the next save.
+
+    Returns:
+        The prompts dict (empty if the file is missing or unreadable).
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError as e:
+        backup = f"{path}.corrupt-{int(time.time())}"
+        print(f"Error reading {path} ({e}); moved it to {backup}")
+        os.replace(path, backup)
+        return {}
+
+
+class PromptStorage:
+    """Interface implemented by every storage engine"""
+
+    name = None
+
+    def bind(self, snapshot_fn):
+        """Give the engine access to the manager's current PromptSnapshot"""
+        self.snapshot_fn = snapshot_fn
+
+    def load(self):
+        """Return the stored prompts as a dict"""
+        raise NotImplementedError
+
+    def put(self, shortcut, data):
+        """Persist a prompt that was added or changed"""
+        raise NotImplementedError
+
+    def delete(self, shortcut):
+        """Persist the removal of a prompt"""
+        raise NotImplementedError
+
+    def replace(self, old_prompts, new_prompts):
+        """Persist a wholesale replacement of the library"""
+        raise NotImplementedError
+
+    def search(self, query, limit=20):
+        """
+        Find prompts whose shortcut or text contain every word of query
+        (as a prefix). Engines with an index override this scan.
+
+        Returns:
+            Up to limit (shortcut, prompt data) pairs, best matches first:
+            shortcut matches, then shorter shortcuts.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        matches = []
+        for shortcut, record in self.snapshot_fn().records.items():
+            name = shortcut.casefold()
+            # The body is only read for terms the shortcut doesn't match
+            words = search_terms(shortcut)
+            rest = [term for term in terms if not any(word.startswith(term) for word in words)]
+            if not rest or self._text_matches(record, rest):
+                in_name = all(term in name for term in terms)
+                matches.append((not in_name, len(shortcut), shortcut, record))
+        matches.sort(key=lambda match: match[:3])
+        return [(shortcut, record.to_dict()) for _, _, shortcut, record in matches[:limit]]
+
+    def _text_matches(self, record, terms):
+        """Whether every term is the start of a word in the record's body"""
+        words = search_terms(record.text)
+        return all(any(word.startswith(term) for word in words) for term in terms)
+
+    def watch_paths(self):
+        """Files whose modification may mean another process changed the prompts"""
+        return []
+
+    def poll(self):
+        """
+        Check whether another process changed the stored prompts since they
+        were last loaded, written or polled.
+
+        Returns:
+            A list of (shortcut, old data, new data) triples as produced by
+            diff_prompts(), or None if nothing changed.
+        """
+        return None
+
+    def flush(self):
+        """Make sure every change reported so far is durable"""
+
+    def close(self):
+        self.flush()
+
+
+class JsonStorage(PromptStorage):
+    """The whole library in one JSON file, rewritten after changes"""
+
+    name = STORAGE_JSON
+
+    def __init__(self, filepath="prompts.json", write_delay=0.5):
+        """
+        Initialize the engine.
+
+        Args:
+            filepath: JSON file holding the prompt library.
+            write_delay: Seconds to collect further changes before writing
+                         them to disk in one go (write-behind). 0 writes on
+                         every change.
+        """
+        self.filepath = filepath
+        self.write_delay = write_delay
+        self.snapshot_fn = None
+        self.lock = threading.Lock()
+        # Serializes file writes, which happen outside self.lock
+        self.write_lock = threading.Lock()
+        self.dirty = False
+        self._save_timer = None
+        # What the file held when it was last read or written, for poll()
+        self.disk_prompts = {}
+        self.signature = None
+        self.digest = None
+
+    def load(self):
+        prompts = read_json_prompts(self.filepath)
+        with self.write_lock:
+            self.disk_prompts = prompts
+            try:
+                self.signature, self.digest, _ = self._read()
+            except OSError:
+                pass
+        return prompts
+
+    def _read(self):
+        """Return (signature, digest, data) of the file as it is now"""
+        with open(self.filepath, 'rb') as f:
+            signature = file_signature(os.fstat(f.fileno()))
+            data = f.read()
+        return signature, hashlib.blake2b(data, digest_size=16).digest(), data
+
+    def watch_paths(self):
+        return [self.filepath]
+
+    def poll(self):
+        with self.write_lock:
+            try:
+                if file_signature(os.stat(self.filepath)) == self.signature:
+                    return None
+                signature, digest, data = self._read()
+                if digest == self.digest:
+                    # Touched or rewritten with the same content
+                    self.signature = signature
+                    return None
+                prompts = json.loads(data)
+            except FileNotFoundError:
+                return None
+            except (OSError, ValueError) as e:
+                # Probably caught mid-write by a non-atomic writer; the
+                # signature is left alone so the next poll retries
+                print(f"Error reading {self.filepath} for changes: {e}")
+                return None
+            changes = diff_prompts(self.disk_prompts, prompts)
+            self.disk_prompts = prompts
+            self.signature, self.digest = signature, digest
+            return changes
+
+    def put(self, shortcut, data):
+        self._schedule_save()
+
+    def delete(self, shortcut):
+        self._schedule_save()
+
+    def replace(self, old_prompts, new_prompts):
+        self._schedule_save()
+
+    def _schedule_save(self):
+        """Write-behind: coalesce changes arriving within write_delay into one write"""
+        with self.lock:
+            self.dirty = True
+            if self.write_delay <= 0 or self._save_timer is not None:
+                timer = None
+            else:
+                timer = self._save_timer = threading.Timer(self.write_delay, self.flush)
+                timer.daemon = True
+        if self.write_delay <= 0:
+            self.flush()
+        elif timer is not None:
+            timer.start()
+
+    def flush(self):
+        """Write pending changes to disk, if any"""
+        with self.write_lock:
+            with self.lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+            # Changes are reported after they are published, so this snapshot
+            # contains everything that marked the storage dirty
+            snapshot = self.snapshot_fn()
+            try:
+                self._write(snapshot)
+            except OSError as e:
+                print(f"Error saving prompts to {self.filepath}: {e}")
+                with self.lock:
+                    self.dirty = True
+
+    def _write(self, snapshot):
+        """Write a snapshot to disk; called by flush() with write_lock held"""
+        data = json.dumps(snapshot.to_dict(), indent=4).encode('utf-8')
+        stat = write_atomic(self.filepath, data)
+        self.disk_prompts = snapshot.prompts
+        self.signature = file_signature(stat)
+        self.digest = hashlib.blake2b(data, digest_size=16).digest()
+
+
+def create_storage(filepath="prompts.json", kind=None, write_delay=0.5):
+    """
+    Create the storage engine selected by the arguments or the environment.
+
+    Args:
+        filepath: The prompts.json path; other engines keep their files next
+                  to it and migrate it on first use.
+        kind: "json", "journal", "sqlite" or "text" (defaults to
+              PROMPTMANAGER_STORAGE, then "json").
+        write_delay: Write-behind delay for the JSON and text engines.
+    """
+    kind = (kind or os.getenv("PROMPTMANAGER_STORAGE") or STORAGE_JSON).lower()
+    if kind == STORAGE_JSON:
+        return JsonStorage(filepath, write_delay)
+    if kind == STORAGE_JOURNAL:
+        from journal_storage import JournalStorage
+        return JournalStorage.from_env(filepath)
+    if kind == STORAGE_SQLITE:
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(filepath, os.getenv("PROMPTMANAGER_SQLITE_PATH"))
+    if kind == STORAGE_TEXT:
+        from text_store import TextStorage
+        return TextStorage.from_env(filepath, write_delay)
+    raise ValueError(f"Unknown prompt storage: {kind}")
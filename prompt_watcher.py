@@ -0,0 +1,201 @@
+"""
+File watching for cross-process prompt reloads.
+A watcher calls back whenever one of a set of files may have changed. On
+Linux, InotifyWatcher uses inotify (through ctypes, no extra dependency) on
+the files' directories, so atomic replace-by-rename is seen as well as
+in-place writes; bursts of events are coalesced into one callback.
+Elsewhere, PollingWatcher calls back on a fixed interval and leaves the
+cheap size/mtime check to the callback.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_inotify():
+    """Return libc with the inotify functions, or None where unavailable"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    """Calls callback() on a background thread when watched files may have changed"""
+
+    def __init__(self, paths, callback):
+        """
+        Initialize the watcher.
+
+        Args:
+            paths: Files to watch (they need not exist yet).
+            callback: Called without arguments; exceptions are printed.
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.stop_event = threading.Event()
+        self.worker = None
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            if not self.stop_event.is_set():
+                return
+            # Restarted right after stop(): let the old worker finish first
+            self.worker.join()
+        self.stop_event.clear()
+        self._open()
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _open(self):
+        """Acquire what the worker needs; called by start()"""
+
+    def _run(self):
+        raise NotImplementedError
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception as e:
+            print(f"Error handling file change: {e}")
+
+
+class PollingWatcher(FileWatcher):
+    """Calls back every interval seconds"""
+
+    def __init__(self, paths, callback, interval=1.0):
+        super().__init__(paths, callback)
+        self.interval = interval
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._notify()
+
+
+class InotifyWatcher(FileWatcher):
+    """Calls back on inotify events for the watched files"""
+
+    def __init__(self, paths, callback, libc, debounce=0.05, interval=30.0):
+        """
+        Initialize the watcher.
+
+        Args:
+            paths: Files to watch.
+            callback: Called after a burst of events has settled.
+            libc: C library from load_inotify().
+            debounce: Seconds of quiet before calling back.
+            interval: Also call back this often, in case an event was missed.
+        """
+        super().__init__(paths, callback)
+        self.libc = libc
+        self.debounce = debounce
+        self.interval = interval
+        self.fd = None
+        self.names = {}  # watch descriptor -> names of interest in that directory
+        # Opened here so an unusable inotify fails now and create_watcher()
+        # can fall back to polling
+        self._open()
+
+    def _open(self):
+        """Create the inotify descriptor and watches, unless they are open already"""
+        if self.fd is not None:
+            return
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        names = {}
+        for path in self.paths:
+            directory, name = os.path.split(path)
+            wd = self.libc.inotify_add_watch(fd, directory.encode(), WATCH_MASK)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+            names.setdefault(wd, set()).add(name.encode())
+        self.fd = fd
+        self.names = names
+
+    def _relevant(self, data):
+        offset = 0
+        relevant = False
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW or name in self.names.get(wd, ()):
+                relevant = True
+        return relevant
+
+    def _read_events(self, timeout):
+        """Wait up to timeout for events; returns whether any concern our files"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            return self._relevant(os.read(self.fd, 64 * 1024))
+        except BlockingIOError:
+            return False
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                # Short select timeouts so stop() takes effect promptly
+                waited = 0.0
+                changed = False
+                while not changed and waited < self.interval and not self.stop_event.is_set():
+                    changed = self._read_events(0.5)
+                    waited += 0.5
+                if self.stop_event.is_set():
+                    return
+                # Let the writer finish (e.g. write then rename) before reacting
+                while changed and self._read_events(self.debounce):
+                    pass
+                self._notify()
+        finally:
+            # start() opens a new one if the watcher is restarted
+            os.close(self.fd)
+            self.fd = None
+
+
+def create_watcher(paths, callback, interval=1.0):
+    """
+    Create an inotify watcher where available, else a polling one.
+
+    Args:
+        paths: Files to watch.
+        callback: Called without arguments when the files may have changed.
+        interval: Polling interval for the fallback watcher.
+    """
+    libc = load_inotify()
+    if libc is not None:
+        try:
+            return InotifyWatcher(paths, callback, libc)
+        except OSError as e:
+            print(f"inotify unavailable ({e}); polling for prompt changes")
+    return PollingWatcher(paths, callback, interval)
@@ -0,0 +1,402 @@
+"""
+Quota-aware scheduling of enhancement requests.
+Sits in front of GeminiClient: every API call first takes tokens from
+per-model request (RPM) and token (TPM) buckets, rate-limit and server errors
+are retried with jittered exponential backoff, and a request that is still
+running after a deadline can be hedged to a fallback model. Failures are
+raised, never returned as text, so callers can decide what the user sees.
+"""
+import http.client
+import os
+import queue
+import random
+import re
+import threading
+import time
+from metrics import metrics
+from gemini_client import ENHANCEMENT_TEMPLATE
+
+QUOTA_WAIT_SECONDS = metrics.histogram('promptmanager_quota_wait_seconds',
+                                       'Time enhancement requests waited for rate-limit tokens')
+RETRIES = metrics.counter('promptmanager_enhancement_retries_total',
+                          'Enhancement requests retried after a rate-limit or server error')
+HEDGES = metrics.counter('promptmanager_enhancement_hedges_total',
+                         'Enhancement requests hedged to the fallback model')
+HEDGE_WINS = metrics.counter('promptmanager_enhancement_hedge_wins_total',
+                             'Hedged enhancement requests answered by the fallback model')
+
+# Published free-tier limits: (requests per minute, tokens per minute).
+# GEMINI_RPM / GEMINI_TPM override them for every model.
+MODEL_LIMITS = {
+    'gemini-2.5-pro': (5, 250000),
+    'gemini-pro-latest': (5, 250000),
+    'gemini-2.5-flash': (10, 250000),
+    'gemini-flash-latest': (10, 250000),
+    'gemini-2.0-flash': (15, 1000000),
+    'gemini-2.0-flash-001': (15, 1000000),
+    'gemini-2.0-flash-lite': (30, 1000000),
+}
+DEFAULT_LIMITS = (10, 250000)
+
+RETRY_AFTER = re.compile(r'retry in ([\d.]+)\s*s|retry_delay\s*\{\s*seconds:\s*(\d+)', re.IGNORECASE)
+
+
+class QuotaExceededError(Exception):
+    """Raised when a request would have to wait longer than allowed for quota"""
+
+    code = 429
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)"""
+    return max(1, len(text) // 4)
+
+
+def is_rate_limit_error(error):
+    """True for errors that mean "slow down" rather than "this request is bad\""""
+    if getattr(error, 'code', None) == 429:
+        return True
+    message = str(error).lower()
+    return ('429' in message or 'rate limit' in message or 'quota' in message
+            or 'resource exhausted' in message or 'resource_exhausted' in message)
+
+
+def is_retryable_error(error):
+    """Rate limits, server errors and dropped connections are worth retrying"""
+    code = getattr(error, 'code', None)
+    if is_rate_limit_error(error) or (isinstance(code, int) and code >= 500):
+        return True
+    return isinstance(error, (ConnectionError, TimeoutError, http.client.HTTPException))
+
+
+def retry_after(error):
+    """Delay in seconds requested by the server, if the error carries one"""
+    value = getattr(error, 'retry_after', None)
+    if value is not None:
+        return float(value)
+    match = RETRY_AFTER.search(str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return None
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously"""
+
+    def __init__(self, rate, capacity):
+        """
+        Initialize the bucket (full).
+
+        Args:
+            rate: Tokens added per second.
+            capacity: Maximum number of tokens (the allowed burst).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1, deadline=None):
+        """
+        Take tokens, waiting for them if necessary.
+
+        Args:
+            amount: Tokens to take (capped at the capacity).
+            deadline: time.monotonic() value after which to give up.
+
+        Returns:
+            True when the tokens were taken, False if the deadline would pass.
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return True
+                wait = (amount - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def debit(self, amount):
+        """Charge tokens after the fact; the balance may go negative"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server reported a rate limit"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0)
+
+
+class RequestScheduler:
+    """Rate-limited, retrying, optionally hedging front end for GeminiClient"""
+
+    def __init__(self, gemini_client, rpm=None, tpm=None, max_retries=3, base_delay=1.0,
+                 max_delay=30.0, max_wait=30.0, hedge_after=None, fallback_model=None,
+                 output_tokens=300):
+        """
+        Initialize the scheduler.
+
+        Args:
+            gemini_client: The GeminiClient to send requests through.
+            rpm: Requests per minute for every model (defaults to MODEL_LIMITS).
+            tpm: Tokens per minute for every model (defaults to MODEL_LIMITS).
+            max_retries: Retries after a rate-limit, server or connection error.
+            base_delay: Backoff before the first retry, doubled per retry;
+                        each delay is drawn uniformly below the cap (full jitter).
+            max_delay: Upper bound for a single backoff.
+            max_wait: Longest a request waits for quota before failing with
+                      QuotaExceededError.
+            hedge_after: Seconds after which a request with no answer yet
+                         (or no first chunk, when streaming) is also sent to
+                         the fallback model; the first answer wins.
+            fallback_model: Model used for hedging and after the current
+                            model fails.
+            output_tokens: Expected response size, reserved up front.
+        """
+        self.gemini_client = gemini_client
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.hedge_after = hedge_after
+        self.fallback_model = fallback_model
+        self.output_tokens = output_tokens
+        self.prompt_tokens = estimate_tokens(ENHANCEMENT_TEMPLATE)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, gemini_client):
+        """
+        Build a scheduler configured from GEMINI_RPM, GEMINI_TPM,
+        GEMINI_MAX_RETRIES, GEMINI_HEDGE_AFTER_MS and GEMINI_FALLBACK_MODEL.
+        """
+        def number(name, convert=float):
+            value = os.getenv(name)
+            return convert(value) if value else None
+
+        hedge_ms = number("GEMINI_HEDGE_AFTER_MS")
+        max_retries = number("GEMINI_MAX_RETRIES", int)
+        return cls(
+            gemini_client,
+            rpm=number("GEMINI_RPM"),
+            tpm=number("GEMINI_TPM"),
+            max_retries=3 if max_retries is None else max_retries,
+            hedge_after=hedge_ms / 1000.0 if hedge_ms else None,
+            fallback_model=os.getenv("GEMINI_FALLBACK_MODEL") or None,
+        )
+
+    def limits_for(self, model_name):
+        rpm, tpm = MODEL_LIMITS.get(model_name, DEFAULT_LIMITS)
+        return self.rpm or rpm, self.tpm or tpm
+
+    def _buckets_for(self, model_name):
+        with self.lock:
+            buckets = self.buckets.get(model_name)
+            if buckets is None:
+                rpm, tpm = self.limits_for(model_name)
+                buckets = self.buckets[model_name] = (TokenBucket(rpm / 60.0, rpm),
+                                                      TokenBucket(tpm / 60.0, tpm))
+            return buckets
+
+    def _acquire(self, model_name, tokens):
+        requests, token_bucket = self._buckets_for(model_name)
+        started = time.monotonic()
+        deadline = started + self.max_wait if self.max_wait is not None else None
+        if not (requests.acquire(1, deadline) and token_bucket.acquire(tokens, deadline)):
+            raise QuotaExceededError(f"Rate limit for {model_name} reached; try again shortly")
+        if metrics.enabled:
+            QUOTA_WAIT_SECONDS.observe(time.monotonic() - started)
+
+    def _estimate(self, text):
+        return self.prompt_tokens + estimate_tokens(text) + self.output_tokens
+
+    def _settle(self, model_name, text_out):
+        """Charge for output beyond the reservation"""
+        extra = estimate_tokens(text_out) - self.output_tokens
+        if extra > 0:
+            self._buckets_for(model_name)[1].debit(extra)
+
+    def _with_retries(self, model_name, tokens, call):
+        """Run call() under the model's quota, retrying transient failures"""
+        for attempt in range(self.max_retries + 1):
+            self._acquire(model_name, tokens)
+            try:
+                return call()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                if is_rate_limit_error(e):
+                    # Everyone sharing this model's quota should back off
+                    for bucket in self._buckets_for(model_name):
+                        bucket.drain()
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                RETRIES.inc()
+                print(f"Enhancement request failed ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _hedge_model(self, model_name):
+        if self.fallback_model and self.fallback_model != model_name:
+            return self.fallback_model
+        return None
+
+    def cached_enhancement(self, text):
+        return self.gemini_client.cached_enhancement(text)
+
+    def enhance_prompt(self, text, force_refresh=False):
+        """String-returning variant for callers that display errors inline"""
+        try:
+            return self.generate_enhancement(text, force_refresh)
+        except Exception as e:
+            return f"Error enhancing prompt: {str(e)}"
+
+    def generate_enhancement(self, text, force_refresh=False):
+        """
+        Enhance the text under the rate limits.
+
+        Raises:
+            QuotaExceededError: If quota stays exhausted for max_wait seconds.
+            Exception: The last error once retries (and any fallback) failed.
+        """
+        if not force_refresh:
+            cached = self.gemini_client.cached_enhancement(text)
+            if cached is not None:
+                return cached
+        model_name = self.gemini_client.model_name
+        if model_name is None:
+            raise RuntimeError("Gemini API Key not configured.")
+        tokens = self._estimate(text)
+
+        def generate(name):
+            result = self._with_retries(name, tokens, lambda: self.gemini_client.generate_enhancement(
+                text, force_refresh=True, model_name=name))
+            self._settle(name, result)
+            return result
+
+        fallback = self._hedge_model(model_name)
+        if fallback is None:
+            return generate(model_name)
+        return self._race(model_name, fallback, generate)
+
+    def enhance_prompt_stream(self, text, force_refresh=False):
+        """
+        Stream the enhancement under the rate limits. Retries (and hedging)
+        only happen before the first chunk; later errors are raised.
+        """
+        if not force_refresh:
+            cached = self.gemini_client.cached_enhancement(text)
+            if cached is not None:
+                yield cached
+                return
+        model_name = self.gemini_client.model_name
+        if model_name is None:
+            raise RuntimeError("Gemini API Key not configured.")
+        tokens = self._estimate(text)
+
+        def open_stream(name):
+            def first_chunk():
+                stream = self.gemini_client.enhance_prompt_stream(text, force_refresh=True, model_name=name)
+                try:
+                    return next(stream), stream
+                except StopIteration:
+                    return '', None
+                except Exception:
+                    stream.close()
+                    raise
+            return name, self._with_retries(name, tokens, first_chunk)
+
+        fallback = self._hedge_model(model_name)
+        if fallback is None:
+            name, (first, stream) = open_stream(model_name)
+        else:
+            name, (first, stream) = self._race(model_name, fallback, open_stream,
+                                               discard=lambda opened: opened[1][1] and opened[1][1].close())
+        chunks = [first]
+        try:
+            if first:
+                yield first
+            if stream is not None:
+                for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+        finally:
+            if stream is not None:
+                stream.close()
+        self._settle(name, ''.join(chunks))
+
+    def _race(self, model_name, fallback, run, discard=None):
+        """
+        Run run(model_name); start run(fallback) too if it hasn't succeeded
+        within hedge_after seconds (or fails). Returns the first success.
+
+        Args:
+            discard: Called with the losing result if it succeeds later.
+        """
+        results = queue.SimpleQueue()
+        state = {'winner': None}
+        state_lock = threading.Lock()
+
+        def attempt(name):
+            try:
+                result = run(name)
+            except Exception as e:
+                results.put((name, None, e))
+                return
+            with state_lock:
+                lost = state['winner'] is not None
+                if not lost:
+                    state['winner'] = name
+            if lost:
+                if discard:
+                    discard(result)
+                return
+            results.put((name, result, None))
+
+        def launch(name):
+            thread = threading.Thread(target=attempt, args=(name,))
+            thread.daemon = True
+            thread.start()
+
+        launch(model_name)
+        outstanding = 1
+        fallback_started = False
+        errors = []
+        while True:
+            # Without hedge_after the fallback only runs after a failure
+            timeout = self.hedge_after if not fallback_started else None
+            try:
+                name, result, error = results.get(timeout=timeout)
+            except queue.Empty:
+                HEDGES.inc()
+                fallback_started = True
+                launch(fallback)
+                outstanding += 1
+                continue
+            outstanding -= 1
+            if error is None:
+                if name == fallback:
+                    HEDGE_WINS.inc()
+                return result
+            errors.append(error)
+            if not fallback_started:
+                print(f"Enhancement with {model_name} failed ({error}); trying {fallback}")
+                fallback_started = True
+                launch(fallback)
+                outstanding += 1
+            elif outstanding == 0:
+                raise errors[0]
@@ -0,0 +1,203 @@
+"""
+Speculative pre-enhancement for the keyboard listener.
+When the keystroke buffer has been idle for a short pause and looks like a
+sentence, the text is enhanced in the background on the engine's
+low-priority worker. The result lands in the enhancement cache (keyed by the
+normalized buffer text), so typing the trigger on unchanged text injects it
+immediately; a trigger arriving while the speculation is still running joins
+it instead of starting a second request.
+"""
+import threading
+import time
+from collections import deque
+from enhancement_cache import normalize_text
+from metrics import metrics
+
+SPECULATIONS = metrics.counter('promptmanager_speculations_total',
+                               'Speculative enhancements started')
+SPECULATION_HITS = metrics.counter('promptmanager_speculation_hits_total',
+                                   'Enhancement triggers served by a speculation')
+SPECULATION_MISSES = metrics.counter('promptmanager_speculation_misses_total',
+                                     'Enhancement triggers on text that was not speculated')
+SPECULATIONS_CANCELLED = metrics.counter('promptmanager_speculations_cancelled_total',
+                                         'Speculations abandoned because the text changed')
+SPECULATIONS_SKIPPED = metrics.counter('promptmanager_speculations_over_budget_total',
+                                       'Speculations skipped because the hourly budget was spent')
+
+
+def looks_like_sentence(text, min_words=3, min_chars=12):
+    """Heuristic for text worth enhancing: a few real words, not a trigger in progress"""
+    text = text.strip()
+    if len(text) < min_chars or '`' in text[-4:]:
+        return False
+    words = text.split()
+    if len(words) < min_words:
+        return False
+    letters = sum(1 for char in text if char.isalpha())
+    return letters >= len(text) / 2
+
+
+class SpeculativeEnhancer:
+    """Starts background enhancements for idle, sentence-like buffer contents"""
+
+    def __init__(self, engine, text_fn, idle_seconds=0.8, budget_per_hour=60,
+                 min_words=3, min_chars=12):
+        """
+        Initialize the speculator.
+
+        Args:
+            engine: EnhancementEngine used for the background requests.
+            text_fn: Returns the current buffer text. It is called from the
+                     speculation thread, so the result is only trusted if no
+                     keystroke arrived while reading it.
+            idle_seconds: Pause after the last keystroke before speculating.
+            budget_per_hour: Maximum number of speculative API requests per
+                             hour (cache hits don't count).
+            min_words: Minimum number of words worth speculating on.
+            min_chars: Minimum text length worth speculating on.
+        """
+        self.engine = engine
+        self.text_fn = text_fn
+        self.idle_seconds = idle_seconds
+        self.budget_per_hour = budget_per_hour
+        self.min_words = min_words
+        self.min_chars = min_chars
+        self.generation = 0  # Bumped for every keystroke
+        self.last_activity = time.monotonic()
+        self.checked_generation = 0
+        self.current = None  # (normalized text, text, future) of the live speculation
+        self.spent = deque()  # Start times of recent speculative requests
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.worker = None
+        self.hits = 0
+        self.misses = 0
+
+    def note_activity(self):
+        """Record a keystroke (called on the listener's worker thread; must stay cheap)"""
+        self.generation += 1
+        self.last_activity = time.monotonic()
+        self.wakeup.set()
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            return
+        self.stop_event.clear()
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        self.cancel()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            # Sleep until a keystroke arrives, then until the pause elapses
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while not self.stop_event.is_set():
+                remaining = self.last_activity + self.idle_seconds - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.stop_event.wait(remaining)
+            if self.stop_event.is_set():
+                return
+            try:
+                self._check()
+            except Exception as e:
+                print(f"Error in speculative enhancement: {e}")
+
+    def _check(self):
+        generation = self.generation
+        if generation == self.checked_generation:
+            return
+        text = self.text_fn().strip()
+        if generation != self.generation:
+            # Typing resumed while reading; the next pause will retry
+            return
+        self.checked_generation = generation
+        if looks_like_sentence(text, self.min_words, self.min_chars):
+            self.speculate(text)
+        else:
+            self.cancel()
+
+    def _take_budget(self):
+        now = time.monotonic()
+        while self.spent and now - self.spent[0] > 3600:
+            self.spent.popleft()
+        if len(self.spent) >= self.budget_per_hour:
+            return False
+        self.spent.append(now)
+        return True
+
+    def speculate(self, text):
+        """Enhance text in the background, replacing any stale speculation"""
+        key = normalize_text(text)
+        with self.lock:
+            if self.current is not None and self.current[0] == key:
+                return
+        self.cancel()
+        if self.engine.gemini_client.cached_enhancement(text) is not None:
+            with self.lock:
+                self.current = (key, text, None)
+            return
+        with self.lock:
+            if not self._take_budget():
+                SPECULATIONS_SKIPPED.inc()
+                return
+        SPECULATIONS.inc()
+        future = self.engine.enhance(text, background=True)
+        with self.lock:
+            self.current = (key, text, future)
+
+    def cancel(self):
+        """Abandon the current speculation (it is cancelled if not started yet)"""
+        with self.lock:
+            current, self.current = self.current, None
+        if current is not None and current[2] is not None:
+            if not current[2].done():
+                SPECULATIONS_CANCELLED.inc()
+            self.engine.release(current[1])
+
+    def claim(self, text):
+        """
+        Record an enhancement trigger for text. Call it after the trigger's
+        own request has been submitted, so that request has already joined
+        a running speculation before the speculation's interest is released.
+
+        Returns:
+            True if the text matches the current speculation.
+        """
+        key = normalize_text(text)
+        with self.lock:
+            current = self.current
+            hit = current is not None and current[0] == key
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            SPECULATION_HITS.inc()
+            with self.lock:
+                if self.current is current:
+                    self.current = None
+            if current[2] is not None:
+                self.engine.release(current[1])
+        else:
+            SPECULATION_MISSES.inc()
+            self.cancel()
+        return hit
+
+    def stats(self):
+        with self.lock:
+            claims = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / claims if claims else None,
+                'spent_last_hour': len(self.spent),
+                'budget_per_hour': self.budget_per_hour,
+            }
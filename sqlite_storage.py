@@ -0,0 +1,270 @@
+"""
+SQLite storage for the prompt library, with full-text search.
+Prompts live in a WAL-mode database next to prompts.json. An FTS5 index over
+shortcut and text (kept in sync by triggers) answers ranked searches without
+shipping the library to the browser; on SQLite builds without FTS5, searches
+fall back to LIKE scans. The listener still matches triggers against the
+in-memory snapshot, so the database is only read at startup, for searches,
+and when another process has committed changes (PRAGMA data_version). Every
+write bumps a change counter and stamps the rows it writes (and tombstones
+for the ones it deletes) with it, so only those rows are read back.
+
+An existing prompts.json is imported in bulk the first time the database is
+created.
+"""
+import json
+import os
+import sqlite3
+import threading
+from prompt_storage import (MISSING, PromptStorage, STORAGE_SQLITE, prompt_text, read_json_prompts,
+                            search_terms)
+
+SCHEMA_VERSION = 1
+
+# Statements are kept as constants so sqlite3's statement cache reuses the
+# prepared versions
+UPSERT = ("INSERT INTO prompts (shortcut, text, data, changed) VALUES (?, ?, ?, ?)"
+          " ON CONFLICT(shortcut) DO UPDATE SET"
+          " text = excluded.text, data = excluded.data, changed = excluded.changed")
+DELETE = "DELETE FROM prompts WHERE shortcut = ?"
+TOMBSTONE = "INSERT OR REPLACE INTO deleted_prompts (shortcut, changed) VALUES (?, ?)"
+SELECT_ALL = "SELECT shortcut, data FROM prompts ORDER BY rowid"
+BUMP_COUNTER = "UPDATE prompt_changes SET counter = counter + 1"
+SELECT_COUNTER = "SELECT counter FROM prompt_changes"
+SELECT_CHANGED = "SELECT shortcut, data FROM prompts WHERE changed > ?"
+# A tombstone only counts if the prompt wasn't added again since
+SELECT_DELETED = ("SELECT shortcut FROM deleted_prompts WHERE changed > ?"
+                  " AND shortcut NOT IN (SELECT shortcut FROM prompts)")
+
+# Change tracking, added to databases created without it
+CHANGES_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS prompt_changes ("
+    " id INTEGER PRIMARY KEY CHECK (id = 0), counter INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO prompt_changes (id, counter) VALUES (0, 0)",
+    "CREATE TABLE IF NOT EXISTS deleted_prompts ("
+    " shortcut TEXT PRIMARY KEY, changed INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS prompts_changed ON prompts (changed)",
+)
+
+# Shortcut matches weigh ten times as much as text matches
+SEARCH_FTS = ("SELECT p.shortcut, p.data FROM prompts_fts f JOIN prompts p ON p.rowid = f.rowid"
+              " WHERE prompts_fts MATCH ? ORDER BY bm25(prompts_fts, 10.0, 1.0) LIMIT ?")
+SEARCH_LIKE = ("SELECT shortcut, data FROM prompts WHERE {conditions}"
+               " ORDER BY {in_shortcut} DESC, length(shortcut) LIMIT ?")
+
+FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5("
+    " shortcut, text, content='prompts', content_rowid='rowid',"
+    " tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS prompts_ai AFTER INSERT ON prompts BEGIN"
+    " INSERT INTO prompts_fts (rowid, shortcut, text) VALUES (new.rowid, new.shortcut, new.text);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS prompts_ad AFTER DELETE ON prompts BEGIN"
+    " INSERT INTO prompts_fts (prompts_fts, rowid, shortcut, text)"
+    " VALUES ('delete', old.rowid, old.shortcut, old.text);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS prompts_au AFTER UPDATE ON prompts BEGIN"
+    " INSERT INTO prompts_fts (prompts_fts, rowid, shortcut, text)"
+    " VALUES ('delete', old.rowid, old.shortcut, old.text);"
+    " INSERT INTO prompts_fts (rowid, shortcut, text) VALUES (new.rowid, new.shortcut, new.text);"
+    " END",
+)
+
+
+def fts_query(terms):
+    """FTS5 MATCH expression requiring every term as a prefix"""
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SqliteStorage(PromptStorage):
+    """Prompt library in SQLite (WAL mode) with an FTS5 search index"""
+
+    name = STORAGE_SQLITE
+
+    def __init__(self, filepath="prompts.json", db_path=None):
+        """
+        Initialize the engine.
+
+        Args:
+            filepath: The prompts.json path, imported when the database is
+                      first created.
+            db_path: Database file (defaults to prompts.db next to filepath).
+        """
+        self.filepath = filepath
+        self.db_path = db_path or os.path.splitext(filepath)[0] + ".db"
+        self.snapshot_fn = None
+        self.lock = threading.Lock()
+        self.db = None
+        self.has_fts = False
+        # Serialized data of every row as last read or written, for poll()
+        self.disk_rows = {}
+        self.data_version = None
+        # Change counter up to which every write has been seen
+        self.counter = 0
+
+    def _open(self):
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=64)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only risks the last commits on power loss, never corruption
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts ("
+            " shortcut TEXT PRIMARY KEY, text TEXT NOT NULL, data TEXT NOT NULL,"
+            " changed INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(prompts)")]
+        if 'changed' not in columns:
+            self.db.execute("ALTER TABLE prompts ADD COLUMN changed INTEGER NOT NULL DEFAULT 0")
+        for statement in CHANGES_SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def _create_index(self):
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'prompts_fts'").fetchone() is not None
+        try:
+            for statement in FTS_SCHEMA:
+                self.db.execute(statement)
+            if not exists:
+                # Index rows that were written before the index existed
+                self.db.execute("INSERT INTO prompts_fts (prompts_fts) VALUES ('rebuild')")
+            self.db.commit()
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5
+            print(f"Full-text prompt search unavailable ({e}); using LIKE queries")
+            self.db.rollback()
+
+    def load(self):
+        with self.lock:
+            self._open()
+            if self.db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._import_json()
+            # Created after the import, so a bulk import indexes in one pass
+            # instead of firing the triggers per row
+            self._create_index()
+            self.data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            self.counter = self.db.execute(SELECT_COUNTER).fetchone()[0]
+            self.disk_rows = dict(self.db.execute(SELECT_ALL))
+            return {shortcut: json.loads(data) for shortcut, data in self.disk_rows.items()}
+
+    def _import_json(self):
+        prompts = read_json_prompts(self.filepath)
+        with self.db:
+            self.db.executemany(UPSERT, self._rows(prompts.items(), 0))
+            self.db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        if prompts:
+            print(f"Imported {len(prompts)} prompts from {self.filepath} into {self.db_path}")
+
+    @staticmethod
+    def _rows(items, change):
+        for shortcut, data in items:
+            yield shortcut, prompt_text(data) or '', json.dumps(data), change
+
+    def _next_change(self):
+        """Bump the change counter in the current transaction; return the new value"""
+        # Must be called with self.lock held
+        self.db.execute(BUMP_COUNTER)
+        change = self.db.execute(SELECT_COUNTER).fetchone()[0]
+        if change == self.counter + 1:
+            # Nobody else wrote in between, so there's nothing to read back
+            self.counter = change
+        return change
+
+    def put(self, shortcut, data):
+        with self.lock, self.db:
+            row = next(self._rows([(shortcut, data)], self._next_change()))
+            self.db.execute(UPSERT, row)
+            self.disk_rows[shortcut] = row[2]
+
+    def delete(self, shortcut):
+        with self.lock, self.db:
+            change = self._next_change()
+            self.db.execute(DELETE, (shortcut,))
+            self.db.execute(TOMBSTONE, (shortcut, change))
+            self.disk_rows.pop(shortcut, None)
+
+    def replace(self, old_prompts, new_prompts):
+        # Write only the difference, in one transaction
+        deleted = [key for key in old_prompts if key not in new_prompts]
+        changed = [(key, value) for key, value in new_prompts.items()
+                   if key not in old_prompts or old_prompts[key] != value]
+        with self.lock, self.db:
+            change = self._next_change()
+            rows = list(self._rows(changed, change))
+            self.db.executemany(DELETE, [(key,) for key in deleted])
+            self.db.executemany(TOMBSTONE, [(key, change) for key in deleted])
+            self.db.executemany(UPSERT, rows)
+            for key in deleted:
+                self.disk_rows.pop(key, None)
+            self.disk_rows.update((row[0], row[2]) for row in rows)
+
+    def watch_paths(self):
+        # Commits land in the WAL file first
+        return [self.db_path, self.db_path + "-wal"]
+
+    def poll(self):
+        with self.lock:
+            if self.db is None:
+                return None
+            # data_version only moves when another connection commits
+            version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return None
+            self.data_version = version
+            counter = self.db.execute(SELECT_COUNTER).fetchone()[0]
+            if counter == self.counter:
+                return None
+            # Only rows written or deleted since the last poll are read.
+            # Commits landing meanwhile are read again next time, and rows
+            # that match disk_rows (e.g. our own writes) are skipped.
+            rows = self.db.execute(SELECT_CHANGED, (self.counter,)).fetchall()
+            deleted = self.db.execute(SELECT_DELETED, (self.counter,)).fetchall()
+            self.counter = counter
+            changes = []
+            for key, data in rows:
+                old = self.disk_rows.get(key)
+                if old != data:
+                    self.disk_rows[key] = data
+                    changes.append((key, json.loads(old) if old is not None else MISSING, json.loads(data)))
+            for (key,) in deleted:
+                old = self.disk_rows.pop(key, None)
+                if old is not None:
+                    changes.append((key, json.loads(old), MISSING))
+        return changes or None
+
+    def search(self, query, limit=20):
+        """
+        Ranked search over shortcuts and prompt text. Every word of query
+        must match (as a prefix); shortcut matches rank first.
+
+        Returns:
+            Up to limit (shortcut, prompt data) pairs, best matches first.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        with self.lock:
+            if self.has_fts:
+                rows = self.db.execute(SEARCH_FTS, (fts_query(terms), limit)).fetchall()
+            else:
+                rows = self._search_like(terms, limit)
+        return [(shortcut, json.loads(data)) for shortcut, data in rows]
+
+    def _search_like(self, terms, limit):
+        # Substring rather than prefix matching, which is close enough here
+        patterns = ['%' + escape_like(term) + '%' for term in terms]
+        conditions = ' AND '.join(["(shortcut LIKE ? ESCAPE '\\' OR text LIKE ? ESCAPE '\\')"] * len(terms))
+        in_shortcut = ' AND '.join(["shortcut LIKE ? ESCAPE '\\'"] * len(terms))
+        sql = SEARCH_LIKE.format(conditions=conditions, in_shortcut=f"({in_shortcut})")
+        params = [p for pattern in patterns for p in (pattern, pattern)] + patterns + [limit]
+        return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
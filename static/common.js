@@ -121,6 +121,34 @@ function addToRecent(shortcut) {
     recent.unshift(shortcut);
     recent = recent.slice(0, MAX_RECENT);
     localStorage.setItem(RECENT_PROMPTS_KEY, JSON.stringify(recent));
+    trackUsageOnServer(shortcut);
+}
+
+async function trackUsageOnServer(shortcut) {
+    try {
+        await fetch('/api/prompts/track-usage', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ shortcut: shortcut })
+        });
+    } catch (error) {
+        console.error('Failed to track usage on server:', error);
+    }
+}
+
+// Replace the local recent list with the server's, which also includes
+// shortcuts expanded by the keyboard listener and other browsers
+async function syncRecentFromServer() {
+    try {
+        const response = await fetch(`/api/usage/recent?limit=${MAX_RECENT}`);
+        if (!response.ok) return;
+        const recent = await response.json();
+        if (recent.length > 0) {
+            localStorage.setItem(RECENT_PROMPTS_KEY, JSON.stringify(recent.map(r => r.shortcut)));
+        }
+    } catch (error) {
+        console.error('Failed to load recent prompts from server:', error);
+    }
 }
 
 async function loadSettings() {
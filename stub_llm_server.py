@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for an LLM API, for offline development and load testing.
+
+Speaks the protocol used by llm_backends.HTTPBackend:
+    GET  /v1/models    -> {"models": ["stub-fast", ...]}
+    POST /v1/generate  {"model", "prompt", "stream"}
+                       -> {"text": ...}, or newline-delimited {"text": chunk}
+                          objects when streaming
+
+Latency, streaming pace and error rate are configurable, so enhancement
+throughput and tail latency can be measured without network access.
+
+Usage:
+    python stub_llm_server.py --port 8765 --latency 0.3 --chunk-delay 0.02 --error-rate 0.05
+    PROMPTMANAGER_LLM_BACKEND=http PROMPTMANAGER_LLM_URL=http://127.0.0.1:8765 python main.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_MODELS = ("stub-fast", "stub-pro")
+
+USER_INPUT = re.compile(r'User Input: "(.*?)"', re.DOTALL)
+
+
+def fake_enhancement(prompt):
+    """Deterministic, enhancement-shaped response for a prompt"""
+    match = USER_INPUT.search(prompt)
+    text = (match.group(1) if match else prompt).strip()[:200]
+    return (f"Perform the following task in the current project: {text}. "
+            "First inspect the relevant files, then make the change, "
+            "and verify the result before finishing.")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        line = json.dumps(data).encode('utf-8') + b'\n'
+        self.wfile.write(f"{len(line):x}\r\n".encode('ascii') + line + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/v1/models':
+            self._send_json(200, {'models': list(self.server.models)})
+        else:
+            self._send_json(404, {'error': f"{self.path} not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': 'invalid JSON'})
+            return
+        if self.path.rstrip('/') != '/v1/generate':
+            self._send_json(404, {'error': f"{self.path} not found"})
+            return
+
+        server = self.server
+        server.count_request()
+        model = request.get('model')
+        if model not in server.models:
+            self._send_json(404, {'error': f"model {model} not found"})
+            return
+        if server.roll_error():
+            time.sleep(server.delay(server.latency) / 2)
+            headers = {'Retry-After': f"{server.retry_after:g}"} if server.error_status == 429 else None
+            self._send_json(server.error_status, {'error': 'simulated failure'}, headers)
+            return
+
+        words = fake_enhancement(request.get('prompt', '')).split(' ')
+        chunks = [' '.join(words[i:i + server.words_per_chunk]) + ' '
+                  for i in range(0, len(words), server.words_per_chunk)]
+        time.sleep(server.delay(server.latency))
+
+        if not request.get('stream'):
+            time.sleep(server.delay(server.chunk_delay) * (len(chunks) - 1))
+            self._send_json(200, {'text': ''.join(chunks).strip()})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(server.delay(server.chunk_delay))
+            self._write_chunk({'text': chunk})
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """Threaded stub LLM server with simulated latency and failures"""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=8765, latency=0.3, chunk_delay=0.02,
+                 jitter=0.2, error_rate=0.0, error_status=503, models=DEFAULT_MODELS,
+                 words_per_chunk=4, seed=None, verbose=False, retry_after=1.0):
+        """
+        Initialize the server.
+
+        Args:
+            host: Interface to bind.
+            port: Port to bind (0 picks a free one).
+            latency: Seconds before the first chunk.
+            chunk_delay: Seconds between streamed chunks.
+            jitter: Random +/- fraction applied to every delay.
+            error_rate: Fraction of generate requests that fail.
+            error_status: HTTP status returned for simulated failures.
+            models: Model names reported and accepted.
+            words_per_chunk: Words per streamed chunk.
+            seed: Seed for the jitter and error randomness.
+            verbose: Log every request.
+            retry_after: Retry-After seconds sent with simulated 429s.
+        """
+        super().__init__((host, port), StubHandler)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.models = tuple(models)
+        self.words_per_chunk = max(1, words_per_chunk)
+        self.verbose = verbose
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self):
+        with self.random_lock:
+            self.requests += 1
+
+    def roll_error(self):
+        with self.random_lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self, seconds):
+        if seconds <= 0:
+            return 0
+        with self.random_lock:
+            return max(0.0, seconds * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def start(self):
+        """Serve on a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.3, help='Seconds before the first chunk')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='Seconds between streamed chunks')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Random +/- fraction applied to delays')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status for simulated failures')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with 429s')
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS), help='Comma-separated model names')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = StubLLMServer(args.host, args.port, args.latency, args.chunk_delay, args.jitter,
+                           args.error_rate, args.error_status,
+                           [model for model in args.models.split(',') if model],
+                           seed=args.seed, verbose=args.verbose, retry_after=args.retry_after)
+    print(f"Stub LLM server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
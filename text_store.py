@@ -0,0 +1,475 @@
+"""
+Trigger index plus memory-mapped text storage for large prompt libraries.
+
+The library lives in two kinds of files next to prompts.json:
+    prompts.index.json  every prompt's shortcut, prepend, postpend and the
+                        offset/length of its body, written atomically
+    prompts.<n>.text    the bodies (UTF-8), appended to and read via mmap
+
+Loading parses only the index, so startup time and memory depend on the
+number of prompts rather than on how long their bodies are. Prompts are
+loaded as StoredPromptRecords, which decode their body from the mapped file
+each time it is asked for - when an expansion fires or the API returns the
+prompt - so bodies stay in the page cache instead of the heap.
+
+Saving appends the bodies of new or edited prompts to the text file and
+rewrites the index (write-behind, like the JSON engine). Bodies that were
+replaced are left behind until the text file grows past a multiple of the
+live text; it is then rewritten as the next generation (prompts.<n+1>.text)
+and the index switched over to it, so a crash never leaves the index
+pointing at missing text.
+
+Several processes can share the files: saves are serialized with a lock
+file, a process that finds a newer index merges its changes and picks up its
+text file before appending, and text files removed by a compaction stay
+readable through the mappings that still use them.
+
+An existing prompts.json is imported on first use; it is left in place but
+no longer updated.
+"""
+import contextlib
+import json
+import mmap
+import os
+import re
+import sys
+import threading
+from prompt_records import PromptRecord, records_from_prompts
+from prompt_storage import (MISSING, JsonStorage, STORAGE_TEXT, file_signature, fsync_directory,
+                            read_json_prompts, write_atomic)
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+INDEX_FORMAT = "promptmanager-text-index"
+NON_ASCII = re.compile(rb"[\x80-\xff]")
+
+
+class TextBlob:
+    """An append-only file of prompt bodies, read through mmap"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        # Kept open so the text stays readable if a compaction removes the file
+        self.file = open(path, 'rb')
+        self.lock = threading.Lock()
+        self.map = None
+        self.mapped = 0
+
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def read_bytes(self, offset, length):
+        if not length:
+            return b''
+        end = offset + length
+        return self._view(end)[offset:end]
+
+    def search(self, pattern, offset, length):
+        """Search the mapped text for a bytes regex without copying it out"""
+        if not length:
+            return None
+        end = offset + length
+        return pattern.search(self._view(end), offset, end)
+
+    def read(self, offset, length):
+        return self.read_bytes(offset, length).decode('utf-8')
+
+    def _view(self, end):
+        view = self.map
+        if view is None or end > self.mapped:
+            view = self._remap(end)
+        return view
+
+    def _remap(self, end):
+        # Text appended since the file was mapped needs a larger mapping.
+        # The old one is left to readers still holding it.
+        with self.lock:
+            if self.map is None or end > self.mapped:
+                size = self.size()
+                if end > size:
+                    raise ValueError(f"{self.name} is shorter than its index ({size} < {end} bytes)")
+                self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+                self.mapped = size
+            return self.map
+
+    def append(self, data, offset):
+        """Append data (expected to land at offset) and sync it to disk"""
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            if os.fstat(fd).st_size != offset:
+                raise OSError(f"{self.name} changed size while appending")
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class StoredPromptRecord(PromptRecord):
+    """A PromptRecord whose body is read from a TextBlob when needed"""
+
+    __slots__ = ('blob', 'offset', 'length')
+
+    lazy_text = True
+
+    def __init__(self, shortcut, prepend, postpend, blob, offset, length, extra=None):
+        self.shortcut = shortcut
+        self.prepend = sys.intern(prepend)
+        self.postpend = sys.intern(postpend)
+        self.trigger = prepend + shortcut + postpend
+        self.extra = extra or None
+        self.blob = blob
+        self.offset = offset
+        self.length = length
+
+    @property
+    def text(self):
+        return self.blob.read(self.offset, self.length)
+
+    def same_text(self, other):
+        if not other.lazy_text:
+            text = other.text
+            # A UTF-8 body is 1 to 4 bytes per character
+            if not len(text) <= self.length <= 4 * len(text):
+                return False
+            return self.blob.read_bytes(self.offset, self.length) == text.encode('utf-8')
+        if self.length != other.length:
+            return False
+        if self.blob is other.blob and self.offset == other.offset:
+            return True
+        return self.blob.read_bytes(self.offset, self.length) == other.blob.read_bytes(other.offset, other.length)
+
+    def contains(self, pattern):
+        """Whether a bytes regex matches somewhere in the body, without decoding it"""
+        return self.blob.search(pattern, self.offset, self.length) is not None
+
+
+class TextStorage(JsonStorage):
+    """Trigger index in JSON, prompt bodies in memory-mapped text files"""
+
+    name = STORAGE_TEXT
+
+    def __init__(self, filepath="prompts.json", write_delay=0.5, compact_ratio=2.0,
+                 min_compact_bytes=1024 * 1024):
+        """
+        Initialize the engine.
+
+        Args:
+            filepath: The prompts.json path. The index and text files are
+                      stored next to it, and it is imported if there is no
+                      index yet.
+            write_delay: Seconds to collect further changes before saving
+                         them in one go. 0 saves on every change.
+            compact_ratio: Rewrite the text file once it is larger than this
+                           multiple of the text still in use.
+            min_compact_bytes: Never rewrite text files smaller than this.
+        """
+        super().__init__(filepath, write_delay)
+        root = os.path.splitext(filepath)[0]
+        self.index_path = root + ".index.json"
+        self.lock_path = root + ".text.lock"
+        self.directory = os.path.dirname(os.path.abspath(filepath))
+        self.text_pattern = re.compile(re.escape(os.path.basename(root)) + r"\.(\d+)\.text$")
+        self.compact_ratio = compact_ratio
+        self.min_compact_bytes = min_compact_bytes
+        self.blob = None
+        self.generation = 0
+        # The prompts as of the index last read or written, for poll() and
+        # for finding text that is already on disk
+        self.disk_records = {}
+        # shortcut -> (record, offset, length) for saved records that aren't
+        # StoredPromptRecords of the current text file
+        self.spans = {}
+        # Changes another process saved that were merged into our own save
+        # before poll() reported them; kept (and re-merged) until it does
+        self.merged_changes = []
+
+    @classmethod
+    def from_env(cls, filepath="prompts.json", write_delay=0.5):
+        """Create an engine configured by PROMPTMANAGER_TEXT_* variables"""
+        return cls(
+            filepath, write_delay,
+            compact_ratio=float(os.getenv("PROMPTMANAGER_TEXT_COMPACT_RATIO", "2.0")),
+            min_compact_bytes=int(os.getenv("PROMPTMANAGER_TEXT_MIN_COMPACT_BYTES", str(1024 * 1024))),
+        )
+
+    @contextlib.contextmanager
+    def _process_lock(self):
+        """Hold the cross-process lock serializing saves"""
+        if not HAS_FCNTL:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _text_path(self, generation):
+        root = os.path.splitext(os.path.basename(self.filepath))[0]
+        return os.path.join(self.directory, f"{root}.{generation}.text")
+
+    def _read_index(self):
+        """
+        Return (signature, index dict) for the index file, or None if it
+        doesn't exist.
+
+        Raises:
+            ValueError: The index is damaged.
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                signature = file_signature(os.fstat(f.fileno()))
+                index = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        if not isinstance(index, dict) or index.get('format') != INDEX_FORMAT:
+            raise ValueError(f"{self.index_path} is not a prompt index")
+        return signature, index
+
+    def _apply_index(self, signature, index):
+        """Switch to the text file an index names; return its prompts as records"""
+        if self.blob is None or index['text'] != self.blob.name:
+            self.blob = TextBlob(os.path.join(self.directory, index['text']))
+            self.spans = {}
+        self.generation = index['generation']
+        blob = self.blob
+        records = {}
+        for entry in index['prompts']:
+            records[entry[0]] = StoredPromptRecord(*entry[:3], blob, entry[3], entry[4],
+                                                   entry[5] if len(entry) > 5 else None)
+        self.signature = signature
+        self.disk_records = records
+        return records
+
+    def _write_index(self, entries):
+        index = {'format': INDEX_FORMAT, 'generation': self.generation,
+                 'text': self.blob.name, 'prompts': entries}
+        stat = write_atomic(self.index_path, json.dumps(index, separators=(',', ':')).encode('utf-8'))
+        self.signature = file_signature(stat)
+
+    @staticmethod
+    def _entry(shortcut, record, offset, length):
+        entry = [shortcut, record.prepend, record.postpend, offset, length]
+        if record.extra:
+            entry.append(record.extra)
+        return entry
+
+    def load(self):
+        with self.write_lock, self._process_lock():
+            state = self._read_index_or_none()
+            if state is None:
+                prompts = read_json_prompts(self.filepath)
+                self.generation = 0
+                self._write_generation(records_from_prompts(prompts))
+                print(f"Imported {len(prompts)} prompts from {self.filepath} into {self.index_path}")
+                state = self._read_index()
+            records = self._apply_index(*state)
+            if self._needs_compaction(records.values()):
+                self._write_generation(records)
+                records = self._apply_index(*self._read_index())
+            self._remove_old_text()
+        return records
+
+    def _read_index_or_none(self):
+        try:
+            return self._read_index()
+        except ValueError as e:
+            # Start again from prompts.json rather than lose the ability to save
+            backup = f"{self.index_path}.corrupt"
+            print(f"Error reading {self.index_path} ({e}); moved it to {backup}")
+            os.replace(self.index_path, backup)
+            return None
+
+    def _needs_compaction(self, records):
+        live = sum(record.length for record in records if isinstance(record, StoredPromptRecord))
+        return self.blob.size() > max(self.min_compact_bytes, self.compact_ratio * live)
+
+    def _write_generation(self, records):
+        """Write every body to a fresh text file and point a new index at it"""
+        generation = self.generation + 1
+        path = self._text_path(generation)
+        entries = []
+        spans = {}
+        offset = 0
+        with open(path, 'wb') as f:
+            for shortcut, record in records.items():
+                if isinstance(record, StoredPromptRecord):
+                    data = record.blob.read_bytes(record.offset, record.length)
+                else:
+                    data = record.text.encode('utf-8')
+                f.write(data)
+                entries.append(self._entry(shortcut, record, offset, len(data)))
+                spans[shortcut] = (record, offset, len(data))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        fsync_directory(path)
+        old = self.blob
+        self.blob = TextBlob(path)
+        self.generation = generation
+        self._write_index(entries)
+        self.disk_records = records
+        self.spans = spans
+        if old is not None:
+            try:
+                os.remove(old.path)
+            except OSError:
+                # Still mapped elsewhere on Windows; removed on a later load
+                pass
+
+    def _remove_old_text(self):
+        """Delete text files of earlier generations left behind"""
+        for name in os.listdir(self.directory):
+            match = self.text_pattern.match(name)
+            if match and int(match.group(1)) < self.generation:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def _known_span(self, shortcut, record, blob, spans):
+        """(offset, length) of a record's body in blob, if known without reading it"""
+        if isinstance(record, StoredPromptRecord) and record.blob is blob:
+            return record.offset, record.length
+        known = spans.get(shortcut)
+        if known is not None and known[0] is record:
+            return known[1:]
+        return None
+
+    def _span(self, shortcut, record):
+        """Where the body of a record to be saved already is in the text file, or None"""
+        span = self._known_span(shortcut, record, self.blob, self.spans)
+        if span is not None:
+            return span
+        old = self.disk_records.get(shortcut)
+        if old is None or old is record:
+            return None
+        # E.g. a replace_prompts() that resent unchanged prompts, or a new
+        # prepend on the same text
+        span = self._known_span(shortcut, old, self.blob, self.spans)
+        if span is not None and old.same_text(record):
+            return span
+        return None
+
+    def _external_changes(self):
+        """
+        Pick up an index another process wrote since we last read or wrote
+        it; called with write_lock held.
+
+        Returns:
+            [(shortcut, old record or MISSING, new record or MISSING)], empty
+            if the index is unchanged.
+
+        Raises:
+            OSError, ValueError: The index couldn't be read.
+        """
+        if file_signature(os.stat(self.index_path)) == self.signature:
+            return []
+        state = self._read_index()
+        if state is None:
+            return []
+        old_blob, old_spans, old = self.blob, self.spans, self.disk_records
+        new = self._apply_index(*state)
+        changes = []
+        for shortcut, record in new.items():
+            previous = old.get(shortcut, MISSING)
+            if previous is MISSING:
+                changes.append((shortcut, MISSING, record))
+                continue
+            span = self._known_span(shortcut, previous, old_blob, old_spans)
+            if (previous.prepend, previous.postpend, previous.extra) == \
+                    (record.prepend, record.postpend, record.extra):
+                if span is not None and old_blob is record.blob and span == (record.offset, record.length):
+                    continue
+                if previous.same_text(record):
+                    continue
+            changes.append((shortcut, previous, record))
+        changes.extend((shortcut, record, MISSING) for shortcut, record in old.items()
+                       if shortcut not in new)
+        return changes
+
+    @staticmethod
+    def _merge(records, changes):
+        """
+        Apply another process's changes to the records about to be saved,
+        the way PromptManager.reload_changes() does: a prompt changed
+        locally since the storage last saw it keeps the local version.
+        """
+        merged = None
+        for shortcut, old, new in changes:
+            value = (records if merged is None else merged).get(shortcut, MISSING)
+            if value is new or value == new or not (value is old or value == old):
+                continue
+            if merged is None:
+                merged = dict(records)
+            if new is MISSING:
+                del merged[shortcut]
+            else:
+                merged[shortcut] = new
+        return records if merged is None else merged
+
+    def _write(self, snapshot):
+        with self._process_lock():
+            # Another process may have saved since we last looked; merge its
+            # changes instead of writing over them
+            try:
+                self.merged_changes.extend(self._external_changes())
+            except (OSError, ValueError) as e:
+                print(f"Error reading {self.index_path} before saving: {e}")
+            records = self._merge(snapshot.records, self.merged_changes)
+            base = self.blob.size()
+            pending = bytearray()
+            entries = []
+            spans = {}
+            live = 0
+            for shortcut, record in records.items():
+                span = self._span(shortcut, record)
+                if span is None:
+                    data = record.text.encode('utf-8')
+                    span = (base + len(pending), len(data))
+                    pending += data
+                if not (isinstance(record, StoredPromptRecord) and record.blob is self.blob):
+                    spans[shortcut] = (record,) + span
+                entries.append(self._entry(shortcut, record, *span))
+                live += span[1]
+            if pending:
+                self.blob.append(pending, base)
+            self._write_index(entries)
+            self.disk_records = records
+            self.spans = spans
+            if base + len(pending) > max(self.min_compact_bytes, self.compact_ratio * live):
+                self._write_generation(records)
+
+    def _text_matches(self, record, terms):
+        # Rule out ASCII bodies that don't contain an ASCII term anywhere by
+        # searching the mapped bytes; only the rest are decoded. (Non-ASCII
+        # text can casefold to ASCII, e.g. "ß" to "ss", so it is decoded.)
+        if isinstance(record, StoredPromptRecord):
+            for term in terms:
+                if (term.isascii() and not record.contains(re.compile(re.escape(term.encode()), re.IGNORECASE))
+                        and not record.contains(NON_ASCII)):
+                    return False
+        return super()._text_matches(record, terms)
+
+    def watch_paths(self):
+        return [self.index_path]
+
+    def poll(self):
+        with self.write_lock:
+            # Changes merged by a save are reported first; the manager skips
+            # the ones it already has
+            changes, self.merged_changes = self.merged_changes, []
+            try:
+                changes.extend(self._external_changes())
+            except (OSError, ValueError) as e:
+                # The signature is left alone so the next poll retries
+                print(f"Error reading {self.index_path} for changes: {e}")
+            return changes or None
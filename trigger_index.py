@@ -0,0 +1,154 @@
+"""
+Compiled trigger index for keyboard shortcut matching.
+Stores every full trigger (prepend + shortcut + postpend) in a reversed-suffix
+trie so the listener can find the matching prompt by walking the end of the
+typed buffer backwards, independent of how many prompts are stored.
+Individual prompts can be added, changed or removed in place, so a change
+doesn't require rebuilding the whole trie.
+
+Terminal nodes hold the PromptRecord itself, whose full trigger was computed
+when it was loaded, so a match needs no further lookups.
+"""
+
+
+class TriggerIndex:
+    """Reversed-suffix trie over the full trigger of every prompt"""
+
+    def __init__(self, prompts=None):
+        """
+        Initialize the index.
+
+        Args:
+            prompts: Optional mapping of shortcut -> PromptRecord to build from.
+        """
+        self.root = {}
+        self.max_length = 0
+        self.size = 0
+        self.records = {}  # shortcut -> indexed record, for in-place updates
+        if prompts:
+            self.build(prompts)
+
+    def build(self, prompts):
+        """
+        Rebuild the index.
+
+        Args:
+            prompts: Mapping of shortcut -> PromptRecord (a snapshot's records).
+        """
+        # Build into fresh containers and swap at the end so a concurrent
+        # match() never sees a half-built trie
+        root = {}
+        max_length = 0
+        size = 0
+        records = {}
+        for shortcut, record in prompts.items():
+            full_trigger = record.trigger
+            if not full_trigger:
+                continue
+            records[shortcut] = record
+            node = root
+            for char in reversed(full_trigger):
+                node = node.setdefault(char, {})
+            # The None key marks a terminal node. When two prompts share the
+            # same full trigger the first one in prompt order wins.
+            if None not in node:
+                node[None] = record
+                size += 1
+            max_length = max(max_length, len(full_trigger))
+        self.max_length = max_length
+        self.size = size
+        self.records = records
+        self.root = root
+
+    def update(self, changed, removed):
+        """
+        Apply a change to the prompt set in place. Must not run concurrently
+        with match() on another thread, or with another update.
+
+        Args:
+            changed: Dict of added or changed prompts (shortcut -> PromptRecord).
+            removed: Shortcuts that were removed.
+        """
+        for shortcut in removed:
+            self._remove(shortcut)
+        for shortcut, record in changed.items():
+            indexed = self.records.get(shortcut)
+            if indexed is not None and indexed.trigger == record.trigger:
+                # Same trigger, new text: swap the entry if this prompt owns it
+                self.records[shortcut] = record
+                node = self._find(record.trigger)
+                if node is not None and node[None].shortcut == shortcut:
+                    node[None] = record
+                continue
+            self._remove(shortcut)
+            if record.trigger:
+                self.records[shortcut] = record
+                self._insert(record)
+
+    def _find(self, full_trigger):
+        node = self.root
+        for char in reversed(full_trigger):
+            node = node.get(char)
+            if node is None:
+                return None
+        return node if None in node else None
+
+    def _insert(self, record):
+        node = self.root
+        for char in reversed(record.trigger):
+            node = node.setdefault(char, {})
+        if None not in node:
+            node[None] = record
+            self.size += 1
+        self.max_length = max(self.max_length, len(record.trigger))
+
+    def _remove(self, shortcut):
+        indexed = self.records.pop(shortcut, None)
+        if indexed is None:
+            return
+        full_trigger = indexed.trigger
+        path = [self.root]
+        for char in reversed(full_trigger):
+            path.append(path[-1].get(char))
+            if path[-1] is None:
+                return
+        node = path[-1]
+        entry = node.get(None)
+        if entry is None or entry.shortcut != shortcut:
+            # Another prompt owns this trigger
+            return
+        del node[None]
+        self.size -= 1
+        # Prune branches left empty. max_length is left alone; an overestimate
+        # only costs a failed lookup.
+        for depth in range(len(full_trigger), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][full_trigger[-depth]]
+        # Hand the trigger to another prompt that shares it
+        for record in self.records.values():
+            if record.trigger == full_trigger:
+                self._insert(record)
+                break
+
+    def match(self, chars):
+        """
+        Find the prompt whose trigger is the longest suffix of the typed text.
+
+        Args:
+            chars: The typed text - a str or a KeyBuffer (anything that
+                   supports len() and negative indexing).
+
+        Returns:
+            The PromptRecord with the longest matching trigger, or None.
+        """
+        node = self.root
+        best = None
+        for i in range(1, min(len(chars), self.max_length) + 1):
+            node = node.get(chars[-i])
+            if node is None:
+                break
+            entry = node.get(None)
+            if entry is not None:
+                best = entry
+        return best
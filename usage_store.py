@@ -0,0 +1,256 @@
+"""
+Persistent usage statistics for prompt shortcuts.
+Keeps per-shortcut counters, last-used timestamps and time-bucketed
+histograms in memory. Every event is appended to a small log, and the log is
+periodically compacted into a snapshot file.
+"""
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class ShortcutStats:
+    """Counters and histogram for a single shortcut"""
+
+    __slots__ = ('count', 'first_used', 'last_used', 'buckets')
+
+    def __init__(self, count=0, first_used=None, last_used=None, buckets=None):
+        self.count = count
+        self.first_used = first_used
+        self.last_used = last_used
+        # (bucket start, count) pairs, oldest first
+        self.buckets = deque(buckets or [])
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'first_used': self.first_used,
+            'last_used': self.last_used,
+            'buckets': [list(bucket) for bucket in self.buckets],
+        }
+
+
+class UsageStore:
+    """In-memory usage statistics with append-only logging and periodic compaction"""
+
+    def __init__(self, path="usage_stats.json", pending_path="usage_events.jsonl",
+                 bucket_seconds=3600, max_buckets=24 * 7, compact_interval=60.0):
+        """
+        Initialize the store and load persisted statistics.
+
+        Args:
+            path: Snapshot file. The event log lives next to it (path + ".log").
+            pending_path: File the UsageTracker writes to when no server is
+                          running; its events are imported on load.
+            bucket_seconds: Width of one histogram bucket.
+            max_buckets: Number of histogram buckets kept per shortcut.
+            compact_interval: Seconds between background compactions.
+        """
+        self.path = path
+        self.log_path = path + ".log"
+        self.pending_path = pending_path
+        self.bucket_seconds = bucket_seconds
+        self.max_buckets = max_buckets
+        self.compact_interval = compact_interval
+        self.lock = threading.Lock()
+        self.stats = {}
+        # Shortcuts ordered from least to most recently used
+        self.recent_order = OrderedDict()
+        self.log_file = None
+        self.dirty = False
+        self.stop_event = threading.Event()
+        self.worker = None
+        self.load()
+
+    def record(self, shortcut, timestamp=None):
+        """Record one use of a shortcut. O(1)."""
+        self.record_many([{'shortcut': shortcut, 'timestamp': timestamp}])
+
+    def record_many(self, events):
+        """
+        Record a batch of usage events.
+
+        Args:
+            events: List of {'shortcut': str, 'timestamp': float or None}.
+                    Events without a shortcut are skipped.
+
+        Raises:
+            ValueError: An event has an invalid timestamp. Nothing from the
+                        batch is recorded, so memory and the log stay in step.
+        """
+        valid = []
+        for event in events:
+            shortcut = event.get('shortcut')
+            if not shortcut or not isinstance(shortcut, str):
+                continue
+            timestamp = event.get('timestamp') or time.time()
+            try:
+                timestamp = float(timestamp)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid timestamp for {shortcut}: {timestamp!r}") from None
+            if not math.isfinite(timestamp):
+                raise ValueError(f"Invalid timestamp for {shortcut}: {timestamp!r}")
+            valid.append((shortcut, timestamp))
+        lines = []
+        with self.lock:
+            for shortcut, timestamp in valid:
+                self._apply(shortcut, timestamp)
+                lines.append(json.dumps({'shortcut': shortcut, 'timestamp': timestamp}))
+            if lines:
+                self._log_lines(lines)
+                self.dirty = True
+
+    def _apply(self, shortcut, timestamp):
+        stats = self.stats.get(shortcut)
+        if stats is None:
+            stats = self.stats[shortcut] = ShortcutStats(first_used=timestamp)
+        stats.count += 1
+        if stats.last_used is None or timestamp >= stats.last_used:
+            stats.last_used = timestamp
+            self.recent_order[shortcut] = timestamp
+            self.recent_order.move_to_end(shortcut)
+
+        bucket = int(timestamp // self.bucket_seconds) * self.bucket_seconds
+        buckets = stats.buckets
+        if buckets and buckets[-1][0] == bucket:
+            buckets[-1][1] += 1
+        elif not buckets or bucket > buckets[-1][0]:
+            buckets.append([bucket, 1])
+            if len(buckets) > self.max_buckets:
+                buckets.popleft()
+        # Events older than the newest bucket (late deliveries) only count
+        # towards the totals
+
+    def _log_lines(self, lines):
+        if self.log_file is None:
+            self.log_file = open(self.log_path, 'a')
+        self.log_file.write('\n'.join(lines) + '\n')
+        self.log_file.flush()
+
+    def top(self, limit=10):
+        """Return the most used shortcuts, highest count first"""
+        with self.lock:
+            items = heapq.nlargest(limit, self.stats.items(),
+                                   key=lambda item: (item[1].count, item[1].last_used or 0))
+            return [self._summary(shortcut, stats) for shortcut, stats in items]
+
+    def recent(self, limit=10):
+        """Return the most recently used shortcuts, newest first"""
+        with self.lock:
+            result = []
+            for shortcut in reversed(self.recent_order):
+                if len(result) >= limit:
+                    break
+                result.append(self._summary(shortcut, self.stats[shortcut]))
+            return result
+
+    def get(self, shortcut):
+        """Return full statistics (including the histogram) for one shortcut"""
+        with self.lock:
+            stats = self.stats.get(shortcut)
+            if stats is None:
+                return None
+            result = stats.to_dict()
+            result['shortcut'] = shortcut
+            result['bucket_seconds'] = self.bucket_seconds
+            return result
+
+    def _summary(self, shortcut, stats):
+        return {'shortcut': shortcut, 'count': stats.count, 'last_used': stats.last_used}
+
+    def load(self):
+        """Load the snapshot, replay the event log and import pending tracker events"""
+        with self.lock:
+            self.stats = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                    for shortcut, entry in data.get('shortcuts', {}).items():
+                        self.stats[shortcut] = ShortcutStats(
+                            entry.get('count', 0), entry.get('first_used'),
+                            entry.get('last_used'), entry.get('buckets'))
+                except (json.JSONDecodeError, OSError) as e:
+                    print(f"Could not read usage statistics: {e}")
+            ordered = sorted((s for s in self.stats.items() if s[1].last_used is not None),
+                             key=lambda item: item[1].last_used)
+            self.recent_order = OrderedDict((shortcut, stats.last_used) for shortcut, stats in ordered)
+
+            for event in self._read_events(self.log_path):
+                self._apply(event['shortcut'], event['timestamp'])
+
+            pending = self._read_events(self.pending_path) if self.pending_path else []
+            if pending:
+                for event in pending:
+                    self._apply(event['shortcut'], event['timestamp'])
+                self._log_lines([json.dumps(event) for event in pending])
+                self.dirty = True
+        if pending:
+            try:
+                os.remove(self.pending_path)
+            except OSError:
+                pass
+
+    def _read_events(self, path):
+        events = []
+        if not os.path.exists(path):
+            return events
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                    if event.get('shortcut'):
+                        event['timestamp'] = float(event.get('timestamp') or time.time())
+                        events.append(event)
+                except (json.JSONDecodeError, ValueError, AttributeError):
+                    # A torn last line from a crash - skip it
+                    continue
+        return events
+
+    def compact(self):
+        """Write a fresh snapshot and truncate the event log"""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {
+                'bucket_seconds': self.bucket_seconds,
+                'shortcuts': {shortcut: stats.to_dict() for shortcut, stats in self.stats.items()},
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+            open(self.log_path, 'w').close()
+            self.dirty = False
+
+    def start(self):
+        """Start periodic background compaction"""
+        if self.worker and self.worker.is_alive():
+            return
+        self.stop_event.clear()
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.worker:
+            self.worker.join(timeout=1)
+            self.worker = None
+        self.compact()
+
+    def _run(self):
+        while not self.stop_event.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Error compacting usage statistics: {e}")
@@ -0,0 +1,134 @@
+"""
+Asynchronous usage telemetry for prompt expansions.
+Expansion events are queued in-process and flushed in batches by a background
+worker, so recording usage never waits on the web server.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    from urllib.request import urlopen, Request
+    HAS_URLLIB = True
+except ImportError:
+    HAS_URLLIB = False
+
+DEFAULT_ENDPOINT = 'http://localhost:5000/api/prompts/track-usage'
+
+
+class UsageTracker:
+    """Bounded in-process queue of usage events with a batching flush worker"""
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, local_path="usage_events.jsonl", sink=None,
+                 max_pending=1000, batch_size=100, flush_interval=2.0, retry_interval=30.0):
+        """
+        Initialize the tracker.
+
+        Args:
+            endpoint: URL of the track-usage API that accepts batched events.
+            local_path: JSON-lines file that receives events when the server
+                        cannot be reached.
+            sink: Optional callable taking a list of events. When given, it
+                  replaces the HTTP/local-file delivery (e.g. to write
+                  straight into an in-process store).
+            max_pending: Queue capacity; events beyond it are dropped.
+            batch_size: Maximum number of events sent per flush.
+            flush_interval: Seconds the worker waits to fill a batch.
+            retry_interval: Seconds to skip the server after a failed post.
+        """
+        self.endpoint = endpoint
+        self.local_path = local_path
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.events = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.server_retry_at = 0.0
+        self.worker = None
+        self.stop_event = threading.Event()
+        self.flush_lock = threading.Lock()
+
+    def record(self, shortcut):
+        """Queue a usage event. Never blocks; drops the event if the queue is full."""
+        try:
+            self.events.put_nowait({'shortcut': shortcut, 'timestamp': time.time()})
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            return
+        self.stop_event.clear()
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        """Stop the worker and deliver whatever is still queued"""
+        self.stop_event.set()
+        if self.worker:
+            self.worker.join(timeout=self.flush_interval + 1)
+            self.worker = None
+        self.flush()
+
+    def flush(self):
+        """Deliver all queued events now (e.g. at shutdown)"""
+        while True:
+            batch = self._take_batch(block=False)
+            if not batch:
+                break
+            self._deliver(batch)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            batch = self._take_batch(block=True)
+            if batch:
+                self._deliver(batch)
+
+    def _take_batch(self, block):
+        batch = []
+        try:
+            if block:
+                batch.append(self.events.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _deliver(self, batch):
+        with self.flush_lock:
+            try:
+                if self.sink:
+                    self.sink(batch)
+                elif not self._post(batch):
+                    self._append_local(batch)
+            except Exception as e:
+                # Non-critical - never let telemetry errors escape
+                print(f"Failed to record usage: {e}")
+
+    def _post(self, batch):
+        if not HAS_URLLIB or time.monotonic() < self.server_retry_at:
+            return False
+        try:
+            data = json.dumps({'events': batch}).encode('utf-8')
+            req = Request(self.endpoint, data=data,
+                          headers={'Content-Type': 'application/json'})
+            urlopen(req, timeout=1.0).close()
+            return True
+        except Exception:
+            # No server running - stop trying for a while
+            self.server_retry_at = time.monotonic() + self.retry_interval
+            return False
+
+    def _append_local(self, batch):
+        if not self.local_path:
+            return
+        with open(self.local_path, 'a') as f:
+            for event in batch:
+                f.write(json.dumps(event) + '\n')
+            f.flush()
+            os.fsync(f.fileno())